@@ -0,0 +1,182 @@
+import argparse
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+from multiprocessing import reduction
+from threading import Thread
+import server
+from newtork_utils import send_message
+from send_queue import SLOW_CLIENT_POLICIES
+
+
+ARENAS = ("alpha:8000:2000:100", "beta:8000:2000:100")  # name:map size:cell count:max players
+LOAD_REPORT_INTERVAL = 0.5  # seconds between tick time updates from arena workers
+
+log = logging.getLogger("arena_server")
+
+
+def arena_worker(name, map_size, cell_count, max_players, tick_rate, settings, conn, clients, tick_ms):
+    '''Runs one world with the server.py game loop, serves the client sockets the lobby hands over'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # lobby stops its workers
+    server.MAP_SIZE = map_size
+    server.CELL_COUNT = cell_count
+    server.MAX_PLAYERS = max_players
+    for setting, value in settings.items():
+        setattr(server, setting, value)
+    server.configure_logging(server.LOG_LEVEL)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s {name} %(name)s: %(message)s"))
+
+    server.init_game()
+    Thread(target=server.game_loop, args=(tick_rate,), daemon=True).start()
+    Thread(target=report_load, args=(tick_ms,), daemon=True).start()
+    # clients can't reach a worker through the lobby port, each arena has a UDP port of its own
+    if server.UDP and (udp_socket := server.open_datagram_socket(server.HOST, 0)) is not None:
+        Thread(target=server.receive_datagrams, args=(udp_socket,), daemon=True).start()
+    log.info("Arena %s running, map size %d, %d cells, up to %d players.", name, map_size, cell_count, max_players)
+
+    while True:
+        try:
+            client_id = conn.recv()
+            fd = reduction.recv_handle(conn)
+        except EOFError:
+            break  # lobby is gone, the arena stops with it
+        Thread(target=serve_client, args=(socket.socket(fileno=fd), client_id, clients), daemon=True).start()
+
+
+def report_load(tick_ms):
+    while True:
+        tick_ms.value = server.tick_ms_average
+        time.sleep(LOAD_REPORT_INTERVAL)
+
+
+def serve_client(conn, client_id, clients):
+    try:
+        server.handle_player_gameplay(conn, client_id)
+    finally:
+        with clients.get_lock():
+            clients.value -= 1
+
+
+class Arena():
+    '''Lobby side of one arena worker process, tracks its load for placement'''
+
+    def __init__(self, name, map_size, cell_count, max_players, tick_rate, settings):
+        self.name = name
+        self.max_players = max_players
+        self.tick_budget_ms = 1000 / tick_rate
+        self.clients = multiprocessing.Value('i', 0)  # handed over and not disconnected yet, includes handshakes
+        self.tick_ms = multiprocessing.Value('d', 0)
+
+        self.conn, worker_conn = multiprocessing.Pipe()
+        # not a daemon, the sharded cell backend starts processes of its own
+        self.process = multiprocessing.Process(
+            target=arena_worker, name=f"arena-{name}",
+            args=(name, map_size, cell_count, max_players, tick_rate, settings, worker_conn, self.clients, self.tick_ms))
+        self.process.start()
+
+    def load(self):
+        '''Fraction of capacity in use, by players or by tick time, whichever is higher'''
+        return max(self.clients.value / self.max_players, self.tick_ms.value / self.tick_budget_ms)
+
+    def is_full(self):
+        return self.clients.value >= self.max_players
+
+    def hand_over(self, conn, client_id):
+        with self.clients.get_lock():
+            self.clients.value += 1
+        self.conn.send(client_id)
+        reduction.send_handle(self.conn, conn.fileno(), self.process.pid)
+
+    def metrics(self):
+        return {"clients": self.clients.value, "tick_ms": round(self.tick_ms.value, 3), "load": round(self.load(), 3)}
+
+    def close(self):
+        '''Worker exits when its pipe is closed, it is terminated if it doesn't'''
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+def log_loads(arenas, interval):
+    while True:
+        time.sleep(interval)
+        log.info("Arenas: %s", {arena.name: arena.metrics() for arena in arenas})
+
+
+def parse_arena(spec):
+    name, map_size, cell_count, max_players = spec.split(":")
+    if int(max_players) < 1:
+        raise ValueError(f"arena {name} must allow at least one player, got {max_players}")
+    return name, int(map_size), int(cell_count), int(max_players)
+
+
+def least_loaded(arenas):
+    '''Arena with the lowest load that has room, None if all are full'''
+    open_arenas = [arena for arena in arenas if not arena.is_full()]
+    return min(open_arenas, key=Arena.load, default=None)
+
+
+def main(host=server.HOST, port=server.PORT, arena_specs=ARENAS, tick_rate=server.TICK_RATE,
+         snapshot_rate=server.SNAPSHOT_RATE, slow_client_policy=server.SLOW_CLIENT_POLICY,
+         cell_backend=server.CELL_BACKEND, input_rate=server.INPUT_RATE, log_level=server.LOG_LEVEL,
+         stats_interval=server.STATS_INTERVAL, udp=server.UDP, chunk_size=server.CHUNK_SIZE):
+    server.configure_logging(log_level)
+    # server.py globals set in every arena worker
+    settings = {"SNAPSHOT_RATE": snapshot_rate, "SLOW_CLIENT_POLICY": slow_client_policy, "CELL_BACKEND": cell_backend,
+                "INPUT_RATE": input_rate, "LOG_LEVEL": log_level, "STATS_INTERVAL": stats_interval,
+                "HOST": host, "UDP": udp, "CHUNK_SIZE": chunk_size}
+    arenas = [Arena(*parse_arena(spec), tick_rate, settings) for spec in arena_specs]
+    log.info("Lobby is running with %d arenas.", len(arenas))
+    if stats_interval:
+        Thread(target=log_loads, args=(arenas, stats_interval), daemon=True).start()
+
+    client_id = 0
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((host, port))
+            s.listen()
+
+            while True:
+                conn, addr = s.accept()
+                client_id += 1  # unique across arenas
+                with conn:
+                    arena = least_loaded(arenas)
+                    if arena is None:
+                        log.warning("All arenas are full, refusing %s.", addr)
+                        send_message(conn, "ERROR Server is full")
+                        continue
+                    arena.hand_over(conn, client_id)
+                    log.info("Client %d from %s placed in arena %s.", client_id, addr, arena.name)
+    finally:
+        for arena in arenas:
+            arena.conn.close()
+        for arena in arenas:
+            arena.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Agar.io lobby placing players in arenas run by worker processes")
+    parser.add_argument("--host", default=server.HOST)
+    parser.add_argument("--port", type=int, default=server.PORT)
+    parser.add_argument("--arena", dest="arenas", action="append", metavar="NAME:MAP_SIZE:CELL_COUNT:MAX_PLAYERS",
+                        help=f"one worker process per arena, default {' '.join(ARENAS)}")
+    parser.add_argument("--tick-rate", type=int, default=server.TICK_RATE, help="simulation ticks per second")
+    parser.add_argument("--snapshot-rate", type=int, default=server.SNAPSHOT_RATE, help="world snapshots per second")
+    parser.add_argument("--slow-client-policy", choices=SLOW_CLIENT_POLICIES, default=server.SLOW_CLIENT_POLICY)
+    parser.add_argument("--cell-backend", choices=server.CELL_BACKENDS, default=server.CELL_BACKEND)
+    parser.add_argument("--input-rate", type=int, default=server.INPUT_RATE, help="input messages per second a client may send")
+    parser.add_argument("--log-level", choices=server.LOG_LEVELS, default=server.LOG_LEVEL)
+    parser.add_argument("--stats-interval", type=float, default=server.STATS_INTERVAL,
+                        help="seconds between stats dumps of every arena and arena loads, 0 is off")
+    parser.add_argument("--no-udp", dest="udp", action="store_false", help="refuse `/transport udp`, TCP only")
+    parser.add_argument("--chunk-size", type=int, default=server.CHUNK_SIZE, help="side of the map chunks streamed to clients")
+    args = parser.parse_args()
+
+    main(host=args.host, port=args.port, arena_specs=args.arenas or ARENAS, tick_rate=args.tick_rate,
+         snapshot_rate=args.snapshot_rate, slow_client_policy=args.slow_client_policy, cell_backend=args.cell_backend,
+         input_rate=args.input_rate, log_level=args.log_level, stats_interval=args.stats_interval, udp=args.udp,
+         chunk_size=args.chunk_size)
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import struct
+import server
+from newtork_utils import send_message
+from send_queue import SendQueue, CLOSE_TIMEOUT
+
+
+log = logging.getLogger("async_server")
+
+
+class NoLock():
+    '''Stands in for server locks, all game state is used from the event loop thread only'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def acquire(self, *args, **kwargs):
+        return True
+
+    def release(self):
+        pass
+
+
+class StreamConnection():
+    '''Socket-like wrapper so server functions can send through an asyncio StreamWriter'''
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def sendall(self, data):
+        if self.writer.is_closing():
+            raise ConnectionError("Stream is closed")
+        self.writer.write(data)
+
+    send = sendall
+
+
+class StreamSendQueue(SendQueue):
+    '''SendQueue drained by a writer task, data keeps coalescing while the stream drains'''
+
+    def __init__(self, writer, *args, **kwargs):
+        super().__init__(writer, *args, **kwargs)
+        self.has_work = asyncio.Event()
+        self.writer_task = asyncio.create_task(self._write_loop())
+
+    def _notify(self):
+        self.has_work.set()
+
+    def _abort(self):
+        self.conn.transport.abort()
+
+    async def wait_closed(self, timeout=CLOSE_TIMEOUT):
+        '''Waits for the writer of a closed queue to send what is left, before the stream is closed'''
+        try:
+            await asyncio.wait_for(asyncio.shield(self.writer_task), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _write_loop(self):
+        while True:
+            await self.has_work.wait()
+            self.has_work.clear()
+
+            # nothing is queued after closing, so this take gets the rest
+            closed = self.closed
+            data = self.take()
+            if data:
+                try:
+                    self.conn.write(data)
+                    await self.conn.drain()
+                except ConnectionError as e:
+                    log.warning("Error sending data: %s", e)
+                    self.close()
+                    return
+            if closed:
+                return
+
+
+class DatagramServer(asyncio.DatagramProtocol):
+    '''UDP channel socket, datagrams are handled on the event loop like everything else'''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        server.handle_datagram(data, address, self.transport)
+
+
+async def game_loop(tick_rate):
+    loop = asyncio.get_running_loop()
+    tick_interval = 1 / tick_rate
+    snapshot_interval = server.ticks_per_snapshot(tick_rate)
+    next_tick = loop.time()
+    next_stats = next_tick + server.STATS_INTERVAL
+    tick = 0
+
+    while True:
+        tick += 1
+        server.simulate_tick(tick_interval, broadcast=tick % snapshot_interval == 0)
+
+        if server.STATS_INTERVAL and loop.time() >= next_stats:
+            server.dump_stats()
+            next_stats += server.STATS_INTERVAL
+
+        next_tick += tick_interval
+        delay = next_tick - loop.time()
+        if delay < 0:
+            # tick took too long, don't try to catch up
+            next_tick = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
+
+async def handle_player_gameplay(reader, writer, client_id):
+    conn = StreamConnection(writer)
+    handshake = server.Handshake(conn, client_id)
+    player = None
+
+    try:
+        while player is None:
+            log.debug("Asking for username...")
+            send_message(conn, "GET username")
+            data = await reader.read(1024)
+            if not data:
+                return
+
+            player = handshake.handle(data.decode('ascii').strip())
+
+        server.send_initial_state(conn, player)
+        send_queue = StreamSendQueue(writer, player.protocol, server.MAP_SIZE,
+                                     server.MAX_QUEUED_BYTES, server.SLOW_CLIENT_POLICY)
+        server.register_connection(player, send_queue)
+
+        input_format = server.INPUT_FORMATS[player.input_mode]
+        input_size = struct.calcsize(input_format)
+        while True:
+            try:
+                data = await reader.readexactly(input_size)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                data = None
+
+            if not player.is_alive:
+                break
+
+            # connection closed or client quit
+            if data is None or not server.apply_input(player, input_format, data):
+                server.remove_player(player)
+                break
+    except ConnectionError:
+        if player is not None and player.is_alive:
+            server.remove_player(player)
+    finally:
+        if player is not None and player.conn is not conn:
+            player.conn.close()
+            await player.conn.wait_closed()
+        writer.close()
+        if player is not None and not player.is_alive:
+            server.retire_player(player)
+
+
+async def serve(host, port, tick_rate, player_counter=0, listener=None):
+    '''listener is a socket already bound to host and port, a standby has one when it takes over'''
+
+    async def on_connect(reader, writer):
+        nonlocal player_counter
+        log.info("Connected with: %s", writer.get_extra_info('peername'))
+        player_counter += 1
+        await handle_player_gameplay(reader, writer, player_counter)
+
+    game_loop_task = asyncio.create_task(game_loop(tick_rate))
+    log.info("Game loop running at %d ticks per second.", tick_rate)
+
+    if server.UDP:
+        try:
+            await asyncio.get_running_loop().create_datagram_endpoint(DatagramServer, local_addr=(host, port))
+            server.datagram_port = port
+        except OSError as e:
+            log.warning("UDP transport is off, can't bind %s:%d: %s", host, port, e)
+
+    if listener is not None:
+        tcp_server = await asyncio.start_server(on_connect, sock=listener)
+    else:
+        tcp_server = await asyncio.start_server(on_connect, host, port)
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+    game_loop_task.cancel()
+
+
+def main(host=server.HOST, port=server.PORT, tick_rate=server.TICK_RATE, record=None, checkpoint=None, restore=False,
+         standby=False, **settings):
+    '''settings are the keyword arguments of server.configure'''
+    server.configure(**settings)
+    log.info("Server is running (asyncio).")
+
+    # game state is only touched from the event loop, so the thread locks are not needed
+    server.cells_lock = NoLock()
+    server.players_lock = NoLock()
+    server.connections_lock = NoLock()
+
+    if record:
+        server.start_recording(record, tick_rate)
+    listener, player_counter = server.start_game(host, port, checkpoint, restore, standby)
+    log.info("Initialized game.")
+
+    asyncio.run(serve(host, port, tick_rate, player_counter, listener))
+
+
+if __name__ == "__main__":
+    main(**server.parse_args("Agar.io game server, asyncio mode"))
@@ -0,0 +1,610 @@
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import bot
+import server
+from newtork_utils import encode_color, pack_cells, pack_players, unpack_cells, unpack_players, CellImage
+from numpy_cells import NumpyCells, np
+from sharded_cells import ShardedCells
+from recorder import Recorder
+from checkpoint import CheckpointWriter, read_checkpoint
+from replay import NullConnection
+from send_queue import SendQueue
+
+
+CELL_COUNTS = (2_000, 20_000, 200_000)
+PLAYER_COUNTS = (10, 100, 500)
+TICKS = 5
+PACKING_CELL_COUNTS = (2_000, 50_000, 500_000)
+LOAD_BOT_COUNTS = (10, 50, 100, 200)
+LOAD_STAGE_SECONDS = 5
+UDP_BOT_COUNT = 50
+UDP_LOSS_RATES = (0, 0.05, 0.2)  # fractions of datagrams the lossy relays drop in each direction
+REPLAY_PLAYER_COUNTS = (10, 50, 100)
+REPLAY_TICKS = 150
+MEMORY_CELL_COUNT = 100_000
+MEMORY_PLAYER_COUNT = 100
+MEMORY_TICKS = 30
+WORLD_CELL_COUNTS = (2_000, 200_000, 1_000_000)
+WORLD_PLAYER_COUNT = 50
+WORLD_SNAPSHOTS = 30
+WORLD_STEP = 20  # units players move between snapshots, without simulating so eaten cells don't add traffic
+RESTART_WORLDS = ((200_000, 40_000), (1_000_000, 90_000))  # cell count, map size
+RESTART_PLAYER_COUNT = 50
+RESTART_TICKS = 30  # played between the two checkpoints, a standby refreshes from one to the next
+
+
+class _NullConnection():
+    def sendall(self, data):
+        pass
+
+
+def _populate_world(cell_count, player_count):
+    server.cells.clear()
+    server.cells_grid.clear()
+    server.players.clear()
+    server.players_grid.clear()
+    server.connections.clear()
+    server.cell_image = CellImage(cell_count)
+
+    for i in range(cell_count):
+        cell = server.CellData(
+            random.randint(0, server.MAP_SIZE),
+            random.randint(0, server.MAP_SIZE),
+            encode_color(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+        )
+        server.cells[i] = cell
+        server.cells_grid.insert(i, cell.pos_x, cell.pos_y)
+        server.cell_image.update(i, cell.pos_x, cell.pos_y, cell.color)
+
+    for client_id in range(player_count):
+        username = f"bot{client_id}"
+        player = server.Player(
+            client_id, random.randint(0, server.MAP_SIZE), random.randint(0, server.MAP_SIZE), 0, username,
+            _NullConnection())
+        server.players[username] = player
+        server.connections[client_id] = player.conn
+        server.players_grid.insert(player, player.pos_x, player.pos_y)
+
+
+def _linear_scan(player):
+    '''Collision pass without the spatial index, used as a reference'''
+    eaten = 0
+    for cell in server.cells.values():
+        if player._collides_with(cell):
+            eaten += 1
+    for other_player in server.players.values():
+        if other_player is not player and player._collides_with(other_player):
+            eaten += 1
+    return eaten
+
+
+def _collision_tick():
+    tick_players = list(server.players.values())
+    for player in tick_players:
+        if player.is_alive:
+            # keep players at spawn size so growth does not skew later ticks
+            player.radius = server.PLAYER_SPAWN_RADIUS
+            player.collision_check()
+    server.find_kills(tick_players)  # players have the same size, nobody is eaten
+    server.cell_changes.clear()
+
+
+def benchmark_collisions():
+    print("cells    players  grid ms/tick  linear ms/tick")
+    for cell_count in CELL_COUNTS:
+        for player_count in PLAYER_COUNTS:
+            random.seed(cell_count + player_count)
+            _populate_world(cell_count, player_count)
+
+            # first tick eats everything under the spawned players, measure steady state
+            _collision_tick()
+
+            start = time.perf_counter()
+            for _ in range(TICKS):
+                _collision_tick()
+            grid_ms = (time.perf_counter() - start) / TICKS * 1000
+
+            # the reference scan is too slow for the biggest worlds
+            linear_ms = "-"
+            if cell_count * player_count <= 2_000_000:
+                start = time.perf_counter()
+                for player in server.players.values():
+                    _linear_scan(player)
+                linear_ms = f"{(time.perf_counter() - start) * 1000:.2f}"
+
+            print(f"{cell_count:<8} {player_count:<8} {grid_ms:<13.2f} {linear_ms}")
+
+
+def _cell_pass(tick_players):
+    for player in tick_players:
+        player.radius = server.PLAYER_SPAWN_RADIUS
+    if server.cell_store is not None:
+        server.eat_cells_vectorized(tick_players)
+    else:
+        for player in tick_players:
+            player.eat_cells()
+    server.cell_changes.clear()
+
+
+def benchmark_cell_backends():
+    if np is None:
+        print("numpy is not installed, skipping cell backend benchmark")
+        return
+
+    print(f"cells    players  python ms/tick  numpy ms/tick  sharded ms/tick ({server.SHARDS} shards)")
+    for cell_count in CELL_COUNTS:
+        for player_count in PLAYER_COUNTS:
+            results = []
+            for backend in server.CELL_BACKENDS:
+                random.seed(cell_count + player_count)
+                _populate_world(cell_count, player_count)
+                server.cell_store = None
+                if backend == "numpy":
+                    server.cells.clear()
+                    server.cells_grid.clear()
+                    server.cell_store = NumpyCells(cell_count, server.MAP_SIZE, server.GRID_BUCKET_SIZE,
+                                                   np.random.default_rng(cell_count))
+                    for key, pos_x, pos_y, _ in server.cell_store.values(range(cell_count)):
+                        server.cells_grid.insert(key, pos_x, pos_y)
+                elif backend == "sharded":
+                    server.cells.clear()
+                    server.cells_grid.clear()
+                    server.cell_store = ShardedCells(cell_count, server.MAP_SIZE, server.GRID_BUCKET_SIZE,
+                                                     server.SHARDS, cell_count)
+                    for key, pos_x, pos_y, _ in server.cell_store.values(range(cell_count)):
+                        server.cells_grid.insert(key, pos_x, pos_y)
+
+                tick_players = list(server.players.values())
+                _cell_pass(tick_players)
+
+                start = time.perf_counter()
+                for _ in range(TICKS):
+                    _cell_pass(tick_players)
+                results.append((time.perf_counter() - start) / TICKS * 1000)
+
+                if backend == "sharded":
+                    server.cell_store.close()
+
+            server.cell_store = None
+            print(f"{cell_count:<8} {player_count:<8} {results[0]:<15.2f} {results[1]:<14.2f} {results[2]:.2f}")
+
+
+def _pack_cells_appending(cells):
+    '''POST cells packing with bytes +=, as it was before pack_cells, used as a reference'''
+    packed_data = struct.pack('I', len(cells))
+    for key, cell in cells.items():
+        packed_data += struct.pack('IffI', key, cell.pos_x, cell.pos_y, cell.color)
+    return struct.pack('I', len(packed_data)) + packed_data
+
+
+def _time_ms(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def benchmark_packing():
+    '''Initial world sync: whole world and one view (what a joining player gets)'''
+    print("cells    appending ms  pack_into ms  image ms  view keys  view pack_into ms  view image ms")
+    for cell_count in PACKING_CELL_COUNTS:
+        random.seed(cell_count)
+        _populate_world(cell_count, 1)
+        player = next(iter(server.players.values()))
+        view_keys = server.cells_grid.query_rect(*player.view_rect())
+        view_cells = {key: server.cells[key] for key in view_keys}
+
+        # appending copies the whole buffer for every cell, too slow for the biggest world
+        appending_ms = "-"
+        if cell_count <= 50_000:
+            appending_ms = f"{_time_ms(_pack_cells_appending, server.cells):.2f}"
+
+        pack_into_ms = _time_ms(pack_cells, server.cells)
+        image_ms = _time_ms(server.cell_image.pack)
+        view_pack_into_ms = _time_ms(pack_cells, view_cells)
+        view_image_ms = _time_ms(server.cell_image.pack, view_keys)
+
+        print(f"{cell_count:<8} {appending_ms:<13} {pack_into_ms:<13.2f} {image_ms:<9.2f} {len(view_keys):<10} "
+              f"{view_pack_into_ms:<18.3f} {view_image_ms:.3f}")
+
+
+class _BufferConnection():
+    '''Socket stand-in receiving from a buffer, at most one TCP receive window per call'''
+
+    WINDOW = 64 * 1024
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def recv(self, n_bytes):
+        chunk = bytes(self.data[self.offset:self.offset + min(n_bytes, self.WINDOW)])
+        self.offset += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+        chunk = self.data[self.offset:self.offset + min(len(buffer), self.WINDOW)]
+        buffer[:len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+
+def _receive_exact_appending(sock, n_bytes):
+    data = b''
+    while len(data) < n_bytes:
+        chunk = sock.recv(n_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Socket connection broken")
+        data += chunk
+    return data
+
+
+def _unpack_cells_slicing(sock):
+    '''POST cells decoding as it was before the bulk decoders, used as a reference'''
+    data_length = struct.unpack('I', _receive_exact_appending(sock, 4))[0]
+    packed_data = _receive_exact_appending(sock, data_length)
+    cells = []
+    offset = 4
+    for _ in range(struct.unpack('I', packed_data[:4])[0]):
+        cells.append(struct.unpack('IffI', packed_data[offset:offset + 16]))
+        offset += 16
+    return cells
+
+
+def _unpack_players_slicing(sock):
+    '''POST players decoding as it was before the bulk decoders, used as a reference'''
+    data_length = struct.unpack('I', _receive_exact_appending(sock, 4))[0]
+    packed_data = _receive_exact_appending(sock, data_length)
+    players = []
+    offset = 4
+    for _ in range(struct.unpack('I', packed_data[:4])[0]):
+        client_id = struct.unpack('I', packed_data[offset:offset + struct.calcsize('I')])[0]
+        offset += struct.calcsize('I')
+        username_length = struct.unpack('I', packed_data[offset:offset + struct.calcsize('I')])[0]
+        offset += struct.calcsize('I')
+        username = packed_data[offset:offset + username_length].decode('ascii')
+        offset += username_length
+        player_data = struct.unpack('ffIf', packed_data[offset:offset + struct.calcsize('ffIf')])
+        offset += struct.calcsize('ffIf')
+        players.append((client_id, username, *player_data))
+    return players
+
+
+def benchmark_decoding():
+    '''Client side of the initial world sync, receiving and decoding POST cells and POST players'''
+    print("cells    slicing ms  bulk ms")
+    for cell_count in PACKING_CELL_COUNTS:
+        random.seed(cell_count)
+        _populate_world(cell_count, 0)
+        packed_data = bytes(server.cell_image.pack())
+
+        slicing_ms = _time_ms(_unpack_cells_slicing, _BufferConnection(packed_data))
+        bulk_ms = _time_ms(unpack_cells, _BufferConnection(packed_data))
+        assert _unpack_cells_slicing(_BufferConnection(packed_data)) == unpack_cells(_BufferConnection(packed_data))
+        print(f"{cell_count:<8} {slicing_ms:<11.2f} {bulk_ms:.2f}")
+
+    print("players  slicing ms  bulk ms")
+    for player_count in PLAYER_COUNTS:
+        random.seed(player_count)
+        _populate_world(0, player_count)
+        packed_data = pack_players(server.players)
+
+        slicing_ms = _time_ms(_unpack_players_slicing, _BufferConnection(packed_data))
+        bulk_ms = _time_ms(unpack_players, _BufferConnection(packed_data))
+        print(f"{player_count:<8} {slicing_ms:<11.3f} {bulk_ms:.3f}")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind((server.HOST, 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_server(port, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((server.HOST, port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError("Server did not start")
+
+
+def benchmark_load():
+    '''Real servers in their own process, loaded by headless bots over TCP'''
+    for server_module in ("server", "async_server"):
+        port = _free_port()
+        process = subprocess.Popen([sys.executable, f"{server_module}.py", "--port", str(port)],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_server(port)
+            print(f"{server_module}.py, compact protocol, random mouse movement")
+            asyncio.run(bot.load_test(server.HOST, port, LOAD_BOT_COUNTS, LOAD_STAGE_SECONDS, seed=0))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def benchmark_udp():
+    '''TCP bots against UDP bots behind lossy relays, on the same server process'''
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, "server.py", "--port", str(port)],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_server(port)
+        print(f"transport  loss  latency ms p50/p99  update ms p50/p99  kB/s      ({UDP_BOT_COUNT} bots)")
+        for transport, loss in [("tcp", 0)] + [("udp", loss) for loss in UDP_LOSS_RATES]:
+            result = asyncio.run(bot.load_test(server.HOST, port, [UDP_BOT_COUNT], LOAD_STAGE_SECONDS, seed=0,
+                                               verbose=False, transport=transport, loss=loss))[0]
+            print(f"{transport:<10} {loss:<5} {result['latency_ms_p50']:>8.1f} / {result['latency_ms_p99']:<8.1f} "
+                  f"{result['tick_ms_p50']:>6.1f} / {result['tick_ms_p99']:<9.1f} {result['kbytes_per_second']:.1f}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _write_synthetic_recording(path, player_count, ticks, seed):
+    '''Players join on the first tick and move into the map, changing direction now and then'''
+    rng = random.Random(seed)
+    recorder = Recorder(path, "python", server.SHARDS, server.TICK_RATE, server.SNAPSHOT_RATE,
+                        server.CELL_COUNT, server.MAP_SIZE, seed)
+    directions = []
+    for client_id in range(1, player_count + 1):
+        recorder.join(0, client_id, f"bot-{client_id}", "compact", "sequenced")
+        directions.append(rng.uniform(0, math.pi / 2))
+
+    # players spawn in the map corner, these directions keep them inside the map
+    for tick in range(ticks):
+        for index in range(player_count):
+            if rng.random() < 0.05:
+                directions[index] = rng.uniform(0, math.pi / 2)
+            recorder.input(tick, index + 1, tick, 600 * math.cos(directions[index]), 600 * math.sin(directions[index]))
+    recorder.close()
+
+
+def _run_replay(path):
+    output = subprocess.run([sys.executable, "replay.py", path, "--json"], check=True, capture_output=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output)
+
+
+def benchmark_replay():
+    '''Synthetic recorded sessions replayed without sockets, twice to check the outcome is deterministic'''
+    print(f"players  ticks/s  move ms  collision ms  broadcast ms  encode ms  deterministic  ({REPLAY_TICKS} ticks)")
+    with tempfile.TemporaryDirectory() as directory:
+        for player_count in REPLAY_PLAYER_COUNTS:
+            path = os.path.join(directory, f"{player_count}.rec")
+            _write_synthetic_recording(path, player_count, REPLAY_TICKS, player_count)
+            first, second = _run_replay(path), _run_replay(path)
+
+            tick_ms = first["tick_ms"]
+            print(f"{player_count:<8} {first['ticks_per_second']:<8.0f} {tick_ms['move']:<8.3f} "
+                  f"{tick_ms['collision']:<13.3f} {tick_ms['broadcast']:<13.3f} {tick_ms['encode']:<10.3f} "
+                  f"{'yes' if first['digest'] == second['digest'] else 'NO'}")
+
+
+def _traced_bytes(function, *args):
+    '''Bytes still allocated after function returns, with its result alive'''
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = function(*args)
+    allocated = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del result
+    return allocated
+
+
+def _join_players(first_client_id, player_count):
+    players = []
+    for client_id in range(first_client_id, first_client_id + player_count):
+        conn = NullConnection()
+        player, _ = server.join_game(client_id, conn, f"bot-{client_id}", "compact", "sequenced")
+        send_queue = SendQueue(conn, "compact", server.MAP_SIZE, server.MAX_QUEUED_BYTES)
+        server.register_connection(player, send_queue)
+        players.append((player, send_queue))
+    return players
+
+
+def benchmark_memory():
+    '''Bytes per entity and memory allocated per tick of a world with MEMORY_CELL_COUNT cells'''
+    server.CELL_COUNT = MEMORY_CELL_COUNT
+    server.SEED = 0
+    server.init_game()
+
+    _join_players(1, MEMORY_PLAYER_COUNT)
+    tick_players = list(server.players.values())
+
+    # field values are shared with the world, so only the entity objects are counted
+    cells = list(server.cells.values())
+    cell_bytes = _traced_bytes(lambda: [server.CellData(cell.pos_x, cell.pos_y, cell.color) for cell in cells])
+    player_bytes = _traced_bytes(lambda: [
+        server.Player(player.client_id, player.pos_x, player.pos_y, player.color, player.username, None)
+        for player in tick_players])
+    print(f"bytes per cell: {cell_bytes / len(cells):.1f}, per player: {player_bytes / len(tick_players):.1f} "
+          f"(with its input limiter)")
+
+    rng = random.Random(0)
+    send_queues = list(server.connections.values())
+    for seq, player in enumerate(tick_players, 1):
+        angle = rng.uniform(0, math.pi / 2)
+        server.set_input(player, seq, 600 * math.cos(angle), 600 * math.sin(angle))
+
+    tracemalloc.start()
+    tick_seconds = 0
+    peak_bytes = 0
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    for _ in range(MEMORY_TICKS):
+        tracemalloc.reset_peak()
+        tick_start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        server.simulate_tick(1 / server.TICK_RATE)
+        for send_queue in send_queues:
+            send_queue.take()
+        tick_seconds += time.perf_counter() - start
+        peak_bytes += tracemalloc.get_traced_memory()[1] - tick_start_bytes
+    retained_bytes = tracemalloc.get_traced_memory()[0] - start_bytes
+    tracemalloc.stop()
+
+    churn_start = time.perf_counter()
+    for round in range(1, 11):
+        for player, send_queue in _join_players(round * MEMORY_PLAYER_COUNT + 1, MEMORY_PLAYER_COUNT):
+            server.remove_player(player)
+            server.retire_player(player)
+        server.simulate_tick(1 / server.TICK_RATE)
+    churn_ms = (time.perf_counter() - churn_start) / (10 * MEMORY_PLAYER_COUNT) * 1000
+
+    print("\nticks  players  ms/tick  peak KiB/tick  retained KiB  join+leave ms  (traced, snapshots encoded)")
+    print(f"{MEMORY_TICKS:<6} {MEMORY_PLAYER_COUNT:<8} {tick_seconds / MEMORY_TICKS * 1000:<8.2f} "
+          f"{peak_bytes / MEMORY_TICKS / 1024:<14.1f} {retained_bytes / 1024:<13.1f} {churn_ms:.3f}")
+
+
+class _CountingConnection(NullConnection):
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def sendall(self, data):
+        self.bytes_sent += len(data)
+
+
+def benchmark_world():
+    '''Bytes a client gets at join and over its first snapshots while moving, in worlds with more and more cells'''
+    print(f"cells     join KiB  max snapshot KiB  snapshots KiB  broadcast ms  "
+          f"({WORLD_PLAYER_COUNT} players, {WORLD_SNAPSHOTS} snapshots)")
+    for cell_count in WORLD_CELL_COUNTS:
+        server.cells.clear()
+        server.cells_grid.clear()
+        server.players.clear()
+        server.players_grid.clear()
+        server.connections.clear()
+        server.CELL_COUNT = cell_count
+        server.SEED = 0
+        server.init_game()
+
+        rng = random.Random(0)
+        join_bytes = []
+        send_queues = []
+        steps = {}  # player, (dx, dy)
+        for client_id in range(1, WORLD_PLAYER_COUNT + 1):
+            conn = _CountingConnection()
+            player, _ = server.join_game(client_id, conn, f"bot-{client_id}", "compact", "sequenced")
+            player.pos_x, player.pos_y = rng.uniform(0, server.MAP_SIZE), rng.uniform(0, server.MAP_SIZE)
+            server.players_grid.move(player, player.pos_x, player.pos_y)
+            server.send_initial_state(conn, player)
+            join_bytes.append(conn.bytes_sent)
+            send_queue = SendQueue(conn, "compact", server.MAP_SIZE, server.MAX_QUEUED_BYTES)
+            server.register_connection(player, send_queue)
+            send_queues.append(send_queue)
+            angle = rng.uniform(0, 2 * math.pi)
+            steps[player] = (WORLD_STEP * math.cos(angle), WORLD_STEP * math.sin(angle))
+
+        snapshot_bytes = []
+        broadcast_seconds = 0
+        for _ in range(WORLD_SNAPSHOTS):
+            for player, (step_x, step_y) in steps.items():
+                player.pos_x = min(max(player.pos_x + step_x, 0), server.MAP_SIZE)
+                player.pos_y = min(max(player.pos_y + step_y, 0), server.MAP_SIZE)
+                server.players_grid.move(player, player.pos_x, player.pos_y)
+            start = time.perf_counter()
+            server.broadcast_world_snapshot(list(server.players.values()))
+            broadcast_seconds += time.perf_counter() - start
+            snapshot_bytes.append(max(len(send_queue.take()) for send_queue in send_queues))
+
+        print(f"{cell_count:<9} {sum(join_bytes) / len(join_bytes) / 1024:<9.1f} {max(snapshot_bytes) / 1024:<17.1f} "
+              f"{sum(snapshot_bytes) / 1024:<14.1f} {broadcast_seconds / WORLD_SNAPSHOTS * 1000:.2f}")
+
+
+def _reset_world(cell_backend, cell_count, map_size):
+    server.cells.clear()
+    server.cells_grid.clear()
+    server.players.clear()
+    server.players_grid.clear()
+    server.connections.clear()
+    server.resumable_players.clear()
+    server.cell_store = None
+    server.CELL_BACKEND = cell_backend
+    server.CELL_COUNT = cell_count
+    server.MAP_SIZE = map_size
+    server.SEED = 0
+
+
+def _write_checkpoint(path):
+    '''Returns (capture ms in the game loop, write ms in the writer thread, checkpoint read back)'''
+    server.checkpoint_writer = CheckpointWriter(path)
+    capture_ms = _time_ms(server.take_checkpoint)
+    server.checkpoint_writer.close()
+    write_ms = server.checkpoint_writer.write_seconds * 1000
+    server.checkpoint_writer = None
+    return capture_ms, write_ms, read_checkpoint(path)
+
+
+def benchmark_restart():
+    '''Checkpoint cost while playing, and how long a cold restart and a standby take to get the world back'''
+    print(f"backend  cells      init ms  capture ms  write ms  file MiB  restore ms  refresh ms  changed  "
+          f"({RESTART_PLAYER_COUNT} players, {RESTART_TICKS} ticks between checkpoints)")
+    backends = ("python", "numpy") if np is not None else ("python",)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkpoint.bin")
+        for cell_backend in backends:
+            for cell_count, map_size in RESTART_WORLDS:
+                _reset_world(cell_backend, cell_count, map_size)
+                init_ms = _time_ms(server.init_game)
+                rng = random.Random(0)
+                for seq, (player, _) in enumerate(_join_players(1, RESTART_PLAYER_COUNT), 1):
+                    player.session_token = seq
+                    player.pos_x, player.pos_y = rng.uniform(0, map_size), rng.uniform(0, map_size)
+                    server.players_grid.move(player, player.pos_x, player.pos_y)
+                    angle = rng.uniform(0, 2 * math.pi)
+                    server.set_input(player, seq, 600 * math.cos(angle), 600 * math.sin(angle))
+
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                capture_ms, write_ms, first = _write_checkpoint(path)
+                for _ in range(RESTART_TICKS):
+                    server.simulate_tick(1 / server.TICK_RATE)
+                _write_checkpoint(path)
+                file_mib = os.path.getsize(path) / 1024 / 1024
+
+                _reset_world(cell_backend, cell_count, map_size)
+                restore_ms = _time_ms(server.restore_game, path)
+
+                _reset_world(cell_backend, cell_count, map_size)
+                server.init_game(first)
+                start = time.perf_counter()
+                changed = server.refresh_game(read_checkpoint(path, first))
+                refresh_ms = (time.perf_counter() - start) * 1000
+
+                print(f"{cell_backend:<8} {cell_count:<10} {init_ms:<8.0f} {capture_ms:<11.1f} {write_ms:<9.1f} "
+                      f"{file_mib:<9.1f} {restore_ms:<11.0f} {refresh_ms:<11.1f} {changed}")
+
+
+BENCHMARKS = {
+    "collisions": benchmark_collisions,
+    "cells": benchmark_cell_backends,
+    "packing": benchmark_packing,
+    "decoding": benchmark_decoding,
+    "load": benchmark_load,
+    "udp": benchmark_udp,
+    "replay": benchmark_replay,
+    "memory": benchmark_memory,
+    "world": benchmark_world,
+    "restart": benchmark_restart,
+}
+
+
+if __name__ == "__main__":
+    # python benchmark.py [name ...], runs all benchmarks without names
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,465 @@
+import argparse
+import asyncio
+import math
+import random
+import struct
+import time
+from enums import Events
+from newtork_utils import unpack_player, unpack_world_snapshot, unpack_compact_snapshot
+from datagrams import pack_hello, pack_input_datagram, unpack_state_datagram
+
+
+HOST = "127.0.0.1"
+PORT = 9999
+MAP_SIZE = 8000
+
+PATTERNS = ("random", "circle", "line", "still")
+PROTOCOLS = ("standard", "compact")
+TRANSPORTS = ("tcp", "udp")  # udp bots send sequenced inputs and get positions over a datagram channel
+MOUSE_DISTANCE = 300  # length of the mouse vector, same as pointing 300 px away from window center
+EDGE_MARGIN = 200  # bots closer to the map edge turn towards the center instead of pushing against it
+SEND_RATE = 60  # mouse vectors per second, same as client.py
+
+# latency probe: bot stands still, then measures how long its next move takes to come back in a snapshot
+PROBE_INTERVAL = 2
+PROBE_PAUSE = 0.5
+
+WARMUP = 1  # seconds after new bots joined before a stage is measured
+RECONNECT_DELAY = 0.5
+RESUME_DELAY = 0.05  # seconds between reconnects of a bot with a session, the sooner it is back the better
+
+EVENTS = {event.code: event for event in Events}
+
+
+class Stats():
+    '''Counters shared by all bots of a load test, reset at the start of every stage'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.events = 0
+        self.bytes = 0
+        self.latencies = []  # seconds from move input to own position update
+        self.update_intervals = []  # seconds between own position updates while moving
+        self.deaths = 0
+        self.errors = 0
+        self.datagrams_dropped = 0  # by lossy relays
+        self.resumed = 0
+        self.downtimes = []  # seconds from losing the connection to the first snapshot after resuming
+
+    def summary(self, player_count):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "players": player_count,
+            "events_per_second": self.events / elapsed,
+            "kbytes_per_second": self.bytes / elapsed / 1024,
+            "tick_ms_p50": percentile(self.update_intervals, 0.5) * 1000,
+            "tick_ms_p99": percentile(self.update_intervals, 0.99) * 1000,
+            "latency_ms_p50": percentile(self.latencies, 0.5) * 1000,
+            "latency_ms_p99": percentile(self.latencies, 0.99) * 1000,
+            "deaths": self.deaths,
+            "errors": self.errors,
+            "datagrams_dropped": self.datagrams_dropped,
+            "resumed": self.resumed,
+            "downtime_ms_max": max(self.downtimes, default=0) * 1000,
+        }
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def read_message(reader):
+    length = struct.unpack('I', await reader.readexactly(4))[0]
+    return (await reader.readexactly(length)).decode('ascii')
+
+
+class DatagramReceiver(asyncio.DatagramProtocol):
+    '''Calls on_datagram(data, address) for every datagram of an endpoint'''
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, address):
+        self.on_datagram(data, address)
+
+
+class LossyRelay():
+    '''Forwards the datagrams of one bot to the server and back, dropping loss of them both ways
+
+    Stands in for a lossy network path, the server sees the relay address as the bot's UDP address.
+    '''
+
+    def __init__(self, server_address, loss, stats, rng):
+        self.server_address = server_address
+        self.loss = loss
+        self.stats = stats
+        self.rng = rng
+        self.bot_address = None
+        self.downstream = None
+        self.upstream = None
+
+    async def start(self):
+        '''Returns the address bots send to'''
+        loop = asyncio.get_running_loop()
+        self.downstream, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramReceiver(self.from_bot), local_addr=("127.0.0.1", 0))
+        self.upstream, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramReceiver(self.from_server), remote_addr=self.server_address)
+        return self.downstream.get_extra_info("sockname")
+
+    def lost(self):
+        if self.rng.random() < self.loss:
+            self.stats.datagrams_dropped += 1
+            return True
+        return False
+
+    def from_bot(self, data, address):
+        self.bot_address = address
+        if not self.lost():
+            self.upstream.sendto(data)
+
+    def from_server(self, data, address):
+        if self.bot_address is not None and not self.lost():
+            self.downstream.sendto(data, self.bot_address)
+
+    def close(self):
+        for transport in (self.downstream, self.upstream):
+            if transport is not None:
+                transport.close()
+
+
+class Bot():
+    '''Headless player, streams mouse vectors in a pattern and consumes every event'''
+
+    def __init__(self, name, pattern, protocol, stats, rng, transport="tcp", loss=0, session=None):
+        self.name = name
+        self.pattern = pattern
+        self.protocol = protocol
+        self.stats = stats
+        self.rng = rng
+        self.transport = transport
+        self.loss = loss
+        self.session = session  # (token, username) to resume, or True to ask for a session when joining
+        self.disconnected = None  # time the previous connection of a resuming bot was lost
+
+        self.seq = 0  # of the latest input, inputs are sequenced on the UDP transport
+        self.datagram_channel = None  # (UDP port, token) offered by the server
+        self.datagrams = None  # DatagramTransport connected to the server or a lossy relay
+        self.relay = None
+        self.bound = False  # server answered HELLO
+        self.latest_datagram_seq = 0
+
+        self.map_size = MAP_SIZE  # from the `/world` answer of the server
+        self.direction = rng.uniform(0, 2 * math.pi)
+        self.client_id = None
+        self.position = None
+        self.compact_baselines = {}
+
+        self.moving = False
+        self.probe_sent = None  # time of first move after a probe pause
+        self.probe_position = None
+        self.last_update = None
+
+    async def run(self, host, port):
+        '''Plays until the bot is eaten or disconnected'''
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await self.join(reader, writer)
+            if self.datagram_channel is not None:
+                await self.open_datagrams(host)
+            sender = asyncio.create_task(self.send_inputs(writer))
+            try:
+                await self.receive_events(reader)
+            finally:
+                sender.cancel()
+        finally:
+            writer.close()
+            if self.datagrams is not None:
+                self.datagrams.close()
+            if self.relay is not None:
+                self.relay.close()
+
+    async def join(self, reader, writer):
+        request = await read_message(reader)
+        if request == "GET username":
+            writer.write(b"/world")
+            response = await read_message(reader)
+            if response.startswith("INFO World: "):
+                settings = dict(setting.split("=") for setting in response.removeprefix("INFO World: ").split())
+                self.map_size = int(settings["map_size"])
+            request = await read_message(reader)
+        if request == "GET username" and self.protocol != "standard":
+            writer.write(f"/protocol {self.protocol}".encode("ascii"))
+            if not (await read_message(reader)).startswith(f"INFO Protocol: {self.protocol}"):
+                self.protocol = "standard"
+            request = await read_message(reader)
+        if request == "GET username" and self.transport == "udp":
+            writer.write(b"/input sequenced")
+            response = await read_message(reader)
+            if not response.startswith("INFO Input: sequenced"):
+                raise ConnectionError(f"No sequenced input: {response}")
+            await read_message(reader)
+            writer.write(b"/transport udp")
+            response = await read_message(reader)
+            if not response.startswith("INFO Transport: udp "):
+                raise ConnectionError(f"No UDP channel: {response}")
+            udp_port, token = map(int, response.split()[3:5])
+            self.datagram_channel = (udp_port, token)
+            request = await read_message(reader)
+
+        username = None
+        if request == "GET username" and isinstance(self.session, tuple):
+            token, name = self.session
+            writer.write(f"/resume {token}".encode("ascii"))
+            if (await read_message(reader)).startswith("ERROR"):
+                self.session = True
+                request = await read_message(reader)
+            else:
+                username = name
+                self.stats.resumed += 1
+        if request == "GET username" and self.session is True:
+            writer.write(b"/session")
+            token = int((await read_message(reader)).split()[2])
+            request = await read_message(reader)
+
+        attempt = 0
+        while username is None:
+            if request != "GET username":
+                raise ConnectionError(f"Unexpected request: {request}")
+            candidate = self.name if attempt == 0 else f"{self.name}-{attempt}"
+            writer.write(candidate.encode("ascii"))
+            response = await read_message(reader)
+            if not response.startswith("ERROR"):
+                username = candidate
+                if self.session is True:
+                    self.session = (token, username)
+                break
+            attempt += 1
+            request = await read_message(reader)
+
+        for _ in range(2):
+            request = await read_message(reader)
+            packed_data = await reader.readexactly(struct.unpack('I', await reader.readexactly(4))[0])
+            self.stats.bytes += 4 + len(packed_data)
+            if request == "POST players":
+                offset = 4
+                for _ in range(struct.unpack('I', packed_data[:4])[0]):
+                    (client_id, name, pos_x, pos_y, _, _), offset = unpack_player(packed_data, offset)
+                    if name == username:
+                        self.client_id = client_id
+                        self.position = (pos_x, pos_y)
+
+    async def open_datagrams(self, host):
+        server_address = (host, self.datagram_channel[0])
+        if self.loss:
+            self.relay = LossyRelay(server_address, self.loss, self.stats, random.Random(self.rng.getrandbits(32)))
+            server_address = await self.relay.start()
+        self.datagrams, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: DatagramReceiver(self.on_datagram), remote_addr=server_address)
+
+    def send_input(self, writer, mouse_x, mouse_y):
+        if self.transport == "tcp":
+            writer.write(struct.pack('ff', mouse_x, mouse_y))
+            return
+
+        self.seq += 1
+        if self.bound:
+            self.datagrams.sendto(pack_input_datagram(self.seq, mouse_x, mouse_y))
+            return
+        # HELLO goes with every input until the server answers, inputs use TCP until then
+        self.datagrams.sendto(pack_hello(self.datagram_channel[1]))
+        writer.write(struct.pack('Iff', self.seq, mouse_x, mouse_y))
+
+    def on_datagram(self, data, address):
+        self.bound = True
+        seq, _, snapshot_players = unpack_state_datagram(data)
+        self.stats.bytes += len(data)
+        self.stats.events += 1
+        # late datagrams of an older snapshot would move the bot back
+        if seq < self.latest_datagram_seq:
+            return
+        self.latest_datagram_seq = seq
+        self.on_snapshot(snapshot_players)
+
+    def mouse_vector(self):
+        match self.pattern:
+            case "still":
+                return 0, 0
+            case "random":
+                if self.rng.random() < 0.01:
+                    self.direction = self.rng.uniform(0, 2 * math.pi)
+            case "circle":
+                self.direction += 2 * math.pi / SEND_RATE / 4  # one circle in 4 seconds
+            case "line":
+                if self.rng.random() < 0.002:
+                    self.direction += math.pi
+
+        if self.pattern != "circle":
+            self.turn_from_edge()
+        return MOUSE_DISTANCE * math.cos(self.direction), MOUSE_DISTANCE * math.sin(self.direction)
+
+    def turn_from_edge(self):
+        if self.position is None:
+            return
+        pos_x, pos_y = self.position
+        if min(pos_x, pos_y) < EDGE_MARGIN or max(pos_x, pos_y) > self.map_size - EDGE_MARGIN:
+            self.direction = math.atan2(self.map_size / 2 - pos_y, self.map_size / 2 - pos_x)
+
+    async def send_inputs(self, writer):
+        send_interval = 1 / SEND_RATE
+        next_probe = time.perf_counter() + self.rng.uniform(0, PROBE_INTERVAL)
+
+        while True:
+            now = time.perf_counter()
+            if now >= next_probe and self.pattern != "still":
+                self.moving = False
+                self.probe_sent = None  # a move that never showed up (bot at the map edge) is not measured
+                self.send_input(writer, 0, 0)
+                await asyncio.sleep(PROBE_PAUSE)
+
+                now = time.perf_counter()
+                self.turn_from_edge()  # probe move must not be blocked by the edge
+                self.probe_position = self.position
+                self.probe_sent = now
+                self.last_update = None
+                next_probe = now + PROBE_INTERVAL
+
+            self.send_input(writer, *self.mouse_vector())
+            self.moving = self.pattern != "still"
+            await writer.drain()
+            await asyncio.sleep(send_interval)
+
+    async def receive_events(self, reader):
+        while True:
+            event = EVENTS[struct.unpack('I', await reader.readexactly(4))[0]]
+            if event.format is None:
+                packed_data = await reader.readexactly(struct.unpack('I', await reader.readexactly(4))[0])
+                self.stats.bytes += 8 + len(packed_data)
+            else:
+                packed_data = await reader.readexactly(struct.calcsize(event.format))
+                self.stats.bytes += 4 + len(packed_data)
+            self.stats.events += 1
+
+            match event:
+                case Events.WORLD_SNAPSHOT:
+                    self.on_snapshot(unpack_world_snapshot(packed_data)[0])
+                case Events.COMPACT_SNAPSHOT:
+                    self.on_snapshot(unpack_compact_snapshot(packed_data, self.compact_baselines, self.map_size)[0])
+                case Events.PLAYER_LEFT_VIEW:
+                    self.compact_baselines.pop(struct.unpack(event.format, packed_data)[0], None)
+                case Events.GAME_OVER:
+                    self.stats.deaths += 1
+                    if self.session is not None:
+                        self.session = True  # eaten players can't be resumed
+                    return
+
+    def on_snapshot(self, snapshot_players):
+        now = time.perf_counter()
+        if self.disconnected is not None:
+            self.stats.downtimes.append(now - self.disconnected)
+            self.disconnected = None
+        for client_id, pos_x, pos_y, _ in snapshot_players:
+            if client_id != self.client_id or (pos_x, pos_y) == self.position:
+                continue
+
+            self.position = (pos_x, pos_y)
+            if self.probe_sent is not None and self.position != self.probe_position:
+                self.stats.latencies.append(now - self.probe_sent)
+                self.probe_sent = None
+
+            if self.moving and self.last_update is not None:
+                self.stats.update_intervals.append(now - self.last_update)
+            self.last_update = now
+
+
+async def run_bot(name, pattern, protocol, stats, rng, host, port, transport="tcp", loss=0, sessions=False):
+    '''Keeps one bot in the game, it joins again after it is eaten or disconnected
+
+    With sessions, a bot that lost its connection resumes its player, from the restarted server or its standby.
+    '''
+    session = True if sessions else None
+    disconnected = None
+    while True:
+        bot = Bot(name, pattern, protocol, stats, rng, transport, loss, session)
+        bot.disconnected = disconnected
+        try:
+            await bot.run(host, port)
+            disconnected = None
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            stats.errors += 1
+            if isinstance(bot.session, tuple):
+                disconnected = bot.disconnected or time.perf_counter()
+                await asyncio.sleep(RESUME_DELAY)
+            else:
+                await asyncio.sleep(RECONNECT_DELAY)
+        session = bot.session
+
+
+async def load_test(host, port, counts, duration, pattern="random", protocol="compact", seed=None, verbose=True,
+                    transport="tcp", loss=0, sessions=False):
+    '''Adds bots up to every count in counts and measures each stage for duration seconds
+
+    With loss, every UDP bot talks to the server through a LossyRelay dropping that fraction of datagrams.
+    '''
+    rng = random.Random(seed)
+    stats = Stats()
+    bots = []
+    results = []
+
+    if verbose:
+        print("players  events/s  kB/s      tick ms p50/p99  latency ms p50/p99  deaths  errors")
+    try:
+        for count in counts:
+            while len(bots) < count:
+                name = f"bot-{len(bots)}"
+                bots.append(asyncio.create_task(
+                    run_bot(name, pattern, protocol, stats, random.Random(rng.getrandbits(32)), host, port,
+                            transport, loss, sessions)))
+                await asyncio.sleep(0)
+
+            await asyncio.sleep(WARMUP)
+            stats.reset()
+            await asyncio.sleep(duration)
+
+            result = stats.summary(count)
+            results.append(result)
+            if verbose:
+                print(f"{count:<8} {result['events_per_second']:<9.0f} {result['kbytes_per_second']:<9.1f} "
+                      f"{result['tick_ms_p50']:>6.1f} / {result['tick_ms_p99']:<7.1f} "
+                      f"{result['latency_ms_p50']:>8.1f} / {result['latency_ms_p99']:<8.1f} "
+                      f"{result['deaths']:<7} {result['errors']}")
+                if sessions:
+                    print(f"         resumed {result['resumed']}, longest downtime {result['downtime_ms_max']:.0f} ms")
+    finally:
+        for bot in bots:
+            bot.cancel()
+        await asyncio.gather(*bots, return_exceptions=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless bots for load testing the Agar.io server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--bots", type=int, nargs="+", default=[10, 50, 100, 200],
+                        help="bot counts, one measured stage per count")
+    parser.add_argument("--duration", type=float, default=5, help="seconds measured per stage")
+    parser.add_argument("--pattern", choices=PATTERNS, default="random", help="how bots move the mouse")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default="compact")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp")
+    parser.add_argument("--loss", type=float, default=0,
+                        help="fraction of UDP datagrams a local relay drops in each direction")
+    parser.add_argument("--sessions", action="store_true",
+                        help="ask for sessions and resume players after losing the connection, measures the downtime")
+    args = parser.parse_args()
+
+    asyncio.run(load_test(args.host, args.port, args.bots, args.duration, args.pattern, args.protocol, args.seed,
+                          transport=args.transport, loss=args.loss, sessions=args.sessions))
@@ -0,0 +1,205 @@
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import namedtuple
+from threading import Thread, Condition
+from newtork_utils import CELL_RECORD
+
+
+# CHECKPOINT FILE
+# header, then two slots of the same size. A checkpoint is written to the slot that doesn't hold
+# the latest one and the header is switched to it afterwards, so a server killed while writing
+# leaves the previous checkpoint readable. Slots are checked with a CRC when they are loaded.
+# Every writer stamps its slots with a generation, the time it started, so the checkpoints of a server
+# started again over the same file are newer than those of the previous one even though its ticks start over.
+MAGIC = b"AGC2"
+FILE_HEADER = struct.Struct('=4sBQ')  # magic, slot of the latest checkpoint, slot size
+# crc32 of the rest of the slot, generation, tick, map size, chunk size, cells, players
+SLOT_HEADER = struct.Struct('=IQQIIII')
+PLAYER_RECORD = struct.Struct('=IdddIQ51p')  # client_id, pos_x, pos_y, radius, color, session token, username
+CELL_CHUNK_SIZE = 4  # cell_chunks item, array('I')
+NO_SLOT = 255
+SPARE_PLAYER_RECORDS = 256  # room left in a new slot for players joining later
+
+log = logging.getLogger("checkpoint")
+
+# cells: POST cells records of all cells (CellImage buffer), cell_chunks: chunk of every cell as array('I') bytes,
+# players: (client_id, pos_x, pos_y, radius, color, session token, username), generation: set by the writer
+Checkpoint = namedtuple("Checkpoint",
+                        ("tick", "map_size", "chunk_size", "cells", "cell_chunks", "players", "generation"),
+                        defaults=(0,))
+
+
+def pack_slot(checkpoint):
+    '''Returns the slot header and the parts after it, the CRC covers everything after its own field'''
+    packed_players = bytearray(PLAYER_RECORD.size * len(checkpoint.players))
+    for index, (client_id, pos_x, pos_y, radius, color, token, username) in enumerate(checkpoint.players):
+        PLAYER_RECORD.pack_into(packed_players, index * PLAYER_RECORD.size,
+                                client_id, pos_x, pos_y, radius, color, token, username.encode("ascii"))
+
+    parts = (checkpoint.cells, checkpoint.cell_chunks, packed_players)
+    header_rest = SLOT_HEADER.pack(0, checkpoint.generation, checkpoint.tick, checkpoint.map_size,
+                                   checkpoint.chunk_size, len(checkpoint.cells) // CELL_RECORD.size,
+                                   len(checkpoint.players))[4:]
+    crc = zlib.crc32(header_rest)
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+    return struct.pack('=I', crc) + header_rest, parts
+
+
+def read_slot(data, offset, after=None):
+    '''Returns the Checkpoint in the slot at offset, None if it is incomplete, damaged or not newer than after'''
+    if offset + SLOT_HEADER.size > len(data):
+        return None
+    crc, generation, tick, map_size, chunk_size, cell_count, player_count = SLOT_HEADER.unpack_from(data, offset)
+    if after is not None and (generation, tick) <= (after.generation, after.tick):
+        return None
+    start = offset + SLOT_HEADER.size
+    cells_end = start + cell_count * CELL_RECORD.size
+    chunks_end = cells_end + cell_count * CELL_CHUNK_SIZE
+    end = chunks_end + player_count * PLAYER_RECORD.size
+    if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+        return None
+
+    players = [(client_id, pos_x, pos_y, radius, color, token, username.decode("ascii"))
+               for client_id, pos_x, pos_y, radius, color, token, username
+               in PLAYER_RECORD.iter_unpack(data[chunks_end:end])]
+    return Checkpoint(tick, map_size, chunk_size, data[start:cells_end], data[cells_end:chunks_end], players,
+                      generation)
+
+
+def read_checkpoint(path, after=None):
+    '''Returns the latest complete Checkpoint in the file, None if there is none or it is not newer than after'''
+    try:
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < FILE_HEADER.size:
+                return None
+            magic, slot, slot_size = FILE_HEADER.unpack_from(data)
+            if magic != MAGIC or slot == NO_SLOT:
+                return None
+            # the other slot is older, but complete if the server died while switching the header
+            for index in (slot, 1 - slot):
+                checkpoint = read_slot(data, FILE_HEADER.size + index * slot_size, after)
+                if checkpoint is not None:
+                    return checkpoint
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log.warning("Can't read checkpoint %s: %s", path, e)
+    return None
+
+
+class CheckpointWriter():
+    '''Writes checkpoints to a memory-mapped file from a thread of its own
+
+    The game loop only copies the world and submits it, packing and writing happen here.
+    Checkpoints submitted while one is written replace each other, only the latest is written.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = time.time_ns()
+        self.condition = Condition()
+        self.pending = None
+        self.closed = False
+        self.file = None
+        self.map = None
+        self.slot_size = 0
+        self.slot = NO_SLOT
+        self._open()
+
+        self.written = 0
+        self.write_seconds = 0  # of the latest write
+        self.thread = Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, checkpoint):
+        with self.condition:
+            self.pending = checkpoint
+            self.condition.notify()
+
+    def close(self):
+        '''Writes the pending checkpoint and stops'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                checkpoint, self.pending = self.pending, None
+            if checkpoint is None:
+                return
+
+            try:
+                self.write(checkpoint)
+            except OSError as e:
+                log.error("Can't write checkpoint %s: %s", self.path, e)
+
+    def write(self, checkpoint):
+        start = time.perf_counter()
+        header, parts = pack_slot(checkpoint._replace(generation=self.generation))
+        size = len(header) + sum(len(part) for part in parts)
+        if size > self.slot_size:
+            self._create(size + PLAYER_RECORD.size * SPARE_PLAYER_RECORDS, header, parts)
+        else:
+            slot = 0 if self.slot == 1 else 1
+            offset = FILE_HEADER.size + slot * self.slot_size
+            for part in (header, *parts):
+                self.map[offset:offset + len(part)] = part
+                offset += len(part)
+            self.map.flush()
+            FILE_HEADER.pack_into(self.map, 0, MAGIC, slot, self.slot_size)
+            self.map.flush(0, mmap.PAGESIZE)
+            self.slot = slot
+
+        self.written += 1
+        self.write_seconds = time.perf_counter() - start
+
+    def _open(self):
+        '''Maps the existing file, its latest checkpoint is kept until the next one is written'''
+        try:
+            self.file = open(self.path, "r+b")
+        except FileNotFoundError:
+            return
+        if os.fstat(self.file.fileno()).st_size < FILE_HEADER.size:
+            self.file.close()
+            self.file = None
+            return
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, slot, slot_size = FILE_HEADER.unpack_from(self.map)
+        if magic != MAGIC or len(self.map) != FILE_HEADER.size + 2 * slot_size:
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+            return
+        self.slot, self.slot_size = slot, slot_size
+
+    def _create(self, slot_size, header, parts):
+        '''Replaces the file with one of bigger slots, written next to it so the old one stays until it is complete'''
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(FILE_HEADER.pack(MAGIC, 0, slot_size))
+            file.write(header)
+            for part in parts:
+                file.write(part)
+            file.truncate(FILE_HEADER.size + 2 * slot_size)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.slot, self.slot_size = 0, slot_size
@@ -0,0 +1,47 @@
+import math
+
+
+class ChunkMap():
+    '''Square chunks of the map, clients get the cells of a chunk at once and drop them at once
+
+    Cell positions are integers, so the server and clients put a cell in the same chunk as long
+    as clients round the positions they receive (compact snapshots are off by less than 0.5,
+    the server refuses them for maps bigger than MAX_COMPACT_MAP_SIZE).
+    '''
+
+    def __init__(self, map_size, chunk_size):
+        self.map_size = map_size
+        self.chunk_size = chunk_size
+        self.columns = max(1, math.ceil(map_size / chunk_size))
+
+    def __len__(self):
+        return self.columns * self.columns
+
+    def _column(self, value):
+        column = int(value + 0.5) // self.chunk_size
+        if column < 0:
+            return 0
+        return column if column < self.columns else self.columns - 1
+
+    def index(self, x, y):
+        return self._column(y) * self.columns + self._column(x)
+
+    def rect(self, chunk):
+        '''(left, top, right, bottom), the last row and column reach up to the map edge'''
+        row, column = divmod(chunk, self.columns)
+        return self._edge(column), self._edge(row), self._edge(column + 1), self._edge(row + 1)
+
+    def _edge(self, column):
+        if column == self.columns:
+            return self.map_size
+        return column * self.chunk_size
+
+    def indexes_in_rect(self, left, top, right, bottom):
+        columns = range(self._column(left), self._column(right) + 1)
+        return [row * self.columns + column for row in range(self._column(top), self._column(bottom) + 1)
+                for column in columns]
+
+    def distance(self, chunk, x, y):
+        '''Squared distance from (x, y) to the chunk center'''
+        row, column = divmod(chunk, self.columns)
+        return ((column + 0.5) * self.chunk_size - x) ** 2 + ((row + 0.5) * self.chunk_size - y) ** 2
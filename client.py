@@ -1,11 +1,16 @@
+import os
 import socket
 import struct
 import pygame
 import time
+from collections import OrderedDict, deque
 from threading import Thread, Lock
 from pygame.locals import QUIT, MOUSEMOTION
-from newtork_utils import decode_color, receive_message, unpack_cells, receive_exact, unpack_players, unpack_player
+from newtork_utils import decode_color, receive_message, unpack_cells, receive_into, receive_sized, unpack_players, unpack_player, unpack_world_snapshot, unpack_compact_snapshot, clamp_mouse_vector, clamp_position
 from enums import Events
+from spatial_grid import SpatialGrid
+from chunks import ChunkMap
+from datagrams import MAX_DATAGRAM_SIZE, pack_hello, pack_input_datagram, unpack_state_datagram
 
 pygame.init()
 
@@ -20,18 +25,81 @@ BIGFONT = pygame.font.Font("freesansbold.ttf", 72)
 
 BACKGROUND_COLOR = (15, 15, 15)
 TEXT_COLOR = (255, 255, 255)
+# world settings, replaced by the `/world` answer of the server
 SPAWN_SIZE = 35
 CELL_RADIUS = 10
+MAP_SIZE = 8000
+CHUNK_SIZE = 250
+PROTOCOL = "compact"  # "standard" or "compact" position updates
+INPUT_MODE = "sequenced"  # "plain" or "sequenced" mouse vectors, server acknowledges sequenced ones
+SEND_RATE = 60  # mouse vectors per second, sent by the input sender thread
+MAX_UNACKED_INPUTS = 2 * SEND_RATE  # send times kept for the RTT, older ones are forgotten if no INPUT_ACK comes
+TRANSPORT = "udp"  # "tcp" or "udp", udp sends inputs and receives positions over a datagram channel
+HELLO_INTERVAL = 0.2  # seconds between HELLO datagrams until the server answers
+HELLO_ATTEMPTS = 10  # unanswered HELLOs before staying on TCP
+SESSION_FILE = ".agario_session"  # token and username of the latest player, resumed after the server restarts
+INTERPOLATION_DELAY = 0.1  # other players are drawn this many seconds in the past, between two snapshots
+INTERPOLATION_SAMPLES = 16
+RECONCILE_RATE = 0.2  # part of the prediction error corrected per acknowledgement
+RECONCILE_SNAP_DISTANCE = 100  # bigger errors are corrected at once
+PLAYER_POOL_SIZE = 256
+TEXT_CACHE_SIZE = 256  # rendered text surfaces kept, least recently drawn ones are dropped first
+FRAME_TIME_REPORT_INTERVAL = 5  # seconds between frame time prints, 0 turns them off
+GRID_BUCKET_SIZE = 200
 
 cells = {}
+cells_grid = SpatialGrid(GRID_BUCKET_SIZE)  # cell keys, guarded by cells_lock, each frame draws only what is in the window
 cells_lock = Lock()  
+chunk_map = ChunkMap(MAP_SIZE, CHUNK_SIZE)
+chunk_cells = {}  # chunk, keys of the cells in it, guarded by cells_lock, CHUNK_LEFT_VIEW drops them all
 players = {}
+players_grid = SpatialGrid(GRID_BUCKET_SIZE)  # client ids of other players, guarded by players_lock
 players_lock = Lock()  
+player_pool = []  # Player objects of players that left the view, reused for players entering it, guarded by players_lock
+max_player_radius = SPAWN_SIZE  # players this far outside the window can still be partly visible
+text_cache = OrderedDict()  # (font, text), rendered surface, least recently used first
+text_cache_lock = Lock()
 current_player = None
 current_client_id = -1
+compact_baselines = {}  # client_id, last quantized state from COMPACT_SNAPSHOT
+
+# client side prediction: own movement is applied locally and corrected with INPUT_ACK
+input_sender = None  # InputSender of the connection
+predicted_moves = deque()  # (input seq, dx, dy) applied locally, not acknowledged yet, used by the render thread
+server_ack = None  # latest (input seq, pos_x, pos_y) from the server, guarded by players_lock
+
+# fixed size events are received into one preallocated buffer per event, used by the network thread only
+EVENT_STRUCTS = {event.code: struct.Struct(event.format) for event in Events if event.format}
+event_buffers = {code: bytearray(event_struct.size) for code, event_struct in EVENT_STRUCTS.items()}
+event_code_buffer = bytearray(4)
+
+
+def render_text(font, text):
+    '''Rendered text surface, fonts are rasterized once per text instead of every frame'''
+    key = (font, text)
+    with text_cache_lock:
+        surface = text_cache.get(key)
+        if surface is not None:
+            text_cache.move_to_end(key)
+            return surface
+
+        surface = font.render(text, True, TEXT_COLOR)
+        text_cache[key] = surface
+        if len(text_cache) > TEXT_CACHE_SIZE:
+            text_cache.popitem(last=False)
+        return surface
+
+
+def forget_text(text):
+    '''Drops surfaces of a text in every font, e.g. name of a player that left'''
+    with text_cache_lock:
+        for key in [key for key in text_cache if key[1] == text]:
+            del text_cache[key]
 
 
 class Cell():
+    __slots__ = ("radius", "color", "pos_x", "pos_y")
+
     def __init__(self, x, y, color, radius):
         self.radius = radius
         self.color = color
@@ -43,30 +111,132 @@ class Cell():
 
 
 class Player(Cell):
+    __slots__ = ("username", "is_alive", "samples")
+
     def __init__(self, username, x, y, color, radius):
+        self.samples = deque(maxlen=INTERPOLATION_SAMPLES)  # (received, pos_x, pos_y)
+        self.reset(username, x, y, color, radius)
+
+    def reset(self, username, x, y, color, radius):
+        '''Sets every field for another player, objects of players that left the view are reused this way'''
         super().__init__(x, y, color, radius)
         self.username = username
         self.is_alive = True
+        self.samples.clear()
+        self.samples.append((time.perf_counter(), x, y))
+
+    def add_sample(self, pos_x, pos_y):
+        self.samples.append((time.perf_counter(), pos_x, pos_y))
+
+    def interpolated_position(self, render_time):
+        '''Position at render_time, between the two samples around it (latest one if there is no newer sample)'''
+        newer = self.samples[-1]
+        if render_time >= newer[0]:
+            return newer[1], newer[2]
+
+        for older in reversed(self.samples):
+            if older[0] <= render_time:
+                fraction = (render_time - older[0]) / (newer[0] - older[0])
+                return older[1] + (newer[1] - older[1]) * fraction, older[2] + (newer[2] - older[2]) * fraction
+            newer = older
+
+        return newer[1], newer[2]
 
     def draw(self, surface, x, y):
         super().draw(surface, x, y)
-        display_text = self.username
         
-        # Render and draw text
-        text_surface = SMALLFONT.render(display_text, True, TEXT_COLOR)
+        # Draw cached name label
+        text_surface = render_text(SMALLFONT, self.username)
         text_rect = text_surface.get_rect(center=(x, y))
         surface.blit(text_surface, text_rect)
 
 
+def update_cell(key, pos_x, pos_y, color):
+    '''Adds or moves a cell, caller holds cells_lock'''
+    chunk = chunk_map.index(pos_x, pos_y)
+    cell = cells.get(key)
+    if cell is None:
+        cells[key] = Cell(pos_x, pos_y, decode_color(color), CELL_RADIUS)
+        cells_grid.insert(key, pos_x, pos_y)
+        chunk_cells.setdefault(chunk, set()).add(key)
+        return
+    old_chunk = chunk_map.index(cell.pos_x, cell.pos_y)
+    if old_chunk != chunk:
+        chunk_cells[old_chunk].discard(key)
+        chunk_cells.setdefault(chunk, set()).add(key)
+    cell.pos_x = pos_x
+    cell.pos_y = pos_y
+    cell.color = decode_color(color)
+    cells_grid.move(key, pos_x, pos_y)
+
+
+def remove_cell(key):
+    cell = cells.pop(key, None)
+    cells_grid.remove(key)
+    if cell is not None:
+        chunk_cells[chunk_map.index(cell.pos_x, cell.pos_y)].discard(key)
+
+
+def remove_chunk(chunk):
+    '''Caller holds cells_lock'''
+    for key in chunk_cells.pop(chunk, ()):
+        cells.pop(key)
+        cells_grid.remove(key)
+
+
+def apply_world_info(response):
+    '''Sets the world settings from `INFO World: map_size=.. cell_radius=.. ...`'''
+    global MAP_SIZE, CELL_RADIUS, SPAWN_SIZE, CHUNK_SIZE, chunk_map, max_player_radius
+    settings = dict(setting.split("=") for setting in response.removeprefix("INFO World: ").split())
+    MAP_SIZE = int(settings["map_size"])
+    CELL_RADIUS = int(settings["cell_radius"])
+    SPAWN_SIZE = max_player_radius = int(settings["player_spawn_radius"])
+    CHUNK_SIZE = int(settings["chunk_size"])
+    chunk_map = ChunkMap(MAP_SIZE, CHUNK_SIZE)
+
+
+def add_player(client_id, player):
+    '''Caller holds players_lock'''
+    global max_player_radius
+    players[client_id] = player
+    players_grid.insert(client_id, player.pos_x, player.pos_y)
+    max_player_radius = max(max_player_radius, player.radius)
+
+
+def update_player(player, client_id, pos_x, pos_y, radius):
+    global max_player_radius
+    player.pos_x = pos_x
+    player.pos_y = pos_y
+    player.radius = radius
+    player.add_sample(pos_x, pos_y)
+    players_grid.move(client_id, pos_x, pos_y)
+    max_player_radius = max(max_player_radius, radius)
+
+
+def pooled_player(username, pos_x, pos_y, color, radius):
+    '''Caller holds players_lock'''
+    if player_pool:
+        player = player_pool.pop()
+        player.reset(username, pos_x, pos_y, color, radius)
+        return player
+    return Player(username, pos_x, pos_y, color, radius)
+
+
+def remove_player(client_id, left_game=False):
+    '''Caller holds players_lock'''
+    player = players.pop(client_id, None)
+    players_grid.remove(client_id)
+    if player is None:
+        return
+    if left_game:
+        forget_text(player.username)
+    if len(player_pool) < PLAYER_POOL_SIZE:
+        player_pool.append(player)
+
+
 def parse_cells_data(cell_data):
-    for cell in cell_data:
-        new_cell = Cell(
-            cell[1],
-            cell[2],
-            decode_color(cell[3]),
-            CELL_RADIUS 
-        )
-        cells[cell[0]] = new_cell
+    for key, pos_x, pos_y, color in cell_data:
+        update_cell(key, pos_x, pos_y, color)
 
 
 def parse_players_data(players_data, current_player_username):
@@ -86,95 +256,273 @@ def parse_players_data(players_data, current_player_username):
             current_client_id = client_id
             print(f"Current client id: {current_client_id}")
         else:
-            players[client_id] = new_player
+            add_player(client_id, new_player)
+
+
+def pack_input(seq, vector_x, vector_y):
+    if INPUT_MODE != "sequenced":
+        return struct.pack('ff', vector_x, vector_y)
+    return struct.pack('Iff', seq, vector_x, vector_y)
+
+
+class InputSender():
+    '''Sends the latest mouse vector at a fixed rate from its own thread, a stalled socket never blocks drawing
+
+    Inputs set between two sends are coalesced, only the latest one is sent.
+    '''
+
+    def __init__(self, conn, send_rate):
+        self.conn = conn
+        self.send_interval = 1 / send_rate
+        self.lock = Lock()
+        self.vector = (0, 0)
+        self.seq = 0  # sequence number of the latest sent input
+        self.sent_times = deque(maxlen=MAX_UNACKED_INPUTS)  # (seq, send time) waiting for INPUT_ACK
+        self.quitting = False
+        self.datagram_socket = None  # connected UDP socket once the server answered HELLO
+
+        self.send_rate = 0  # measured inputs per second
+        self.rtt = None  # smoothed time from sending an input to its INPUT_ACK, seconds
+        self.thread = Thread(target=self._send_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def set_input(self, vector_x, vector_y):
+        '''Replaces the input waiting to be sent, returns the sequence number it is sent with'''
+        with self.lock:
+            self.vector = (vector_x, vector_y)
+            return self.seq + 1
+
+    def acknowledge(self, acked_seq):
+        now = time.perf_counter()
+        with self.lock:
+            sent_time = None
+            while self.sent_times and self.sent_times[0][0] <= acked_seq:
+                _, sent_time = self.sent_times.popleft()
+            if sent_time is not None:
+                rtt = now - sent_time
+                self.rtt = rtt if self.rtt is None else self.rtt * 0.875 + rtt * 0.125
+
+    def close(self):
+        '''Sends the quit message after the last input and stops'''
+        self.quitting = True
+        self.thread.join(timeout=1)
+
+    def _send_loop(self):
+        next_send = rate_start = time.perf_counter()
+        rate_sends = 0
+
+        while True:
+            with self.lock:
+                self.seq += 1
+                seq = self.seq
+                vector = (999999, 0) if self.quitting else self.vector
+                now = time.perf_counter()
+                if INPUT_MODE == "sequenced":
+                    self.sent_times.append((seq, now))
+
+            try:
+                if self.datagram_socket is not None and not self.quitting:
+                    self.datagram_socket.send(pack_input_datagram(seq, *vector))
+                else:
+                    # quit message must not be lost, it goes over TCP
+                    self.conn.sendall(pack_input(seq, *vector))
+            except ConnectionRefusedError:
+                pass  # ICMP error of an earlier datagram, UDP inputs are allowed to get lost
+            except OSError:
+                return
+            if self.quitting:
+                return
+
+            rate_sends += 1
+            if now - rate_start >= 1:
+                self.send_rate = rate_sends / (now - rate_start)
+                rate_start, rate_sends = now, 0
+
+            next_send += self.send_interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_send = time.perf_counter()
+
+
+def reconcile_prediction(acked_seq, server_x, server_y):
+    '''Moves the predicted position towards server position + moves the server has not applied yet'''
+    while predicted_moves and predicted_moves[0][0] <= acked_seq:
+        predicted_moves.popleft()
+
+    target_x = clamp_position(server_x + sum(move[1] for move in predicted_moves), MAP_SIZE)
+    target_y = clamp_position(server_y + sum(move[2] for move in predicted_moves), MAP_SIZE)
+    error_x, error_y = target_x - current_player.pos_x, target_y - current_player.pos_y
+
+    if error_x ** 2 + error_y ** 2 > RECONCILE_SNAP_DISTANCE ** 2:
+        current_player.pos_x, current_player.pos_y = target_x, target_y
+    else:
+        # small errors are corrected over a few acknowledgements, so the view doesn't jump
+        current_player.pos_x += error_x * RECONCILE_RATE
+        current_player.pos_y += error_y * RECONCILE_RATE
+
+
+def receive_event_values(conn, event):
+    buffer = event_buffers[event.code]
+    receive_into(conn, buffer)
+    return EVENT_STRUCTS[event.code].unpack(buffer)
+
+
+def apply_snapshot_players(snapshot_players):
+    with players_lock:
+        for client_id, new_pos_x, new_pos_y, new_radius in snapshot_players:
+            if client_id == current_client_id:
+                # position is predicted locally
+                current_player.radius = new_radius
+                continue
+
+            player = players.get(client_id)
+            if player is None:
+                continue
+            update_player(player, client_id, new_pos_x, new_pos_y, new_radius)
+
+
+def apply_input_ack(acked_input):
+    global server_ack
+    input_sender.acknowledge(acked_input[0])
+    with players_lock:
+        server_ack = acked_input
+
+
+def datagram_handler(udp_socket, token):
+    """Binds the UDP channel, then receives player positions and input acks over it"""
+    udp_socket.settimeout(HELLO_INTERVAL)
+    for _ in range(HELLO_ATTEMPTS):
+        try:
+            udp_socket.send(pack_hello(token))
+            udp_socket.recv(MAX_DATAGRAM_SIZE)
+            break
+        except (socket.timeout, ConnectionRefusedError):
+            continue
+    else:
+        print("No answer over UDP, positions keep coming over TCP")
+        return
+
+    udp_socket.settimeout(None)
+    input_sender.datagram_socket = udp_socket
+    latest_seq = 0
+    while True:
+        try:
+            seq, acked_input, snapshot_players = unpack_state_datagram(udp_socket.recv(MAX_DATAGRAM_SIZE))
+        except ConnectionRefusedError:
+            continue
+        except (OSError, ValueError, struct.error):
+            break
+
+        # datagrams can arrive out of order, parts of the latest snapshot share its sequence number
+        if seq < latest_seq:
+            continue
+        latest_seq = seq
+        if acked_input is not None:
+            apply_input_ack(acked_input)
+        apply_snapshot_players(snapshot_players)
 
 
 def network_handler(conn):
     """Receive and process network data"""
     while True:
         try:
-            event_data = receive_exact(conn, struct.calcsize("I"))
-            event = struct.unpack("I", event_data)[0]
-            if event != 2:
+            event = struct.unpack("I", receive_into(conn, event_code_buffer))[0]
+            if event not in (Events.PLAYER_MOVED.code, Events.WORLD_SNAPSHOT.code, Events.COMPACT_SNAPSHOT.code,
+                             Events.PLAYER_LEFT_VIEW.code, Events.CELL_LEFT_VIEW.code, Events.INPUT_ACK.code,
+                             Events.CHUNK_LEFT_VIEW.code):
                 print("Event: ", event)
 
             match event:
                 case Events.PLAYER_MOVED.code:
-                    data_format = Events.PLAYER_MOVED.format
-                    data = receive_exact(conn, struct.calcsize(data_format))
-                    client_id, new_pos_x, new_pos_y, new_radius = struct.unpack(data_format, data)
+                    client_id, new_pos_x, new_pos_y, new_radius = receive_event_values(conn, Events.PLAYER_MOVED)
 
                     with players_lock:
-                        player = players[client_id]
-                        player.pos_x = new_pos_x
-                        player.pos_y = new_pos_y
-                        player.radius = new_radius
-
-                case Events.NEW_PLAYER.code:
-                    length_data = receive_exact(conn, 4)
-                    data_length = struct.unpack('I', length_data)[0]
-                    packed_data = receive_exact(conn, data_length)
+                        update_player(players[client_id], client_id, new_pos_x, new_pos_y, new_radius)
+
+                case Events.WORLD_SNAPSHOT.code | Events.COMPACT_SNAPSHOT.code:
+                    packed_data = receive_sized(conn)
+                    if event == Events.COMPACT_SNAPSHOT.code:
+                        snapshot_players, snapshot_cells = unpack_compact_snapshot(
+                            packed_data, compact_baselines, MAP_SIZE)
+                    else:
+                        snapshot_players, snapshot_cells = unpack_world_snapshot(packed_data)
+
+                    apply_snapshot_players(snapshot_players)
+                    with cells_lock:
+                        # cells of chunks entering the view are sent the same way as changed ones
+                        for key, new_pos_x, new_pos_y, new_color in snapshot_cells:
+                            update_cell(key, new_pos_x, new_pos_y, new_color)
+
+                case Events.INPUT_ACK.code:
+                    apply_input_ack(receive_event_values(conn, Events.INPUT_ACK))
+
+                case Events.PLAYER_LEFT_VIEW.code:
+                    client_id = receive_event_values(conn, Events.PLAYER_LEFT_VIEW)[0]
+                    compact_baselines.pop(client_id, None)
+                    with players_lock:
+                        remove_player(client_id)
+
+                case Events.CELL_LEFT_VIEW.code:
+                    key = receive_event_values(conn, Events.CELL_LEFT_VIEW)[0]
+                    with cells_lock:
+                        remove_cell(key)
+
+                case Events.CHUNK_LEFT_VIEW.code:
+                    chunk = receive_event_values(conn, Events.CHUNK_LEFT_VIEW)[0]
+                    with cells_lock:
+                        remove_chunk(chunk)
+
+                case Events.NEW_PLAYER.code | Events.PLAYER_ENTERED_VIEW.code:
+                    packed_data = receive_sized(conn)
                     (client_id, username, pos_x, pos_y, color, radius), _ = unpack_player(packed_data=packed_data) 
-                    print(f"New player has joined: {username}")
-                    new_player = Player(
-                        username,
-                        pos_x,
-                        pos_y,
-                        decode_color(color),
-                        radius
-                    )
+                    if client_id == current_client_id:
+                        continue
+                    print(f"Player in view: {username}")
 
                     with players_lock:
-                        players[client_id] = new_player
+                        remove_player(client_id)  # player entering the view again
+                        add_player(client_id, pooled_player(username, pos_x, pos_y, decode_color(color), radius))
                     
 
                 case Events.PLAYER_QUIT.code:
-                    data_format = Events.PLAYER_QUIT.format
-                    data = receive_exact(conn, struct.calcsize(data_format))
-                    client_id = struct.unpack(data_format, data)[0]
+                    client_id = receive_event_values(conn, Events.PLAYER_QUIT)[0]
                     with players_lock:
-                        players.pop(client_id)
+                        remove_player(client_id, left_game=True)
 
                 case Events.PLAYER_EATEN.code:
-                    data_format = Events.PLAYER_EATEN.format
-                    data = receive_exact(conn, struct.calcsize(data_format))
-                    defeated_client_id, winner_client_id, new_winner_radius = struct.unpack(
-                        data_format, data)
+                    defeated_client_id, winner_client_id, new_winner_radius = receive_event_values(conn, Events.PLAYER_EATEN)
                     
                     with players_lock:
-                        players.pop(defeated_client_id, None)
+                        remove_player(defeated_client_id, left_game=True)
                         try:
                             winner = players[winner_client_id]
-                            winner.radius = new_winner_radius
+                            update_player(winner, winner_client_id, winner.pos_x, winner.pos_y, new_winner_radius)
                         except Exception as e:
                             print(e)
                     
                 case Events.PLAYER_EATEN_BY_CURRENT_PLAYER.code:
-                    data_format = Events.PLAYER_EATEN_BY_CURRENT_PLAYER.format
-                    data = receive_exact(conn, struct.calcsize(data_format))
-                    defeated_client_id, winner_client_id, new_winner_radius = struct.unpack(
-                        data_format, data)
+                    defeated_client_id, winner_client_id, new_winner_radius = receive_event_values(conn, Events.PLAYER_EATEN_BY_CURRENT_PLAYER)
                     
                     with players_lock:
-                        players.pop(defeated_client_id, None)
+                        remove_player(defeated_client_id, left_game=True)
                         current_player.radius = new_winner_radius
 
                 case Events.GAME_OVER.code:
                     print("Game over.")
                     current_player.is_alive = False
+                    if os.path.exists(SESSION_FILE):
+                        os.remove(SESSION_FILE)  # eaten players can't be resumed
                     break
 
                 case Events.CELL_EATEN.code | Events.CELL_EATEN_BY_CURRENT_PLAYER.code:
-                    data_format = Events.CELL_EATEN.format
-                    data = receive_exact(conn, struct.calcsize(data_format))
-                    key, new_pos_x, new_pos_y, new_color = struct.unpack(
-                        data_format, data)
+                    key, new_pos_x, new_pos_y, new_color = receive_event_values(conn, Events.CELL_EATEN)
 
                     with cells_lock:  
-                        cell = cells[key]
-                        cell.pos_x = new_pos_x
-                        cell.pos_y = new_pos_y
-                        cell.color = decode_color(new_color)
+                        update_cell(key, new_pos_x, new_pos_y, new_color)
 
                         print(f"Removed cell: {key}")
                         print(f"New cell was spawned: {new_pos_x}, {new_pos_y}, {new_color}")
@@ -190,10 +538,8 @@ def network_handler(conn):
 
 
 
-def render_game(conn):
-    global WIDTH, HEIGHT
-    last_send_time = 0
-    SEND_INTERVAL = 1/60 
+def render_game(conn, datagram_channel=None):
+    global WIDTH, HEIGHT, input_sender
     FPS = 30
 
     pygame.display.set_caption("Agar.io")
@@ -201,15 +547,29 @@ def render_game(conn):
     CLOCK = pygame.time.Clock()
     SCREEN = pygame.display.set_mode((1280, 720), pygame.RESIZABLE)
 
+    input_sender = InputSender(conn, SEND_RATE)
+
     # Start network thread
     network_thread_obj = Thread(
         target=network_handler, args=(conn,))
     network_thread_obj.start()
+    input_sender.start()
+    if datagram_channel is not None:
+        Thread(target=datagram_handler, args=datagram_channel, daemon=True).start()
+
+    global current_player, server_ack
 
-    global current_player
+    mouse_x, mouse_y = WIDTH / 2, HEIGHT / 2  # until the first mouse event
+    hud_mass = None
+    hud_surface = None
+    network_surface = None
+    last_network_hud_time = 0
+    frame_times = []
+    last_report_time = time.time()
 
     while True:
         current_time = time.time()
+        frame_start = time.perf_counter()
 
         if not current_player.is_alive:
             return
@@ -217,8 +577,7 @@ def render_game(conn):
         for event in pygame.event.get():
             if event.type == QUIT:
                 pygame.quit()
-                data = struct.pack('ff', 999999, 0)
-                conn.sendall(data)
+                input_sender.close()
                 return
             if event.type == MOUSEMOTION:
                 mouse_x, mouse_y = event.pos
@@ -226,44 +585,75 @@ def render_game(conn):
                 mouse_x = WIDTH / 2
                 mouse_y = HEIGHT / 2
 
-        if current_time - last_send_time > SEND_INTERVAL:
-            data = struct.pack('ff', (mouse_x - WIDTH / 2), (mouse_y - HEIGHT / 2))
-            conn.sendall(data)
-            last_send_time = current_time
+        # sender thread sends it, together with anything else set before its next send
+        move_seq = input_sender.set_input(mouse_x - WIDTH / 2, mouse_y - HEIGHT / 2)
+
+        # predicted the way the server moves it, with the clamped vector (windows bigger than 1280x720
+        # give longer ones) and kept on the map
+        vector_x, vector_y = clamp_mouse_vector(mouse_x - WIDTH / 2, mouse_y - HEIGHT / 2)
+        pos_x = clamp_position(current_player.pos_x + vector_x / current_player.radius / 2, MAP_SIZE)
+        pos_y = clamp_position(current_player.pos_y + vector_y / current_player.radius / 2, MAP_SIZE)
+        move_x, move_y = pos_x - current_player.pos_x, pos_y - current_player.pos_y
+        current_player.pos_x, current_player.pos_y = pos_x, pos_y
 
-        current_player.pos_x += ((mouse_x - WIDTH / 2) /
-                                 current_player.radius / 2)
-        current_player.pos_y += ((mouse_y - HEIGHT / 2) /
-                                 current_player.radius / 2)
+        if INPUT_MODE == "sequenced":
+            predicted_moves.append((move_seq, move_x, move_y))
+            with players_lock:
+                acked_input, server_ack = server_ack, None
+            if acked_input is not None:
+                reconcile_prediction(*acked_input)
 
 
+        # world position of the window's top left corner, only entities overlapping the window are drawn
+        view_left = current_player.pos_x - WIDTH / 2
+        view_top = current_player.pos_y - HEIGHT / 2
+
         with cells_lock:
-            for cell in cells.values():
-                cell.draw(
-                    SCREEN,
-                    cell.pos_x - current_player.pos_x + WIDTH / 2,
-                    cell.pos_y - current_player.pos_y + HEIGHT / 2
-                )
+            for key in cells_grid.query_rect(view_left - CELL_RADIUS, view_top - CELL_RADIUS,
+                                             view_left + WIDTH + CELL_RADIUS, view_top + HEIGHT + CELL_RADIUS):
+                cell = cells[key]
+                cell.draw(SCREEN, cell.pos_x - view_left, cell.pos_y - view_top)
 
+        # other players are drawn a bit in the past, so there are snapshots on both sides to interpolate
+        render_time = time.perf_counter() - INTERPOLATION_DELAY
         with players_lock:
-            for other_player in players.values():
-                other_player.draw(
-                    SCREEN,
-                    other_player.pos_x - current_player.pos_x + WIDTH / 2,
-                    other_player.pos_y - current_player.pos_y + HEIGHT / 2
-                )
+            for client_id in players_grid.query_rect(view_left - max_player_radius, view_top - max_player_radius,
+                                                     view_left + WIDTH + max_player_radius,
+                                                     view_top + HEIGHT + max_player_radius):
+                other_player = players[client_id]
+                pos_x, pos_y = other_player.interpolated_position(render_time)
+                other_player.draw(SCREEN, pos_x - view_left, pos_y - view_top)
 
         current_player.draw(SCREEN, (WIDTH / 2), (HEIGHT / 2))
 
    
-        text = FONT.render(
-            "Mass: " + str((current_player.radius)), False, TEXT_COLOR)
-        SCREEN.blit(text, (20, 20))
+        # HUD is rendered again only when the mass changes
+        if current_player.radius != hud_mass:
+            hud_mass = current_player.radius
+            hud_surface = FONT.render("Mass: " + str(hud_mass), False, TEXT_COLOR)
+        SCREEN.blit(hud_surface, (20, 20))
+
+        if current_time - last_network_hud_time >= 1:
+            last_network_hud_time = current_time
+            rtt = "-" if input_sender.rtt is None else f"{input_sender.rtt * 1000:.0f} ms"
+            network_surface = SMALLFONT.render(
+                f"Send rate: {input_sender.send_rate:.0f}/s  RTT: {rtt}  "
+                f"{'UDP' if input_sender.datagram_socket is not None else 'TCP'}", True, TEXT_COLOR)
+        SCREEN.blit(network_surface, (20, 60))
 
     
 
         WIDTH, HEIGHT = pygame.display.get_surface().get_size()
         pygame.display.update()
+
+        # time spent drawing a frame, without waiting for the next one
+        frame_times.append(time.perf_counter() - frame_start)
+        if FRAME_TIME_REPORT_INTERVAL and current_time - last_report_time > FRAME_TIME_REPORT_INTERVAL:
+            print(f"Frame time: {sum(frame_times) / len(frame_times) * 1000:.2f} ms avg, "
+                  f"{max(frame_times) * 1000:.2f} ms max, {len(players)} players")
+            frame_times.clear()
+            last_report_time = current_time
+
         CLOCK.tick(FPS)
         SCREEN.fill(BACKGROUND_COLOR)
 
@@ -277,19 +667,75 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
     username = ""
     response = ""
     request = receive_message(s)
-    while request == "GET username":
+    if request == "GET username":
+        s.sendall(b"/world")
+        response = receive_message(s)
+        print(response)
+        if response.startswith("INFO World: "):
+            apply_world_info(response)
+        request = receive_message(s)
+    if request == "GET username" and PROTOCOL != "standard":
+        s.sendall(f"/protocol {PROTOCOL}".encode("ascii"))
+        response = receive_message(s)
+        print(response)
+        if not response.startswith(f"INFO Protocol: {PROTOCOL}"):
+            PROTOCOL = "standard"
+        request = receive_message(s)
+    if request == "GET username" and INPUT_MODE != "plain":
+        s.sendall(f"/input {INPUT_MODE}".encode("ascii"))
+        response = receive_message(s)
+        print(response)
+        if not response.startswith(f"INFO Input: {INPUT_MODE}"):
+            # the server reads plain mouse vectors, sequenced ones would be misread from then on
+            INPUT_MODE = "plain"
+        request = receive_message(s)
+    datagram_channel = None  # (UDP socket, token) when the server offered a UDP channel
+    if request == "GET username" and TRANSPORT == "udp" and INPUT_MODE == "sequenced":
+        s.sendall(f"/transport {TRANSPORT}".encode("ascii"))
+        response = receive_message(s)
+        print(response)
+        if response.startswith("INFO Transport: udp "):
+            udp_port, token = map(int, response.split()[3:5])
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.connect((HOST, udp_port))
+            datagram_channel = (udp_socket, token)
+        request = receive_message(s)
+
+    resumed = False
+    if request == "GET username" and os.path.exists(SESSION_FILE):
+        with open(SESSION_FILE) as session_file:
+            token, username = session_file.read().split(maxsplit=1)
+        s.sendall(f"/resume {token}".encode("ascii"))
+        response = receive_message(s)
+        print(response)
+        resumed = not response.startswith("ERROR")
+        if not resumed:
+            os.remove(SESSION_FILE)
+            request = receive_message(s)
+    if request == "GET username" and not resumed:
+        s.sendall(b"/session")
+        response = receive_message(s)
+        print(response)
+        session_token = response.split()[2] if response.startswith("INFO Session: ") else None
+        request = receive_message(s)
+
+    while request == "GET username" and not resumed:
         print("Type username: ")
         username = input()
         s.sendall(username.encode("ascii"))
         response = receive_message(s)
         print(response)
         if not response.startswith("ERROR"):
+            if session_token is not None:
+                with open(SESSION_FILE, "w") as session_file:
+                    session_file.write(f"{session_token} {username}")
             break
         request = receive_message(s)
         print(request)
     else:
-        print("An error occurred")
-        print(request)
+        if not resumed:
+            print("An error occurred")
+            print(request)
 
     for i in range(2):  
         request = receive_message(s)
@@ -305,4 +751,4 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             print("An error occurred")
             print(request)
 
-    render_game(s)
+    render_game(s, datagram_channel)
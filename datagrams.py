@@ -0,0 +1,96 @@
+import struct
+from enums import Events
+from newtork_utils import pack_event, pack_world_snapshot, unpack_world_snapshot
+
+
+# UDP CHANNEL
+# client asks for it with `/transport udp` before its username, the server answers with the
+# UDP port and a token. After joining the client sends HELLO with the token from its UDP socket
+# until the server answers, from then on inputs and player positions go over UDP and everything
+# else (enter/leave view, eaten players, game over, cell respawns) stays on TCP.
+MAX_DATAGRAM_SIZE = 1200  # fits the MTU of any path without IP fragmentation
+
+# client to server: kind, values
+HELLO = 1  # token
+INPUT = 2  # seq, mouse_x, mouse_y
+HELLO_DATAGRAM = struct.Struct('=BI')
+INPUT_DATAGRAM = struct.Struct('=BIff')
+
+# server to client: snapshot sequence number, then INPUT_ACK and WORLD_SNAPSHOT events as on TCP,
+# a snapshot too big for one datagram is split into several with the same sequence number
+STATE_HEADER = struct.Struct('=I')
+INPUT_ACK_SIZE = 4 + struct.calcsize(Events.INPUT_ACK.format)
+PLAYERS_PER_DATAGRAM = (MAX_DATAGRAM_SIZE - STATE_HEADER.size - INPUT_ACK_SIZE - 16) // 16
+
+
+def pack_hello(token):
+    return HELLO_DATAGRAM.pack(HELLO, token)
+
+
+def pack_input_datagram(seq, mouse_x, mouse_y):
+    return INPUT_DATAGRAM.pack(INPUT, seq, mouse_x, mouse_y)
+
+
+def unpack_client_datagram(data):
+    '''Returns (kind, values), kind is None for datagrams of unknown kind or size'''
+    if len(data) == HELLO_DATAGRAM.size and data[0] == HELLO:
+        return HELLO, HELLO_DATAGRAM.unpack(data)[1:]
+    if len(data) == INPUT_DATAGRAM.size and data[0] == INPUT:
+        return INPUT, INPUT_DATAGRAM.unpack(data)[1:]
+    return None, ()
+
+
+def pack_state_datagrams(seq, ack, players):
+    '''ack: (input seq, pos_x, pos_y) or None, players: (client_id, pos_x, pos_y, radius)'''
+    chunks = [players[start:start + PLAYERS_PER_DATAGRAM]
+              for start in range(0, len(players), PLAYERS_PER_DATAGRAM)] or [[]]
+    datagrams = []
+    for chunk in chunks:
+        datagram = STATE_HEADER.pack(seq)
+        if ack is not None and not datagrams:
+            datagram += pack_event(*ack, event=Events.INPUT_ACK.code, format=Events.INPUT_ACK.format)
+        if chunk:
+            datagram += pack_event(event=Events.WORLD_SNAPSHOT.code, packed_data=pack_world_snapshot(chunk, []))
+        datagrams.append(datagram)
+    return datagrams
+
+
+def unpack_state_datagram(data):
+    '''Returns (seq, ack or None, snapshot players)'''
+    seq = STATE_HEADER.unpack_from(data)[0]
+    offset = STATE_HEADER.size
+    ack = None
+    players = []
+    while offset < len(data):
+        event = struct.unpack_from('I', data, offset)[0]
+        offset += 4
+        if event == Events.INPUT_ACK.code:
+            ack = struct.unpack_from(Events.INPUT_ACK.format, data, offset)
+            offset += INPUT_ACK_SIZE - 4
+        elif event == Events.WORLD_SNAPSHOT.code:
+            length = struct.unpack_from('I', data, offset)[0]
+            players = unpack_world_snapshot(data[offset + 4:offset + 4 + length])[0]
+            offset += 4 + length
+        else:
+            raise ValueError(f"Unexpected event in state datagram: {event}")
+    return seq, ack, players
+
+
+class DatagramChannel():
+    '''Server side of the UDP channel of one client, used by its send queue'''
+
+    def __init__(self, transport, address):
+        self.transport = transport  # server UDP socket or asyncio DatagramTransport, both have sendto
+        self.address = address
+        self.seq = 0  # of the latest sent snapshot, client ignores older ones arriving late
+
+    def send_state(self, ack, players):
+        '''Sends one snapshot, a lost datagram is not sent again, the next snapshot replaces it'''
+        self.seq += 1
+        datagrams = pack_state_datagrams(self.seq, ack, players)
+        for datagram in datagrams:
+            try:
+                self.transport.sendto(datagram, self.address)
+            except OSError:
+                pass  # same as a datagram lost on the way
+        return datagrams
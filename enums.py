@@ -18,4 +18,11 @@ class Events(enum.Enum):
     NEW_PLAYER = 5, None
     PLAYER_EATEN_BY_CURRENT_PLAYER = 6, "IIf"
     PLAYER_QUIT = 7, "I"
+    WORLD_SNAPSHOT = 8, None
+    PLAYER_ENTERED_VIEW = 9, None
+    PLAYER_LEFT_VIEW = 10, "I"
+    CELL_LEFT_VIEW = 11, "I"
+    COMPACT_SNAPSHOT = 12, None
+    INPUT_ACK = 13, "Iff"
+    CHUNK_LEFT_VIEW = 14, "I"
 
@@ -0,0 +1,144 @@
+import bisect
+import struct
+import time
+from threading import Lock
+from enums import Events
+
+
+HISTOGRAM_BOUNDS_MS = (0.01, 0.1, 0.5, 1, 5, 10, 50, 100)  # bucket upper bounds, last bucket has everything slower
+TICK_PHASES = ("move", "collision", "broadcast", "total")
+
+DATAGRAM_EVENT = 0x10000  # events_sent key of UDP datagrams with player positions and input acks, no event has it
+
+EVENT_NAMES = {event.code: event.name for event in Events}
+EVENT_NAMES[DATAGRAM_EVENT] = "STATE_DATAGRAM"
+
+
+class Histogram():
+    '''Durations in milliseconds counted per bucket, plus count, total and max'''
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS_MS):
+        self.bounds = bounds
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0
+            self.max = 0
+
+    def add(self, milliseconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, milliseconds)] += 1
+            self.count += 1
+            self.total += milliseconds
+            self.max = max(self.max, milliseconds)
+
+    def add_seconds(self, seconds):
+        self.add(seconds * 1000)
+
+    def summary(self):
+        with self.lock:
+            labels = [f"<={bound}" for bound in self.bounds] + [f">{self.bounds[-1]}"]
+            return {
+                "count": self.count,
+                "avg_ms": round(self.total / self.count, 4) if self.count else 0,
+                "max_ms": round(self.max, 4),
+                "buckets": {label: count for label, count in zip(labels, self.counts) if count},
+            }
+
+
+class TimedLock():
+    '''Lock that records how long acquiring it waited and how long it was held
+
+    Uncontended acquires are counted as 0 ms waits without timing the acquire.
+    '''
+
+    def __init__(self, wait_histogram, hold_histogram):
+        self.lock = Lock()
+        self.wait_histogram = wait_histogram
+        self.hold_histogram = hold_histogram
+        self.acquired = 0  # written and read by the holder only
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.acquired = time.perf_counter()
+            self.wait_histogram.add(0)
+            return True
+        if not blocking:
+            return False
+
+        start = time.perf_counter()
+        if not self.lock.acquire(True, timeout):
+            return False
+        self.acquired = time.perf_counter()
+        self.wait_histogram.add_seconds(self.acquired - start)
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.hold_histogram.add_seconds(held)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+
+tick_phases = {phase: Histogram() for phase in TICK_PHASES}
+lock_waits = {}  # lock name, Histogram
+lock_holds = {}  # lock name, Histogram
+snapshot_encoding = Histogram()  # time writers spend encoding coalesced snapshot state
+
+events_lock = Lock()
+events_sent = {}  # event code, [messages, bytes]
+
+
+def timed_lock(name):
+    '''Creates a lock whose wait and hold times show up in stats under name'''
+    lock_waits[name] = Histogram()
+    lock_holds[name] = Histogram()
+    return TimedLock(lock_waits[name], lock_holds[name])
+
+
+def count_event(data):
+    '''Counts one packed event, its code is the first field'''
+    count_event_code(struct.unpack_from('I', data)[0], len(data))
+
+
+def count_event_code(code, n_bytes):
+    with events_lock:
+        counters = events_sent.setdefault(code, [0, 0])
+        counters[0] += 1
+        counters[1] += n_bytes
+
+
+def stats(reset=False):
+    '''Collected timings and counters, with reset=True the next call only covers what happened after this one'''
+    with events_lock:
+        events = {EVENT_NAMES.get(code, str(code)): {"messages": messages, "bytes": n_bytes}
+                  for code, (messages, n_bytes) in events_sent.items()}
+        if reset:
+            events_sent.clear()
+
+    histograms = [*tick_phases.values(), *lock_waits.values(), *lock_holds.values(), snapshot_encoding]
+    result = {
+        "tick_ms": {phase: histogram.summary() for phase, histogram in tick_phases.items()},
+        "lock_wait_ms": {name: histogram.summary() for name, histogram in lock_waits.items()},
+        "lock_hold_ms": {name: histogram.summary() for name, histogram in lock_holds.items()},
+        "snapshot_encoding_ms": snapshot_encoding.summary(),
+        "events_sent": events,
+    }
+    if reset:
+        for histogram in histograms:
+            histogram.reset()
+    return result
@@ -1,77 +1,110 @@
+import logging
+import math
 import struct
 import socket
+from enums import Events
+
+log = logging.getLogger("network")
+
+
+# event code + values of every fixed size event format, compiled once instead of on every pack
+EVENT_STRUCTS = {event.format: struct.Struct("I" + event.format) for event in Events if event.format is not None}
+LENGTH = struct.Struct('I')
+
+
+def pack_event(*data, event: int, format: str | None = "", packed_data: bytes | None = None):
+    if packed_data is None:
+        return EVENT_STRUCTS[format].pack(event, *data)
+    return LENGTH.pack(event) + packed_data
+
 
 def notify_client(*data, conn: socket, event: int, format: str | None = "", packed_data: bytes | None = None):
-    send_format = "I" + format
-    if packed_data == None:
-        conn.sendall(struct.pack(
-            send_format, event, *data))
-    else:
-        conn.sendall(struct.pack(
-            send_format, event) + packed_data)
+    conn.sendall(pack_event(*data, event=event, format=format, packed_data=packed_data))
+
+
+# INPUT
+# the server clamps longer mouse vectors (half the diagonal of a 1280x720 window), clients predict with the same clamp
+MAX_MOUSE_DISTANCE = math.hypot(1280 / 2, 720 / 2)
+
+
+def clamp_mouse_vector(mouse_x, mouse_y):
+    '''Returns (mouse_x, mouse_y) no longer than MAX_MOUSE_DISTANCE'''
+    distance = math.hypot(mouse_x, mouse_y)
+    if distance <= MAX_MOUSE_DISTANCE:
+        return mouse_x, mouse_y
+    return mouse_x * MAX_MOUSE_DISTANCE / distance, mouse_y * MAX_MOUSE_DISTANCE / distance
+
+
+def clamp_position(value, map_size):
+    '''Keeps a coordinate on the map, players are never moved past its edges'''
+    return min(max(value, 0), map_size)
 
 
 # CELLS
-def _pack_cells(cells):
-    packed_data = struct.pack('I', len(cells))  # Number of cells
+CELL_RECORD = struct.Struct('IffI')  # key, pos_x, pos_y, color
+
 
+def pack_cells(cells):
+    '''Length prefixed POST cells data of {key: cell}, packed into one preallocated buffer'''
+    packed_data = bytearray(8 + CELL_RECORD.size * len(cells))
+    struct.pack_into('II', packed_data, 0, len(packed_data) - 4, len(cells))
+    offset = 8
     for key, cell in cells.items():
-        packed_data += struct.pack('IffI', key, cell.pos_x,
-                                   cell.pos_y, cell.color)
+        CELL_RECORD.pack_into(packed_data, offset, key, cell.pos_x, cell.pos_y, cell.color)
+        offset += CELL_RECORD.size
 
     return packed_data
 
 
-def send_cells(sock, cells):
-    try:
-        packed_data = _pack_cells(cells)
+class CellImage():
+    '''POST cells records of all cells (by key), kept encoded and updated in place when a cell changes'''
 
-        # Send data length first
-        data_length = len(packed_data)
-        sock.send(struct.pack('I', data_length))
+    def __init__(self, count):
+        self.buffer = bytearray(CELL_RECORD.size * count)
+        self.view = memoryview(self.buffer)
 
-        sock.send(packed_data)
+    def update(self, key, pos_x, pos_y, color):
+        CELL_RECORD.pack_into(self.buffer, key * CELL_RECORD.size, key, pos_x, pos_y, color)
+
+    def pack(self, keys=None):
+        '''Length prefixed POST cells data of the given cells (all without keys), copied from the image'''
+        size = CELL_RECORD.size
+        if keys is None:
+            return struct.pack('II', 4 + len(self.buffer), len(self.buffer) // size) + self.buffer
+
+        parts = [struct.pack('II', 4 + size * len(keys), len(keys))]
+        parts.extend([self.view[key * size:key * size + size] for key in keys])
+        return b"".join(parts)
+
+
+def send_cells(sock, cells):
+    '''cells: {key: cell}, or data already packed with pack_cells/CellImage'''
+    try:
+        packed_data = cells if isinstance(cells, (bytes, bytearray)) else pack_cells(cells)
+        sock.sendall(packed_data)
         return True
     except Exception as e:
-        print(f"Error sending cells: {e}")
+        log.error("Error sending cells: %s", e)
         return False
     
 
 def unpack_cells(sock):
     try:
-        # data length
-        length_data = receive_exact(sock, 4)
-        data_length = struct.unpack('I', length_data)[0]
-
-        # actual data
-        packed_data = receive_exact(sock, data_length)
-
-        # number of cells
-        cell_count = struct.unpack('I', packed_data[:4])[0]
-
-        cells = []
-        offset = 4  # Skip the cell count
-
-        for _ in range(cell_count):
-            cell_data = struct.unpack('IffI', packed_data[offset:offset+16])
-            cells.append(cell_data)  # (key, pos_x, pos_y, color)
-            offset += 16
+        packed_data = receive_sized(sock)
 
-        return cells
+        # fixed size (key, pos_x, pos_y, color) records after the cell count
+        cell_count = struct.unpack_from('I', packed_data)[0]
+        return list(CELL_RECORD.iter_unpack(memoryview(packed_data)[4:4 + cell_count * CELL_RECORD.size]))
     except Exception as e:
-        print(f"Error receiving cells: {e}")
+        log.error("Error receiving cells: %s", e)
         return []
 
 
 # PLAYERS
 def pack_player(player, add_length: bool | None = False):
-    packed_player = struct.pack("I", player.client_id)
     encoded_username = player.username.encode("ascii")
-
-    packed_player += struct.pack('I', len(encoded_username))
-    packed_player += encoded_username
-    packed_player += struct.pack('ffIf', player.pos_x,
-                                 player.pos_y, player.color, player.radius)
+    packed_player = struct.pack(f'=II{len(encoded_username)}sffIf', player.client_id, len(encoded_username),
+                                encoded_username, player.pos_x, player.pos_y, player.color, player.radius)
     
     if add_length:
         packed_player = struct.pack("I", len(packed_player)) + packed_player
@@ -79,80 +112,243 @@ def pack_player(player, add_length: bool | None = False):
     return packed_player
 
 
-def _pack_players(players):
-    packed_data = struct.pack('I', len(players))  # Number of players
-
-    for player in players.values():
-        packed_data += pack_player(player)
+def pack_players(players):
+    '''Length prefixed POST players data, joined once instead of appended player by player'''
+    parts = [b"", struct.pack('I', len(players))]  # data length, number of players
+    parts.extend(pack_player(player) for player in players.values())
+    parts[0] = struct.pack('I', sum(len(part) for part in parts))
 
-    return packed_data
+    return b"".join(parts)
 
 
 def send_players(sock, players):
+    '''players: {username: player} or data already packed with pack_players'''
     try:
-        packed_data = _pack_players(players)
-
-        # Send data length first
-        data_length = len(packed_data)
-        sock.send(struct.pack('I', data_length))
-        
-        sock.send(packed_data)
+        packed_data = players if isinstance(players, (bytes, bytearray)) else pack_players(players)
+        sock.sendall(packed_data)
         return True
     except Exception as e:
-        print(f"Error sending players: {e}")
+        log.error("Error sending players: %s", e)
         return False
     
 
 
-def unpack_player(packed_data: bytes, start_offset: int | None = 0):
-    offset = start_offset
-    client_id = struct.unpack(
-        'I', packed_data[offset:offset + struct.calcsize('I')])[0]
-    offset += struct.calcsize('I')
+PLAYER_HEADER = struct.Struct('=II')  # client_id, username length
+PLAYER_VALUES = struct.Struct('=ffIf')  # pos_x, pos_y, color, radius
 
-    username_length = struct.unpack(
-        'I', packed_data[offset:offset + struct.calcsize('I')])[0]
-    offset += struct.calcsize('I')
 
-    username = packed_data[offset:offset +
-                           username_length].decode('ascii')
+def unpack_player(packed_data: bytes, start_offset: int | None = 0):
+    client_id, username_length = PLAYER_HEADER.unpack_from(packed_data, start_offset)
+    offset = start_offset + PLAYER_HEADER.size
+
+    username = str(packed_data[offset:offset + username_length], 'ascii')
     offset += username_length
 
-    player_data = struct.unpack(
-        'ffIf', packed_data[offset:offset + struct.calcsize('ffIf')])
-    offset += struct.calcsize('ffIf')
+    player_data = PLAYER_VALUES.unpack_from(packed_data, offset)
+    offset += PLAYER_VALUES.size
 
     return (client_id, username, *player_data), offset
 
 
 def unpack_players(sock):
     try:
-        # data length
-        length_data = receive_exact(sock, 4)
-        data_length = struct.unpack('I', length_data)[0]
-
-        # actual data
-        packed_data = receive_exact(sock, data_length)
-
-        # number of players
-        count = struct.unpack('I', packed_data[:4])[0]
+        # one offset scan over the data, slices are views instead of copies
+        packed_data = memoryview(receive_sized(sock))
+        count = struct.unpack_from('I', packed_data)[0]
 
         players = []
-        offset = 4  # Skip the cell count
+        offset = 4  # Skip the player count
 
         for _ in range(count):
             # (client_id, username, pos_x, pos_y, color, radius)
-            data, new_offset = unpack_player(
-                packed_data=packed_data, start_offset=offset)
-            offset = new_offset
+            data, offset = unpack_player(packed_data, offset)
             players.append(data)
 
         return players
     except Exception as e:
-        print(f"Error receiving players: {e}")
+        log.error("Error receiving players: %s", e)
         return []
 
 
+# SNAPSHOTS
+SNAPSHOT_PLAYER = struct.Struct('Ifff')  # client_id, pos_x, pos_y, radius
+SNAPSHOT_CELL = struct.Struct('IIII')  # key, pos_x, pos_y, color
+
+
+def pack_world_snapshot(players, cell_changes):
+    '''players: (client_id, pos_x, pos_y, radius), cell_changes: (key, pos_x, pos_y, color)
+
+    Records are packed into one preallocated buffer, which is returned length prefixed.
+    '''
+    cells_offset = 8 + len(players) * SNAPSHOT_PLAYER.size
+    packed_data = bytearray(cells_offset + 4 + len(cell_changes) * SNAPSHOT_CELL.size)
+    LENGTH.pack_into(packed_data, 0, len(packed_data) - 4)
+    LENGTH.pack_into(packed_data, 4, len(players))
+    for offset, player in zip(range(8, cells_offset, SNAPSHOT_PLAYER.size), players):
+        SNAPSHOT_PLAYER.pack_into(packed_data, offset, *player)
+    LENGTH.pack_into(packed_data, cells_offset, len(cell_changes))
+    for offset, cell in zip(range(cells_offset + 4, len(packed_data), SNAPSHOT_CELL.size), cell_changes):
+        SNAPSHOT_CELL.pack_into(packed_data, offset, *cell)
+
+    return packed_data
+
+
+def unpack_world_snapshot(packed_data: bytes):
+    packed_data = memoryview(packed_data)
+    offset = 0
+    player_count = struct.unpack_from('I', packed_data, offset)[0]
+    offset += 4
+
+    players_end = offset + player_count * SNAPSHOT_PLAYER.size
+    players = list(SNAPSHOT_PLAYER.iter_unpack(packed_data[offset:players_end]))
+    offset = players_end
+
+    cell_count = struct.unpack_from('I', packed_data, offset)[0]
+    offset += 4
+
+    cells = list(SNAPSHOT_CELL.iter_unpack(packed_data[offset:offset + cell_count * SNAPSHOT_CELL.size]))
+
+    return players, cells
+
+
+# COMPACT PROTOCOL
+# positions are 16-bit fixed point relative to the map, radius is in quarter units,
+# players are sent as deltas against the last snapshot (TCP delivers every snapshot, so
+# the last sent one is the acknowledged one)
+COMPACT_POSITION_SCALE = 65535
+MAX_COMPACT_MAP_SIZE = COMPACT_POSITION_SCALE  # bigger maps have steps over 1 unit, positions are off by more than 0.5
+COMPACT_RADIUS_SCALE = 4
+
+COMPACT_QUANTIZED_POSITION = struct.Struct('HH')
+
+COMPACT_FULL = 1
+COMPACT_POSITION = 2
+COMPACT_RADIUS = 4
+
+
+def _pack_varint(value):
+    packed = bytearray()
+    while value > 0x7F:
+        packed.append((value & 0x7F) | 0x80)
+        value >>= 7
+    packed.append(value)
+    return bytes(packed)
+
+
+def _unpack_varint(packed_data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = packed_data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _pack_signed_varint(value):
+    return _pack_varint(value << 1 if value >= 0 else (-value << 1) - 1)  # zigzag
+
+
+def _unpack_signed_varint(packed_data, offset):
+    value, offset = _unpack_varint(packed_data, offset)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+
+
+def quantize_position(value, map_size):
+    value = clamp_position(value, map_size)
+    return round(value / map_size * COMPACT_POSITION_SCALE)
+
+
+def dequantize_position(value, map_size):
+    return value / COMPACT_POSITION_SCALE * map_size
+
+
+def pack_compact_snapshot(players, cell_changes, baselines, map_size):
+    '''Same content as pack_world_snapshot, baselines (client_id, quantized state) are updated'''
+    packed_data = bytearray(_pack_varint(len(players)))
+    for client_id, pos_x, pos_y, radius in players:
+        state = (quantize_position(pos_x, map_size), quantize_position(pos_y, map_size),
+                 round(radius * COMPACT_RADIUS_SCALE))
+        baseline = baselines.get(client_id)
+        baselines[client_id] = state
+
+        if baseline is None:
+            packed_data += _pack_varint(client_id << 3 | COMPACT_FULL)
+            packed_data += COMPACT_QUANTIZED_POSITION.pack(state[0], state[1])
+            packed_data += _pack_varint(state[2])
+            continue
+
+        flags = 0
+        if state[:2] != baseline[:2]:
+            flags |= COMPACT_POSITION
+        if state[2] != baseline[2]:
+            flags |= COMPACT_RADIUS
+
+        packed_data += _pack_varint(client_id << 3 | flags)
+        if flags & COMPACT_POSITION:
+            packed_data += _pack_signed_varint(state[0] - baseline[0])
+            packed_data += _pack_signed_varint(state[1] - baseline[1])
+        if flags & COMPACT_RADIUS:
+            packed_data += _pack_signed_varint(state[2] - baseline[2])
+
+    packed_data += _pack_varint(len(cell_changes))
+    for key, pos_x, pos_y, color in cell_changes:
+        packed_data += _pack_varint(key)
+        packed_data += COMPACT_QUANTIZED_POSITION.pack(quantize_position(pos_x, map_size),
+                                                       quantize_position(pos_y, map_size))
+        packed_data += color.to_bytes(3, 'little')
+
+    return LENGTH.pack(len(packed_data)) + packed_data
+
+
+def unpack_compact_snapshot(packed_data: bytes, baselines, map_size):
+    '''Returns the same tuples as unpack_world_snapshot, baselines are updated'''
+    player_count, offset = _unpack_varint(packed_data, 0)
+
+    players = []
+    for _ in range(player_count):
+        header, offset = _unpack_varint(packed_data, offset)
+        client_id, flags = header >> 3, header & 7
+
+        if flags & COMPACT_FULL:
+            quantized_x, quantized_y = struct.unpack_from('HH', packed_data, offset)
+            offset += 4
+            quantized_radius, offset = _unpack_varint(packed_data, offset)
+            state = (quantized_x, quantized_y, quantized_radius)
+        else:
+            state = baselines.get(client_id)
+            delta_x = delta_y = delta_radius = 0
+            if flags & COMPACT_POSITION:
+                delta_x, offset = _unpack_signed_varint(packed_data, offset)
+                delta_y, offset = _unpack_signed_varint(packed_data, offset)
+            if flags & COMPACT_RADIUS:
+                delta_radius, offset = _unpack_signed_varint(packed_data, offset)
+
+            if state is None:
+                continue  # no baseline, full state comes with the next snapshot
+            state = (state[0] + delta_x, state[1] + delta_y, state[2] + delta_radius)
+
+        baselines[client_id] = state
+        players.append((client_id, dequantize_position(state[0], map_size),
+                        dequantize_position(state[1], map_size), state[2] / COMPACT_RADIUS_SCALE))
+
+    cell_count, offset = _unpack_varint(packed_data, offset)
+
+    cells = []
+    for _ in range(cell_count):
+        key, offset = _unpack_varint(packed_data, offset)
+        quantized_x, quantized_y = struct.unpack_from('HH', packed_data, offset)
+        offset += 4
+        color = int.from_bytes(packed_data[offset:offset + 3], 'little')
+        offset += 3
+        cells.append((key, dequantize_position(quantized_x, map_size),
+                      dequantize_position(quantized_y, map_size), color))
+
+    return players, cells
+
+
 # MESSAGES
 def send_message(conn, msg):
     data = msg.encode("ascii")
@@ -160,14 +356,26 @@ def send_message(conn, msg):
     conn.sendall(length + data)
 
 
-def receive_exact(sock, n_bytes):
-    data = b''
-    while len(data) < n_bytes:
-        chunk = sock.recv(n_bytes - len(data))
-        if not chunk:
+def receive_into(sock, buffer):
+    '''Fills a preallocated buffer from the socket'''
+    view = memoryview(buffer)
+    received = 0
+    while received < len(view):
+        n_bytes = sock.recv_into(view[received:])
+        if not n_bytes:
             raise ConnectionError("Socket connection broken")
-        data += chunk
-    return data
+        received += n_bytes
+    return buffer
+
+
+def receive_exact(sock, n_bytes):
+    return receive_into(sock, bytearray(n_bytes))
+
+
+def receive_sized(sock):
+    '''Receives data sent with its length in front (POST cells, POST players, snapshots)'''
+    data_length = struct.unpack('I', receive_exact(sock, 4))[0]
+    return receive_exact(sock, data_length)
 
 
 def receive_message(conn):
@@ -178,7 +386,7 @@ def receive_message(conn):
     length = struct.unpack('I', length_data)[0]
 
     # Read exact message length
-    message = conn.recv(length).decode('ascii')
+    message = receive_exact(conn, length).decode('ascii')
     return message
 
 
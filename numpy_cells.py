@@ -0,0 +1,162 @@
+try:
+    import numpy as np
+except ImportError:  # optional, only needed for the numpy cell backend
+    np = None
+
+
+# same layout as 'IffI' records sent with POST cells
+CELL_DTYPE = None if np is None else np.dtype(
+    [("key", "<u4"), ("pos_x", "<f4"), ("pos_y", "<f4"), ("color", "<u4")])
+
+REBUILD_THRESHOLD = 1024  # respawned cells checked without the index before it is rebuilt
+
+
+class NumpyCells():
+    '''Cells stored as arrays (structure of arrays), key of a cell is its index
+
+    Collisions of all players are found in one vectorized pass over a bucket index:
+    cells are sorted by bucket and every (player, bucket) pair expands to the cell range
+    of that bucket. Respawned cells are not moved inside the index, they are checked
+    separately until there are enough of them to rebuild it.
+    '''
+
+    def __init__(self, count, map_size, bucket_size, rng=None):
+        '''rng is a numpy Generator or a seed'''
+        if np is None:
+            raise RuntimeError("numpy cell backend needs numpy installed")
+
+        self.count = count
+        self.map_size = map_size
+        self.bucket_size = bucket_size
+        self.grid_size = int(map_size // bucket_size) + 1
+        self.rng = np.random.default_rng(rng)
+
+        self.pos_x = np.zeros(count, dtype=np.float32)
+        self.pos_y = np.zeros(count, dtype=np.float32)
+        self.color = np.zeros(count, dtype=np.uint32)
+
+        self.order = np.arange(count)  # cell keys sorted by bucket
+        self.bucket_starts = np.zeros(self.grid_size * self.grid_size + 1, dtype=np.int64)
+        self.moved = np.zeros(count, dtype=bool)  # respawned since last index rebuild
+        self.moved_keys = []
+
+        self.respawn(np.arange(count))
+        self.rebuild_index()
+
+    def __len__(self):
+        return self.count
+
+    def respawn(self, keys):
+        '''Moves cells to random positions with random colors, in bulk'''
+        keys = np.asarray(keys, dtype=np.int64)
+        self.pos_x[keys] = self.rng.integers(0, self.map_size, len(keys), endpoint=True)
+        self.pos_y[keys] = self.rng.integers(0, self.map_size, len(keys), endpoint=True)
+        rgb = self.rng.integers(0, 255, (len(keys), 3), endpoint=True, dtype=np.uint32)
+        self.color[keys] = rgb[:, 0] * 256 * 256 + rgb[:, 1] * 256 + rgb[:, 2]  # encode_color
+        self._mark_moved(keys)
+
+    def load(self, records, keys=None):
+        '''Replaces cells with POST cells records of every cell, as kept in a CellImage, only the keys ones if given
+
+        Cells loaded by key are checked like respawned ones until the index is rebuilt.
+        '''
+        records = np.frombuffer(records, dtype=CELL_DTYPE, count=self.count)
+        if keys is None:
+            self.pos_x[:] = records["pos_x"]
+            self.pos_y[:] = records["pos_y"]
+            self.color[:] = records["color"]
+            self.rebuild_index()
+            return
+
+        keys = np.asarray(keys, dtype=np.int64)
+        self.pos_x[keys] = records["pos_x"][keys]
+        self.pos_y[keys] = records["pos_y"][keys]
+        self.color[keys] = records["color"][keys]
+        self._mark_moved(keys)
+
+    def _mark_moved(self, keys):
+        self.moved[keys] = True
+        self.moved_keys.extend(keys.tolist())
+        if len(self.moved_keys) > REBUILD_THRESHOLD:
+            self.rebuild_index()
+
+    def rebuild_index(self):
+        buckets = self._bucket_of(self.pos_x, self.pos_y)
+        self.order = np.argsort(buckets, kind="stable")
+        counts = np.bincount(buckets, minlength=self.grid_size * self.grid_size)
+        self.bucket_starts[1:] = np.cumsum(counts)
+        self.moved[:] = False
+        self.moved_keys = []
+
+    def collide(self, players_x, players_y, players_reach):
+        '''Returns (cell keys, player indices), each colliding cell goes to its first player
+
+        players_reach is the collision distance of each player (player radius + cell part).
+        '''
+        players_x = np.asarray(players_x, dtype=np.float32)
+        players_y = np.asarray(players_y, dtype=np.float32)
+        players_reach = np.asarray(players_reach, dtype=np.float32)
+        if len(players_x) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        hit_cells, hit_players = self._collide_indexed(players_x, players_y, players_reach)
+
+        if self.moved_keys:
+            moved_keys = np.asarray(self.moved_keys, dtype=np.int64)
+            distances = ((self.pos_x[moved_keys][None, :] - players_x[:, None]) ** 2
+                         + (self.pos_y[moved_keys][None, :] - players_y[:, None]) ** 2)
+            moved_players, moved_cells = np.nonzero(distances < (players_reach ** 2)[:, None])
+            hit_cells = np.concatenate((hit_cells, moved_keys[moved_cells]))
+            hit_players = np.concatenate((hit_players, moved_players))
+
+        # first player (lowest index) eats the cell
+        sort_order = np.lexsort((hit_players, hit_cells))
+        hit_cells, hit_players = hit_cells[sort_order], hit_players[sort_order]
+        eaten_cells, first = np.unique(hit_cells, return_index=True)
+        return eaten_cells, hit_players[first]
+
+    def eat(self, players_x, players_y, players_reach):
+        '''Eats and respawns colliding cells, returns (cell keys, player indices) lists'''
+        eaten_cells, eater_players = self.collide(players_x, players_y, players_reach)
+        if len(eaten_cells):
+            self.respawn(eaten_cells)
+        return eaten_cells.tolist(), eater_players.tolist()
+
+    def values(self, keys):
+        '''(key, pos_x, pos_y, color) tuples with integer positions, as used in snapshots'''
+        keys = np.asarray(keys, dtype=np.int64)
+        return list(zip(keys.tolist(), self.pos_x[keys].astype(np.int64).tolist(),
+                        self.pos_y[keys].astype(np.int64).tolist(), self.color[keys].tolist()))
+
+    def _bucket_of(self, x, y):
+        bucket_x = np.clip((x // self.bucket_size).astype(np.int64), 0, self.grid_size - 1)
+        bucket_y = np.clip((y // self.bucket_size).astype(np.int64), 0, self.grid_size - 1)
+        return bucket_x * self.grid_size + bucket_y
+
+    def _collide_indexed(self, players_x, players_y, players_reach):
+        last_bucket = self.grid_size - 1
+        min_x = np.clip(((players_x - players_reach) // self.bucket_size).astype(np.int64), 0, last_bucket)
+        max_x = np.clip(((players_x + players_reach) // self.bucket_size).astype(np.int64), 0, last_bucket)
+        min_y = np.clip(((players_y - players_reach) // self.bucket_size).astype(np.int64), 0, last_bucket)
+        max_y = np.clip(((players_y + players_reach) // self.bucket_size).astype(np.int64), 0, last_bucket)
+
+        # (player, bucket) pairs
+        rows = max_y - min_y + 1
+        bucket_counts = (max_x - min_x + 1) * rows
+        pair_players = np.repeat(np.arange(len(players_x)), bucket_counts)
+        pair_offsets = np.arange(len(pair_players)) - np.repeat(np.cumsum(bucket_counts) - bucket_counts, bucket_counts)
+        pair_rows = rows[pair_players]
+        buckets = ((min_x[pair_players] + pair_offsets // pair_rows) * self.grid_size
+                   + min_y[pair_players] + pair_offsets % pair_rows)
+
+        # (player, cell) candidates from cell ranges of the buckets
+        starts = self.bucket_starts[buckets]
+        cell_counts = self.bucket_starts[buckets + 1] - starts
+        candidate_players = np.repeat(pair_players, cell_counts)
+        candidate_offsets = np.arange(len(candidate_players)) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+        candidate_cells = self.order[np.repeat(starts, cell_counts) + candidate_offsets]
+
+        distances = ((self.pos_x[candidate_cells] - players_x[candidate_players]) ** 2
+                     + (self.pos_y[candidate_cells] - players_y[candidate_players]) ** 2)
+        hits = (distances < players_reach[candidate_players] ** 2) & ~self.moved[candidate_cells]
+        return candidate_cells[hits], candidate_players[hits]
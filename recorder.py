@@ -0,0 +1,105 @@
+import struct
+import time
+from threading import Lock
+
+
+MAGIC = b"AGRR"
+VERSION = 1
+
+# header: magic, version, cell backend, shards, tick rate, snapshot rate, cell count, map size, seed
+HEADER = struct.Struct('=4sBBBHHIIQ')
+# every record: type, ticks simulated before it arrived, seconds since recording started
+RECORD = struct.Struct('=BId')
+
+JOIN = 1  # client_id, protocol, input mode, username length, username
+INPUT = 2  # client_id, seq, mouse_x, mouse_y
+QUIT = 3  # client_id
+END = 4  # outcome digest, written when the server stops
+
+JOIN_VALUES = struct.Struct('=IBBB')
+INPUT_VALUES = struct.Struct('=IIff')
+QUIT_VALUES = struct.Struct('=I')
+END_VALUES = struct.Struct('=32s')
+
+# stored as indexes into these, same names as in server.py
+CELL_BACKENDS = ("python", "numpy", "sharded")
+PROTOCOLS = ("standard", "compact")
+INPUT_MODES = ("plain", "sequenced")
+
+
+class Recorder():
+    '''Writes joins, accepted inputs and quits of a server session to a binary file
+
+    Each record carries the number of ticks simulated before it arrived, so a replay
+    applies it right before the same tick that used it in the recorded session.
+    '''
+
+    def __init__(self, path, cell_backend, shards, tick_rate, snapshot_rate, cell_count, map_size, seed):
+        self.file = open(path, "wb")
+        self.lock = Lock()
+        self.started = time.perf_counter()
+        self.file.write(HEADER.pack(MAGIC, VERSION, CELL_BACKENDS.index(cell_backend), shards, tick_rate,
+                                    snapshot_rate, cell_count, map_size, seed))
+
+    def _write(self, record_type, tick, values):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD.pack(record_type, tick, time.perf_counter() - self.started) + values)
+
+    def join(self, tick, client_id, username, protocol, input_mode):
+        name = username.encode("ascii")
+        self._write(JOIN, tick, JOIN_VALUES.pack(client_id, PROTOCOLS.index(protocol),
+                                                 INPUT_MODES.index(input_mode), len(name)) + name)
+
+    def input(self, tick, client_id, seq, mouse_x, mouse_y):
+        self._write(INPUT, tick, INPUT_VALUES.pack(client_id, seq, mouse_x, mouse_y))
+
+    def quit(self, tick, client_id):
+        self._write(QUIT, tick, QUIT_VALUES.pack(client_id))
+
+    def close(self, tick=None, digest=None):
+        '''Ends the recording with the final tick and outcome digest, if given'''
+        if digest is not None:
+            self._write(END, tick, END_VALUES.pack(digest))
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(path):
+    '''Returns (session header values, records), records are (type, tick, timestamp, values) tuples'''
+    with open(path, "rb") as file:
+        data = file.read()
+
+    magic, version, backend, shards, tick_rate, snapshot_rate, cell_count, map_size, seed = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} recording: {path}")
+    session = (CELL_BACKENDS[backend], shards, tick_rate, snapshot_rate, cell_count, map_size, seed)
+
+    records = []
+    offset = HEADER.size
+    # a recording cut off by a killed server ends with a partial record, it is ignored
+    while offset + RECORD.size <= len(data):
+        record_type, tick, timestamp = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+
+        if record_type == JOIN:
+            if offset + JOIN_VALUES.size > len(data):
+                break
+            client_id, protocol, input_mode, name_length = JOIN_VALUES.unpack_from(data, offset)
+            offset += JOIN_VALUES.size
+            name = data[offset:offset + name_length]
+            if len(name) < name_length:
+                break
+            offset += name_length
+            values = (client_id, name.decode("ascii"), PROTOCOLS[protocol], INPUT_MODES[input_mode])
+        else:
+            value_struct = {INPUT: INPUT_VALUES, QUIT: QUIT_VALUES, END: END_VALUES}[record_type]
+            if offset + value_struct.size > len(data):
+                break
+            values = value_struct.unpack_from(data, offset)
+            offset += value_struct.size
+
+        records.append((record_type, tick, timestamp, values))
+
+    return session, records
@@ -0,0 +1,124 @@
+import argparse
+import json
+import time
+import server
+import instrumentation
+from recorder import read_recording, JOIN, INPUT, QUIT, END
+from send_queue import SendQueue
+
+
+class NullConnection():
+    '''Stands in for a client socket, everything sent to it is discarded'''
+
+    def sendall(self, data):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+
+def replay(path):
+    '''Runs a recorded session as fast as possible without sockets, returns a report dict
+
+    Records are applied right before the tick that used them on the server, snapshots are
+    encoded into send queues of null connections, so a replay costs what the game loop did.
+    '''
+    (cell_backend, shards, tick_rate, snapshot_rate, cell_count, map_size, seed), records = read_recording(path)
+    server.CELL_BACKEND = cell_backend
+    server.SHARDS = shards
+    server.SNAPSHOT_RATE = snapshot_rate
+    server.CELL_COUNT = cell_count
+    server.MAP_SIZE = map_size
+    server.SEED = seed
+    server.init_game()
+
+    recorded_digest = None
+    end_tick = records[-1][1] if records else 0
+    if records and records[-1][0] == END:
+        recorded_digest = records[-1][3][0].hex()
+    else:
+        end_tick += 1  # server was killed, replay until the last record was used
+
+    tick_interval = 1 / tick_rate
+    snapshot_interval = server.ticks_per_snapshot(tick_rate)
+    replay_players = {}  # client_id, player
+    send_queues = []
+    inputs = 0
+    encode_seconds = 0  # done by writer threads on the server
+    instrumentation.stats(reset=True)
+
+    start = time.perf_counter()
+    index = 0
+    for tick in range(end_tick):
+        while index < len(records) and records[index][1] == tick:
+            record_type, _, _, values = records[index]
+            index += 1
+
+            if record_type == JOIN:
+                client_id, username, protocol, input_mode = values
+                conn = NullConnection()
+                player, _ = server.join_game(client_id, conn, username, protocol, input_mode)
+                server.send_initial_state(conn, player)
+                send_queue = SendQueue(conn, protocol, map_size, server.MAX_QUEUED_BYTES, server.SLOW_CLIENT_POLICY)
+                server.register_connection(player, send_queue)
+                replay_players[client_id] = player
+                send_queues.append(send_queue)
+            elif record_type == INPUT:
+                client_id, seq, mouse_x, mouse_y = values
+                player = replay_players.get(client_id)
+                if player is not None and player.is_alive:
+                    server.set_input(player, seq if player.input_mode == "sequenced" else None, mouse_x, mouse_y)
+                    inputs += 1
+            elif record_type == QUIT:
+                player = replay_players.pop(values[0], None)
+                if player is not None and player.is_alive:
+                    server.remove_player(player)
+
+        server.simulate_tick(tick_interval, broadcast=(tick + 1) % snapshot_interval == 0)
+        encode_start = time.perf_counter()
+        for send_queue in send_queues:
+            send_queue.take()
+        encode_seconds += time.perf_counter() - encode_start
+
+    elapsed = time.perf_counter() - start
+    tick_ms = {phase: summary["avg_ms"] for phase, summary in instrumentation.stats()["tick_ms"].items()}
+    tick_ms["encode"] = encode_seconds / end_tick * 1000 if end_tick else 0
+    if server.cell_store is not None and hasattr(server.cell_store, "close"):
+        server.cell_store.close()
+
+    return {
+        "ticks": end_tick,
+        "seconds": elapsed,
+        "ticks_per_second": end_tick / elapsed if elapsed else float("inf"),
+        "players": len(send_queues),
+        "inputs": inputs,
+        "tick_ms": tick_ms,
+        "digest": server.outcome_digest().hex(),
+        "recorded_digest": recorded_digest,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a session recorded with server.py --record")
+    parser.add_argument("path")
+    parser.add_argument("--expect", metavar="DIGEST", help="exit with status 1 if the game ends differently")
+    parser.add_argument("--log-level", choices=server.LOG_LEVELS, default=server.LOG_LEVEL)
+    parser.add_argument("--json", action="store_true", help="print the report as one JSON line")
+    args = parser.parse_args()
+
+    server.configure_logging(args.log_level)
+    report = replay(args.path)
+    if args.json:
+        print(json.dumps(report))
+        raise SystemExit(0)
+    print(f"{report['ticks']} ticks, {report['players']} players, {report['inputs']} inputs in "
+          f"{report['seconds']:.2f} s: {report['ticks_per_second']:.0f} ticks/s")
+    print("avg ms/tick: " + ", ".join(f"{phase} {ms:.3f}" for phase, ms in report["tick_ms"].items()))
+    print(f"outcome: {report['digest']}")
+    if report["recorded_digest"] is not None:
+        print("same outcome as the recorded session" if report["digest"] == report["recorded_digest"]
+              else f"recorded session ended differently: {report['recorded_digest']}")
+
+    if args.expect and args.expect != report["digest"]:
+        print(f"outcome differs from expected {args.expect}")
+        raise SystemExit(1)
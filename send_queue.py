@@ -0,0 +1,245 @@
+import logging
+import socket
+import time
+from threading import Thread, Lock, Condition
+from enums import Events
+from newtork_utils import pack_event, pack_world_snapshot, pack_compact_snapshot
+from datagrams import INPUT_ACK_SIZE
+import instrumentation
+
+
+SLOW_CLIENT_POLICIES = ("drop", "disconnect")
+CLOSE_TIMEOUT = 1  # seconds the writer of a closed queue gets to send what was queued before closing
+
+log = logging.getLogger("send_queue")
+
+
+class SendQueue():
+    '''Outbound data of one connection
+
+    Events are kept in order. Snapshot state is coalesced, only the latest position of
+    each player and the latest values of each cell are kept until the writer sends them.
+    When more than max_queued_bytes of events are waiting the client is too slow:
+    "drop" policy drops player positions until it catches up, "disconnect" closes it.
+    Cell changes are never dropped, a lost one would never be sent again.
+    Closing sends what is queued, only a disconnect throws it away.
+    Once the client has a UDP channel, player positions and input acks go over it instead.
+    '''
+
+    def __init__(self, conn, protocol, map_size, max_queued_bytes, policy="drop"):
+        self.conn = conn
+        self.protocol = protocol
+        self.map_size = map_size
+        self.max_queued_bytes = max_queued_bytes
+        self.policy = policy
+        self.lock = Lock()
+        self.closed = False
+
+        self.events = []
+        self.queued_bytes = 0
+        self.pending_players = {}  # client_id, (client_id, pos_x, pos_y, radius)
+        self.pending_cells = {}  # key, (key, pos_x, pos_y, color)
+        self.compact_baselines = {}  # client_id, last quantized state sent with COMPACT_SNAPSHOT
+        self.pending_ack = None  # latest (input seq, pos_x, pos_y) for INPUT_ACK
+        self.datagrams = None  # DatagramChannel once the client bound its UDP channel
+
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.max_queued_bytes_seen = 0
+
+    def is_backed_up(self):
+        return self.queued_bytes > self.max_queued_bytes
+
+    def sendall(self, data):
+        '''Queues an event, same call as socket.sendall so notify_client can use it'''
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Send queue is closed")
+
+            self.events.append(data)
+            instrumentation.count_event(data)
+            self.queued_bytes += len(data)
+            self.max_queued_bytes_seen = max(self.max_queued_bytes_seen, self.queued_bytes)
+
+            if self.is_backed_up():
+                if self.policy == "disconnect" or self.queued_bytes > self.max_queued_bytes * 4:
+                    log.warning("Disconnecting slow client, %d bytes queued.", self.queued_bytes)
+                    self._disconnect()
+                    return
+                self._drop_pending()
+
+        self._notify()
+
+    def put_snapshot(self, players, cells):
+        '''Returns False when the queue is closed, player positions are dropped while the client is backed up'''
+        with self.lock:
+            if self.closed:
+                return False
+
+            if self.is_backed_up():
+                # the next snapshot has newer positions anyway
+                self.bytes_dropped += 16 * len(players)
+            else:
+                for player in players:
+                    self.pending_players[player[0]] = player
+            for cell in cells:
+                self.pending_cells[cell[0]] = cell
+
+        self._notify()
+        return True
+
+    def put_input_ack(self, seq, pos_x, pos_y):
+        '''Only the latest acknowledgement is sent, it covers all earlier inputs'''
+        with self.lock:
+            if self.closed:
+                return
+            self.pending_ack = (seq, pos_x, pos_y)
+
+        self._notify()
+
+    def use_datagrams(self, channel):
+        with self.lock:
+            self.datagrams = channel
+
+    def put_player_left(self, client_id):
+        with self.lock:
+            self.pending_players.pop(client_id, None)
+            self.compact_baselines.pop(client_id, None)
+        self.sendall(pack_event(client_id, event=Events.PLAYER_LEFT_VIEW.code, format=Events.PLAYER_LEFT_VIEW.format))
+
+    def put_cell_left(self, key):
+        with self.lock:
+            self.pending_cells.pop(key, None)
+        self.sendall(pack_event(key, event=Events.CELL_LEFT_VIEW.code, format=Events.CELL_LEFT_VIEW.format))
+
+    def put_chunk_left(self, chunk, chunk_map):
+        '''Client drops the cells it has in the chunk, pending cells in it are sent as left instead'''
+        with self.lock:
+            keys = [key for key, (_, pos_x, pos_y, _) in self.pending_cells.items()
+                    if chunk_map.index(pos_x, pos_y) == chunk]
+            for key in keys:
+                del self.pending_cells[key]
+        # the client may still have these cells in a chunk they moved out of
+        for key in keys:
+            self.sendall(pack_event(key, event=Events.CELL_LEFT_VIEW.code, format=Events.CELL_LEFT_VIEW.format))
+        self.sendall(pack_event(chunk, event=Events.CHUNK_LEFT_VIEW.code, format=Events.CHUNK_LEFT_VIEW.format))
+
+    def take(self):
+        '''Returns everything queued as one buffer, input ack and snapshot are encoded after the events'''
+        with self.lock:
+            data = b"".join(self.events)
+            self.events.clear()
+            self.queued_bytes = 0
+
+            players = list(self.pending_players.values())
+            cells = list(self.pending_cells.values())
+            ack = self.pending_ack
+            self.pending_players.clear()
+            self.pending_cells.clear()
+            self.pending_ack = None
+
+            start = time.perf_counter()
+            if self.datagrams is not None and (players or ack):
+                # a lost datagram is replaced by the next one, cells stay on TCP as a lost respawn is never sent again
+                for datagram in self.datagrams.send_state(ack, players):
+                    instrumentation.count_event_code(instrumentation.DATAGRAM_EVENT, len(datagram))
+                players, ack = [], None
+
+            if ack is not None:
+                data += pack_event(*ack, event=Events.INPUT_ACK.code, format=Events.INPUT_ACK.format)
+                instrumentation.count_event_code(Events.INPUT_ACK.code, INPUT_ACK_SIZE)
+
+            if players or cells:
+                if self.protocol == "compact":
+                    snapshot = pack_event(event=Events.COMPACT_SNAPSHOT.code, packed_data=pack_compact_snapshot(
+                        players, cells, self.compact_baselines, self.map_size))
+                else:
+                    snapshot = pack_event(event=Events.WORLD_SNAPSHOT.code,
+                                          packed_data=pack_world_snapshot(players, cells))
+                instrumentation.count_event(snapshot)
+                data += snapshot
+                instrumentation.snapshot_encoding.add_seconds(time.perf_counter() - start)
+
+            self.bytes_sent += len(data)
+            return data
+
+    def has_data(self):
+        return bool(self.events or self.pending_players or self.pending_cells or self.pending_ack)
+
+    def close(self):
+        '''No more data is accepted, the writer sends what is queued and stops'''
+        with self.lock:
+            self.closed = True
+        self._notify()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "queued_bytes": self.queued_bytes,
+                "queued_events": len(self.events),
+                "pending_entities": len(self.pending_players) + len(self.pending_cells),
+                "max_queued_bytes": self.max_queued_bytes_seen,
+                "bytes_sent": self.bytes_sent,
+                "bytes_dropped": self.bytes_dropped,
+            }
+
+    def _drop_pending(self):
+        self.bytes_dropped += 16 * len(self.pending_players)
+        self.pending_players.clear()
+
+    def _disconnect(self):
+        self.closed = True
+        self.bytes_dropped += self.queued_bytes + 16 * (len(self.pending_players) + len(self.pending_cells))
+        self.events.clear()
+        self.queued_bytes = 0
+        self.pending_players.clear()
+        self.pending_cells.clear()
+        self.pending_ack = None
+        self._abort()
+
+    def _abort(self):
+        try:
+            # connection handler sees closed socket and removes the player
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _notify(self):
+        pass
+
+
+class ThreadSendQueue(SendQueue):
+    '''SendQueue drained by its own writer thread with blocking sendall'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = Condition()
+        self.writer = Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _notify(self):
+        with self.condition:
+            self.condition.notify()
+
+    def wait_closed(self, timeout=CLOSE_TIMEOUT):
+        '''Waits for the writer of a closed queue to send what is left, before the socket is closed'''
+        self.writer.join(timeout)
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self.has_data():
+                    self.condition.wait()
+
+            # nothing is queued after closing, so this take gets the rest
+            closed = self.closed
+            data = self.take()
+            if data:
+                try:
+                    self.conn.sendall(data)
+                except OSError as e:
+                    log.warning("Error sending data: %s", e)
+                    self.close()
+                    return
+            if closed:
+                return
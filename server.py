@@ -1,10 +1,30 @@
 import socket
 import random
+import argparse
+import atexit
+import errno
+import hashlib
+import json
+import logging
+import math
+import secrets
+from array import array
+import time
 from threading import Thread, Lock
 import re
 import struct
-from newtork_utils import send_cells, send_message, encode_color, send_players, pack_player, notify_client
+from newtork_utils import send_cells, send_message, encode_color, send_players, pack_player, pack_players, notify_client, pack_event, CellImage, CELL_RECORD, receive_exact, clamp_mouse_vector, clamp_position, MAX_COMPACT_MAP_SIZE
+from send_queue import ThreadSendQueue, SLOW_CLIENT_POLICIES
+from numpy_cells import NumpyCells
+from sharded_cells import ShardedCells
 from enums import Events
+from spatial_grid import SpatialGrid
+from chunks import ChunkMap
+from token_bucket import TokenBucket
+from recorder import Recorder
+from checkpoint import Checkpoint, CheckpointWriter, read_checkpoint
+from datagrams import DatagramChannel, HELLO, INPUT, MAX_DATAGRAM_SIZE, STATE_HEADER, unpack_client_datagram
+import instrumentation
 
 
 HOST = "127.0.0.1"
@@ -12,118 +32,220 @@ PORT = 9999
 
 CELL_COUNT = 2000
 MAP_SIZE = 8000
+MAX_PLAYERS = 0  # players in the world at once, 0 is no limit
 PLAYER_SPAWN_RADIUS = 35
+PLAYER_POOL_SIZE = 256  # Player objects kept for reuse, joins allocate new ones when the pool is empty
 CELL_RADIUS = 10
+GRID_BUCKET_SIZE = 200
+CHUNK_SIZE = 250  # cells are streamed to clients in square chunks, nearest ones first
+CHUNK_CELLS_PER_SNAPSHOT = 2000  # cells of newly visible chunks sent with one snapshot, at least one chunk
+CELL_BACKENDS = ("python", "numpy", "sharded")
+CELL_BACKEND = "python"  # numpy keeps cells in arrays and eats them in one vectorized pass per tick
+SHARDS = 4  # worker processes of sharded cell backend, each owns the cells of one map strip
+
+# area of interest, clients only get updates for entities inside their view (client window) + margin
+VIEW_WIDTH = 1280
+VIEW_HEIGHT = 720
+VIEW_MARGIN = 200
+
+# outbound queues, clients with more queued event bytes are treated as slow
+MAX_QUEUED_BYTES = 256 * 1024
+SLOW_CLIENT_POLICY = "drop"  # one of SLOW_CLIENT_POLICIES
+
+TICK_RATE = 30  # simulation ticks per second
+SNAPSHOT_RATE = 30  # world snapshots per second (at most TICK_RATE), clients interpolate between them
+MOVE_STEPS_PER_SECOND = 30  # movement steps per second, same as client FPS (client predicts one step per frame)
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+LOG_LEVEL = "WARNING"  # INFO logs joins and disconnects, DEBUG every eaten cell and collision
+STATS_INTERVAL = 0  # seconds between stats dumps (tick timings, lock waits, events sent), 0 is off
+SEED = None  # world seed, same seed and inputs give the same game
+CHECKPOINT_INTERVAL = 1  # seconds between world checkpoints written with --checkpoint
+RESUME_TIMEOUT = 30  # seconds players of a restored checkpoint wait for their clients, then they are dropped
+STANDBY_POLL_INTERVAL = 0.1  # seconds between a standby's attempts to take over the port
+REFRESH_BLOCK_CELLS = 16  # cells compared at once when a standby looks for cells changed between checkpoints
 
 VALID_USERNAME_CHARACTERS = r"^[a-zA-Z\d _-]+$"
 INVALID_USERNAME_MESSAGE = "Invalid username. Valid characters are: letters, digits, ` `, `_`, `-`"
 USERNAME_MAX_LENGTH = 50
 USERNAME_MIN_LENGTH = 1
 
+# wire formats for position updates, client can ask for one with `/protocol <name>` instead of username
+PROTOCOLS = ("standard", "compact")
+# movement input messages, `/input sequenced` switches to (seq, mouse_x, mouse_y) acknowledged with INPUT_ACK
+INPUT_MODES = ("plain", "sequenced")
+INPUT_FORMATS = {"plain": "ff", "sequenced": "Iff"}
+INPUT_COUNTERS = ("received", "throttled", "dropped", "clamped", "stale")  # Player.inputs_<counter>, in stats
+# `/transport udp` asks for a UDP channel for inputs and player positions, it needs sequenced input
+TRANSPORTS = ("tcp", "udp")
+UDP = True  # the server opens a UDP socket for clients asking for it
+# `/world` asks for the map and cell settings, clients of servers without it keep their defaults
+# `/session` asks for a token, after a restart from a checkpoint or a standby taking over, `/resume <token>`
+# instead of username gets the player back
+QUIT_INPUT = 999999  # mouse_x of the message a client sends when it quits
+
+# input messages per second a client may send on average (client sends 60), the rest is throttled
+INPUT_RATE = 120
+INPUT_BURST = 60
+
+log = logging.getLogger("server")
+stats_log = logging.getLogger("server.stats")
+
 cells = {} 
-cells_lock = Lock()  # OK
+cell_store = None  # NumpyCells or ShardedCells, used instead of cells with numpy and sharded cell backends
+cells_grid = SpatialGrid(GRID_BUCKET_SIZE)  # cell keys, guarded by cells_lock
+cell_image = CellImage(CELL_COUNT)  # encoded POST cells records of all cells, guarded by cells_lock
+cells_lock = instrumentation.timed_lock("cells_lock")  # OK
+cell_changes = []  # (key, pos_x, pos_y, color) since last tick, guarded by cells_lock
+chunk_map = ChunkMap(MAP_SIZE, CHUNK_SIZE)
+cell_chunks = array('I')  # chunk of every cell as of the last snapshot, guarded by cells_lock
 
 players = {}  # player_name, player_obj
-players_lock = Lock()  # OK
+players_grid = SpatialGrid(GRID_BUCKET_SIZE)  # player objects, guarded by players_lock
+players_lock = instrumentation.timed_lock("players_lock")  # OK
+player_pool = []  # Player objects of players that left, reused by spawn_player, guarded by players_lock
+retired_players = []  # left since the last tick, which may still use them, guarded by players_lock
+
+connections = {}  # client_id, send queue
+connections_lock = instrumentation.timed_lock("connections_lock") # OK
 
-connections = {}  # client_id, conn
-connections_lock = Lock() # OK
+moved_since_snapshot = set()  # players moved or grown since the last snapshot, used by the game loop only
+tick_count = 0  # ticks simulated so far, guarded by players_lock
+tick_lock = Lock()  # held by the game loop thread while it simulates a tick
+tick_ms_average = 0  # moving average of simulate_tick duration, used for arena placement
+
+cell_rng = random.Random()  # cell positions and colors, used by the game loop only
+player_rng = random.Random()  # player colors, guarded by players_lock
+recorder = None  # Recorder of joins, inputs and quits when the session is recorded
+checkpoint_writer = None  # CheckpointWriter when checkpoints are on
+next_checkpoint = 0  # perf_counter time of the next checkpoint, used by the game loop only
+resumable_players = {}  # session token, restored player waiting for its client, guarded by players_lock
+resume_deadline = 0  # monotonic time restored players are dropped at
+
+datagram_port = None  # port of the UDP channel socket, None when UDP is off
+datagram_tokens = {}  # token, player whose client has not sent HELLO yet, guarded by connections_lock
+datagram_players = {}  # client UDP address, player, guarded by connections_lock
 
 
 def notify_all_clients(*data, event: int, format: str | None = "", current_client_id: int | None = None, packed_data: bytes | None = None):
     with connections_lock:
-        for key, conn in connections.items():
-            send_event = event
+        send_queues = list(connections.items())
 
-            if send_event == Events.CELL_EATEN.code and key == current_client_id:
-                send_event = Events.CELL_EATEN_BY_CURRENT_PLAYER.code
+    packed_events = {}  # event code, the event packed once for all clients getting it
+    for key, conn in send_queues:
+        send_event = event
 
-            elif send_event in (Events.PLAYER_MOVED.code, Events.NEW_PLAYER.code) and key == current_client_id:
-                continue
+        if send_event == Events.CELL_EATEN.code and key == current_client_id:
+            send_event = Events.CELL_EATEN_BY_CURRENT_PLAYER.code
+
+        elif send_event in (Events.PLAYER_MOVED.code, Events.NEW_PLAYER.code) and key == current_client_id:
+            continue
+
+        elif send_event == Events.PLAYER_EATEN.code and key == current_client_id:
+            send_event = Events.PLAYER_EATEN_BY_CURRENT_PLAYER.code
+            
+        packed_event = packed_events.get(send_event)
+        if packed_event is None:
+            packed_event = packed_events[send_event] = pack_event(
+                *data, event=send_event, format=format, packed_data=packed_data)
+        try:
+            conn.sendall(packed_event)
+        except ConnectionError:
+            # queue of a client that is disconnecting
+            continue
 
-            elif send_event == Events.PLAYER_EATEN.code and key == current_client_id:
-                send_event = Events.PLAYER_EATEN_BY_CURRENT_PLAYER.code
-                
-            notify_client(*data, conn=conn, event=send_event, format=format, packed_data=packed_data)
 
 class CellData():
+    __slots__ = ("color", "pos_x", "pos_y")
+
     def __init__(self, x, y, color):
         self.color = color
         self.pos_x = x
         self.pos_y = y
 
 class Player(CellData):
+    __slots__ = ("client_id", "radius", "username", "conn", "is_alive", "input_x", "input_y", "input_seq",
+                 "applied_input_seq", "acked_input_seq", "input_mode", "inputs_received", "inputs_throttled",
+                 "inputs_dropped", "inputs_clamped", "inputs_stale", "input_limiter", "datagram_token",
+                 "datagram_address", "known_players", "known_chunks", "protocol", "session_token")
+
     def __init__(self, client_id, x, y, color, name, conn):
+        self.input_limiter = TokenBucket(INPUT_RATE, INPUT_BURST)
+        self.reset(client_id, x, y, color, name, conn)
+
+    def reset(self, client_id, x, y, color, name, conn):
+        '''Sets every field for a new player, pooled objects of players that left are reused this way'''
         super().__init__(x, y, color)
         self.client_id = client_id
         self.radius = PLAYER_SPAWN_RADIUS
         self.username = name
         self.conn = conn
         self.is_alive = True
+        self.input_x = 0  # latest mouse vector, written by the connection thread
+        self.input_y = 0
+        self.input_seq = 0  # sequence number of the latest input, written after input_x and input_y
+        self.applied_input_seq = 0  # latest input used by move()
+        self.acked_input_seq = None  # latest input acknowledged to the client
+        self.input_mode = "plain"
+        self.inputs_received = 0
+        self.inputs_throttled = 0  # over INPUT_RATE, discarded
+        self.inputs_dropped = 0  # not finite numbers, discarded
+        self.inputs_clamped = 0  # longer than MAX_MOUSE_DISTANCE
+        self.inputs_stale = 0  # UDP inputs arriving after a newer one, discarded
+        self.input_limiter.reset()
+        self.datagram_token = None  # from `/transport udp`, the client sends it in HELLO
+        self.datagram_address = None  # client UDP address after HELLO
+        self.known_players = None  # client ids the client knows about, None until initial sync
+        self.known_chunks = None  # chunks the client has the cells of
+        self.protocol = "standard"
+        self.session_token = None  # from `/session`, kept in checkpoints so the client can resume the player
+
+    def view_rect(self):
+        half_width = VIEW_WIDTH / 2 + VIEW_MARGIN
+        half_height = VIEW_HEIGHT / 2 + VIEW_MARGIN
+        return (self.pos_x - half_width, self.pos_y - half_height,
+                self.pos_x + half_width, self.pos_y + half_height)
+
+    def move(self, dt):
+        '''Integrates latest input over dt seconds, returns True if position changed'''
+        # read before the vector, so a newer vector is never acknowledged with an older sequence number
+        self.applied_input_seq = self.input_seq
+        if self.input_x == 0 and self.input_y == 0:
+            return False
+
+        steps = dt * MOVE_STEPS_PER_SECOND
+        # on the map, where the compact protocol can send it
+        pos_x = clamp_position(self.pos_x + (self.input_x / self.radius / 2) * steps, MAP_SIZE)
+        pos_y = clamp_position(self.pos_y + (self.input_y / self.radius / 2) * steps, MAP_SIZE)
+        if pos_x == self.pos_x and pos_y == self.pos_y:
+            return False
+        self.pos_x, self.pos_y = pos_x, pos_y
+        return True
 
     def collision_check(self):
+        # numpy cell backend eats cells for all players at once in simulate_tick,
+        # players eat each other in find_kills after all cells are eaten
+        if cell_store is None:
+            self.eat_cells()
+
+    def eat_cells(self):
         cells_to_reuse = []
         
-        # TODO: if too slow try changing iteration strategy
-        # 1 map batches - only ~1000 closest  // not now
-        # keys are natural nums, so while loop will be ok also
-        # --> always same num of cells, just change pos (send new pos for id)
-        # => acquring lock on one item, not the whole map :)
+        # only cells from grid buckets overlapping the player are checked
         with cells_lock:
-            for key, cell in cells.items():
+            for key in cells_grid.query(self.pos_x, self.pos_y, self.radius + CELL_RADIUS):
+                cell = cells[key]
                 if self._collides_with(cell):
                     new_pos_x, new_pos_y, new_color = self._generate_new_cell_values(cell)
                     cells_to_reuse.append((key, new_pos_x, new_pos_y, new_color))
-                    notify_all_clients(
-                        key, new_pos_x, new_pos_y, new_color,
-                        format=Events.CELL_EATEN.format, current_client_id=self.client_id, event=Events.CELL_EATEN.code)
-            
                     self.radius += 0.5
 
             for new_cell_values in cells_to_reuse:
                 self._reuse_cell(new_cell_values)
-        
-        
-        with players_lock:
-            remove_players = []
-            for other_player in players.values():
-                if other_player.client_id == self.client_id:
-                    continue
-
-                if self._collides_with(other_player):
-                    print(f"Player collision: {other_player.username}" )
-                    winner, defeated = None, None
-                    if self.radius > other_player.radius * 1.15:
-                        winner = self
-                        defeated = other_player
-                    elif other_player.radius > self.radius * 1.15:
-                        winner = other_player
-                        defeated = self
-                    else:
-                        continue
-
-                    if winner == self:
-                        winner.radius += defeated.radius
-                        defeated.is_alive = False
-
-                        print(f"Player {defeated.username} was eaten by {winner.username}.")
-                        with connections_lock:
-                            print(f"REMOVED: {defeated.client_id}")
-                            connections.pop(defeated.client_id)
-                        
-                        notify_client(conn=defeated.conn, format=Events.GAME_OVER.format, event=Events.GAME_OVER.code)
-                        
-                        notify_all_clients(
-                            defeated.client_id, winner.client_id, winner.radius, current_client_id=winner.client_id, format=Events.PLAYER_EATEN.format, event=Events.PLAYER_EATEN.code)
-                    
-                    
-                    remove_players.append(defeated)
-            
-            for player in remove_players:
-                players.pop(player.username, None)
 
+            # sent to clients with the next world snapshot
+            cell_changes.extend(cells_to_reuse)
 
-                    
     def _calculate_distance(self, cell):
         '''Returns distance between origins of two cells'''
         return (cell.pos_x - self.pos_x) ** 2 + (cell.pos_y - self.pos_y) ** 2
@@ -135,18 +257,16 @@ class Player(CellData):
         return self._calculate_distance(other_player) < (other_player.radius * 0.5 + self.radius * 0.5) ** 2
     
     def _generate_new_cell_values(self, cell):
-            new_pos_x, new_pos_y = random.randint(0, MAP_SIZE), random.randint(0, MAP_SIZE)
+            new_pos_x, new_pos_y = cell_rng.randint(0, MAP_SIZE), cell_rng.randint(0, MAP_SIZE)
 
             new_color = encode_color(
-                random.randint(0, 255),
-                random.randint(0, 255),
-                random.randint(0, 255)
+                cell_rng.randint(0, 255),
+                cell_rng.randint(0, 255),
+                cell_rng.randint(0, 255)
             )
             
-            print(f"Player: {self.pos_x}, {self.pos_y}, Cell: ",
-                    cell.pos_x, cell.pos_y)
-
-            print("New cell: ", (new_pos_x, new_pos_y, new_color))
+            log.debug("Player: %s, %s, Cell: %s %s, New cell: %s",
+                      self.pos_x, self.pos_y, cell.pos_x, cell.pos_y, (new_pos_x, new_pos_y, new_color))
 
             return new_pos_x, new_pos_y, new_color
     
@@ -156,22 +276,356 @@ class Player(CellData):
         cell.pos_x = new_pos_x
         cell.pos_y = new_pos_y
         cell.color = new_color
+        cells_grid.move(key, new_pos_x, new_pos_y)
+        cell_image.update(key, new_pos_x, new_pos_y, new_color)
+
+
+
+def broadcast_world_snapshot(moved_players):
+    '''Queues view updates of one tick for every connection
+
+    Each client gets enter/leave events for players crossing its view and for chunks
+    leaving it, moved players, changed cells of known chunks and the cells of newly
+    visible chunks go to the snapshot state of its send queue, which the writer sends
+    as one WORLD_SNAPSHOT or COMPACT_SNAPSHOT.
+    '''
+    with connections_lock:
+        send_queues = connections.copy()
+
+    moved_ids = {player.client_id for player in moved_players}
+
+    # send queues don't block, so they can be filled while holding game state locks
+    with players_lock:
+        viewers = [player for player in players.values()
+                   if player.client_id in send_queues and player.known_players is not None]
+
+        for viewer in viewers:
+            send_queue = send_queues[viewer.client_id]
+            visible = {player.client_id: player for player in players_grid.query_rect(*viewer.view_rect())}
+            snapshot_players = []
+            try:
+                for client_id, player in visible.items():
+                    if client_id not in viewer.known_players:
+                        send_queue.sendall(pack_event(event=Events.PLAYER_ENTERED_VIEW.code,
+                                                      packed_data=pack_player(player, add_length=True)))
+                    elif client_id in moved_ids:
+                        snapshot_players.append((client_id, player.pos_x, player.pos_y, player.radius))
+
+                for client_id in viewer.known_players - visible.keys():
+                    send_queue.put_player_left(client_id)
+            except ConnectionError:
+                # connection thread cleans up closed connections
+                continue
+
+            viewer.known_players = set(visible)
+            send_queue.put_snapshot(snapshot_players, [])
+
+            # authoritative position after the inputs the client sent so far, for its prediction
+            if viewer.input_mode == "sequenced" and (
+                    viewer.client_id in moved_ids or viewer.applied_input_seq != viewer.acked_input_seq):
+                send_queue.put_input_ack(viewer.applied_input_seq, viewer.pos_x, viewer.pos_y)
+                viewer.acked_input_seq = viewer.applied_input_seq
+
+    with cells_lock:
+        # latest values of every changed cell, with the chunk clients saw it in before
+        moved_cells = []  # (old chunk, new chunk, record)
+        for record in {change[0]: change for change in cell_changes}.values():
+            new_chunk = chunk_map.index(record[1], record[2])
+            moved_cells.append((cell_chunks[record[0]], new_chunk, record))
+            cell_chunks[record[0]] = new_chunk
+        cell_changes.clear()
+
+        for viewer in viewers:
+            send_queue = send_queues[viewer.client_id]
+            visible_chunks = set(chunk_map.indexes_in_rect(*viewer.view_rect()))
+            known_chunks = viewer.known_chunks & visible_chunks
+
+            snapshot_cells = []
+            try:
+                for chunk in viewer.known_chunks - visible_chunks:
+                    send_queue.put_chunk_left(chunk, chunk_map)
+                for old_chunk, new_chunk, record in moved_cells:
+                    if new_chunk in known_chunks:
+                        snapshot_cells.append(record)
+                    elif old_chunk in known_chunks:
+                        send_queue.put_cell_left(record[0])
+            except ConnectionError:
+                continue
+
+            # the rest of the view follows with the next snapshots, so joins and fast moves don't burst,
+            # a backed up client gets no new chunks until it catches up
+            new_chunks = []
+            chunk_cells_sent = 0
+            new_chunk_limit = 0 if send_queue.is_backed_up() else CHUNK_CELLS_PER_SNAPSHOT
+            for chunk in sorted(visible_chunks - known_chunks,
+                                key=lambda chunk: chunk_map.distance(chunk, viewer.pos_x, viewer.pos_y)):
+                if chunk_cells_sent >= new_chunk_limit:
+                    break
+                records = chunk_records(chunk)
+                snapshot_cells.extend(records)
+                chunk_cells_sent += len(records)
+                new_chunks.append(chunk)
+
+            # cells are queued even for a backed up client, only a closed queue refuses them
+            if send_queue.put_snapshot([], snapshot_cells):
+                known_chunks.update(new_chunks)
+            viewer.known_chunks = known_chunks
+
+
+def cell_records(keys):
+    '''Returns (key, pos_x, pos_y, color) of cells, caller holds cells_lock'''
+    if cell_store is not None:
+        return cell_store.values(list(keys))
+
+    return [(key, cells[key].pos_x, cells[key].pos_y, cells[key].color) for key in keys]
+
+
+def chunk_records(chunk):
+    '''Returns (key, pos_x, pos_y, color) of the cells in a chunk as of the last snapshot, caller holds cells_lock
+
+    Cells that moved since are sorted out by the next snapshot, like the ones clients already have.
+    '''
+    return cell_records([key for key in cells_grid.query_rect(*chunk_map.rect(chunk)) if cell_chunks[key] == chunk])
+
+
+def eat_cells_vectorized(tick_players):
+    '''Cell collisions of all players in one pass over the cell store'''
+    alive_players = [player for player in tick_players if player.is_alive]
+    with cells_lock:
+        eaten_keys, eater_indexes = cell_store.eat(
+            [player.pos_x for player in alive_players],
+            [player.pos_y for player in alive_players],
+            [CELL_RADIUS * 0.9 + player.radius for player in alive_players])
+        if not eaten_keys:
+            return
+
+        new_cell_values = cell_store.values(eaten_keys)
+        for key, new_pos_x, new_pos_y, new_color in new_cell_values:
+            cells_grid.move(key, new_pos_x, new_pos_y)
+            cell_image.update(key, new_pos_x, new_pos_y, new_color)
+
+        # sent to clients with the next world snapshot
+        cell_changes.extend(new_cell_values)
 
+    for index in eater_indexes:
+        alive_players[index].radius += 0.5
 
 
-def main():
-    print("Server is running.")
-    init_game()
-    player_counter = 0
-    print("Initialized game.")
+def find_kills(tick_players):
+    '''Player-vs-player kills of one tick as (winner, defeated) pairs in the order they happen
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
+    Works on a copy of positions, radiuses and neighbours taken under players_lock,
+    a player eats every player 15% smaller whose center it covers and grows with each kill.
+    '''
+    with players_lock:
+        alive_players = [player for player in tick_players if player.is_alive]
+        positions = {player: (player.pos_x, player.pos_y) for player in alive_players}
+        radiuses = {player: player.radius for player in alive_players}
+        # sorted, so the same inputs always resolve collisions in the same order
+        neighbours = {player: sorted(players_grid.query(player.pos_x, player.pos_y, player.radius + CELL_RADIUS),
+                                     key=lambda other_player: other_player.client_id)
+                      for player in alive_players}
+
+    kills = []
+    for player in alive_players:
+        if player not in radiuses:
+            continue  # eaten earlier in this tick
+        pos_x, pos_y = positions[player]
+        for other_player in neighbours[player]:
+            if other_player is player or other_player not in radiuses:
+                continue
+
+            other_x, other_y = positions[other_player]
+            if ((other_x - pos_x) ** 2 + (other_y - pos_y) ** 2 < (CELL_RADIUS * 0.9 + radiuses[player]) ** 2
+                    and radiuses[player] > radiuses[other_player] * 1.15):
+                radiuses[player] += radiuses.pop(other_player)
+                kills.append((player, other_player))
+    return kills
+
+
+def in_game(player):
+    '''Caller holds players_lock'''
+    return player.is_alive and players.get(player.username) is player
+
+
+def apply_kill(winner, defeated):
+    '''Removes defeated from game state and connections, returns False if one of the players already left'''
+    with players_lock:
+        if not (in_game(winner) and in_game(defeated)):
+            return False
+        winner.radius += defeated.radius
+        winner_radius = winner.radius
+        defeated.is_alive = False
+        players.pop(defeated.username)
+        players_grid.remove(defeated)
+
+    with connections_lock:
+        # not registered yet or already disconnecting, its connection thread sees is_alive and stops
+        send_queue = connections.pop(defeated.client_id, None)
+        forget_datagrams(defeated)
+
+    log.info("Player %s was eaten by %s.", defeated.username, winner.username)
+
+    # events are queued after game state locks are released
+    if send_queue is not None:
+        try:
+            notify_client(conn=send_queue, format=Events.GAME_OVER.format, event=Events.GAME_OVER.code)
+        except ConnectionError as e:
+            log.warning("Error sending game over: %s", e)
+
+    notify_all_clients(defeated.client_id, winner.client_id, winner_radius, current_client_id=winner.client_id,
+                       format=Events.PLAYER_EATEN.format, event=Events.PLAYER_EATEN.code)
+    return True
+
+
+def simulate_tick(dt, broadcast=True):
+    '''Runs one tick, changes are collected until a tick with broadcast sends them'''
+    global tick_count, tick_ms_average
+    tick_start = time.perf_counter()
+    moved_players = set()
+    with players_lock:
+        tick_count += 1
+        if retired_players:
+            # the tick that may have used them is over
+            moved_since_snapshot.difference_update(retired_players)
+            player_pool.extend(retired_players[:PLAYER_POOL_SIZE - len(player_pool)])
+            retired_players.clear()
+        tick_players = list(players.values())
+        for player in tick_players:
+            if player.move(dt):
+                players_grid.move(player, player.pos_x, player.pos_y)
+                moved_players.add(player)
+
+    collision_start = time.perf_counter()
+    radiuses = {player: player.radius for player in tick_players}
+    if cell_store is not None:
+        eat_cells_vectorized(tick_players)
+
+    for player in tick_players:
+        if player.is_alive:
+            player.collision_check()
+
+    for winner, defeated in find_kills(tick_players):
+        apply_kill(winner, defeated)
+
+    moved_players.update(player for player in tick_players
+                         if player.is_alive and player.radius != radiuses[player])
+
+    broadcast_start = time.perf_counter()
+    moved_since_snapshot.update(moved_players)
+    if broadcast:
+        broadcast_world_snapshot([player for player in moved_since_snapshot if player.is_alive])
+        moved_since_snapshot.clear()
+        if checkpoint_writer is not None and time.perf_counter() >= next_checkpoint:
+            take_checkpoint()
+
+    tick_end = time.perf_counter()
+    tick_ms_average += ((tick_end - tick_start) * 1000 - tick_ms_average) * 0.1
+    instrumentation.tick_phases["move"].add_seconds(collision_start - tick_start)
+    instrumentation.tick_phases["collision"].add_seconds(broadcast_start - collision_start)
+    if broadcast:
+        instrumentation.tick_phases["broadcast"].add_seconds(tick_end - broadcast_start)
+    instrumentation.tick_phases["total"].add_seconds(tick_end - tick_start)
+
+
+def take_checkpoint():
+    '''Copies the world for the checkpoint writer, called right after a broadcast when no cell change is pending'''
+    global next_checkpoint
+    next_checkpoint = time.perf_counter() + CHECKPOINT_INTERVAL
+    with players_lock:
+        expire_sessions()
+        # players of clients that didn't ask for a session can't be resumed
+        checkpoint_players = [
+            (player.client_id, player.pos_x, player.pos_y, player.radius, player.color, player.session_token,
+             player.username)
+            for player in (*players.values(), *resumable_players.values()) if player.session_token is not None]
+        tick = tick_count
+    with cells_lock:
+        cells_data = bytes(cell_image.buffer)
+        chunks_data = cell_chunks.tobytes()
+    checkpoint_writer.submit(Checkpoint(tick, MAP_SIZE, CHUNK_SIZE, cells_data, chunks_data, checkpoint_players))
+
+
+def dump_stats():
+    '''Logs stats collected since the last dump as one JSON line'''
+    report = instrumentation.stats(reset=True)
+    if checkpoint_writer is not None:
+        report["checkpoint_write_ms"] = round(checkpoint_writer.write_seconds * 1000, 3)
+    with players_lock:
+        report["players"] = len(players)
+
+    # totals over the current connections, since each of them connected, and the worst client
+    queues = list(send_queue_metrics().values())
+    report["connections"] = len(queues)
+    report["send_queues"] = {
+        "queued_bytes": sum(metrics["queued_bytes"] for metrics in queues),
+        "queued_events": sum(metrics["queued_events"] for metrics in queues),
+        "max_queued_bytes": max((metrics["max_queued_bytes"] for metrics in queues), default=0),
+        "bytes_sent": sum(metrics["bytes_sent"] for metrics in queues),
+        "bytes_dropped": sum(metrics["bytes_dropped"] for metrics in queues),
+        "max_bytes_dropped": max((metrics["bytes_dropped"] for metrics in queues), default=0),
+    }
+    inputs = list(input_metrics().values())
+    report["inputs"] = {counter: sum(counts[counter] for counts in inputs) for counter in INPUT_COUNTERS}
+    report["inputs"]["max_throttled"] = max((counts["throttled"] for counts in inputs), default=0)
+    stats_log.info(json.dumps(report))
+
+
+def ticks_per_snapshot(tick_rate):
+    return max(1, round(tick_rate / SNAPSHOT_RATE))
+
+
+def game_loop(tick_rate):
+    tick_interval = 1 / tick_rate
+    snapshot_interval = ticks_per_snapshot(tick_rate)
+    next_tick = time.perf_counter()
+    next_stats = next_tick + STATS_INTERVAL
+    tick = 0
+
+    while True:
+        tick += 1
+        with tick_lock:
+            simulate_tick(tick_interval, broadcast=tick % snapshot_interval == 0)
+
+        if STATS_INTERVAL and time.perf_counter() >= next_stats:
+            dump_stats()
+            next_stats += STATS_INTERVAL
+
+        next_tick += tick_interval
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # tick took too long, don't try to catch up
+            next_tick = time.perf_counter()
+
+
+def main(host=HOST, port=PORT, tick_rate=TICK_RATE, record=None, checkpoint=None, restore=False, standby=False,
+         **settings):
+    '''settings are the keyword arguments of configure'''
+    configure(**settings)
+
+    log.info("Server is running.")
+    if record:
+        start_recording(record, tick_rate)
+    listener, player_counter = start_game(host, port, checkpoint, restore, standby)
+    if listener is None:
+        listener = open_listening_socket(host, port)
+    log.info("Initialized game.")
+
+    Thread(target=game_loop, args=(tick_rate,), daemon=True).start()
+    log.info("Game loop running at %d ticks per second.", tick_rate)
+
+    # same port number as TCP, clients learn it from the `/transport udp` answer anyway
+    if UDP and (udp_socket := open_datagram_socket(host, port)) is not None:
+        Thread(target=receive_datagrams, args=(udp_socket,), daemon=True).start()
+
+    with listener as s:
         s.listen()
 
         while (True):
             conn, addr = s.accept()
-            print(f"Connected with: {addr}")
+            log.info("Connected with: %s", addr)
             player_counter += 1
             client_id = player_counter
 
@@ -179,20 +633,261 @@ def main():
             t.start()
 
 
-def init_game():
-    # spawn point cells
-    for i in range(CELL_COUNT):
-        new_cell = CellData(
-            random.randint(0, MAP_SIZE),
-            random.randint(0, MAP_SIZE),
-            encode_color(
-                random.randint(0, 255),
-                random.randint(0, 255),
-                random.randint(0, 255)
-            ),
-        )
-        
-        cells[i] = new_cell
+def configure(max_queued_bytes=MAX_QUEUED_BYTES, slow_client_policy=SLOW_CLIENT_POLICY, cell_backend=CELL_BACKEND,
+              shards=SHARDS, snapshot_rate=SNAPSHOT_RATE, input_rate=INPUT_RATE, log_level=LOG_LEVEL,
+              stats_interval=STATS_INTERVAL, seed=SEED, udp=UDP, map_size=MAP_SIZE, cell_count=CELL_COUNT,
+              chunk_size=CHUNK_SIZE):
+    '''Sets the settings both servers take from the command line'''
+    global MAX_QUEUED_BYTES, SLOW_CLIENT_POLICY, CELL_BACKEND, SHARDS, SNAPSHOT_RATE, INPUT_RATE, STATS_INTERVAL, SEED
+    global UDP, MAP_SIZE, CELL_COUNT, CHUNK_SIZE
+    MAX_QUEUED_BYTES = max_queued_bytes
+    SLOW_CLIENT_POLICY = slow_client_policy
+    CELL_BACKEND = cell_backend
+    SHARDS = shards
+    SNAPSHOT_RATE = snapshot_rate
+    INPUT_RATE = input_rate
+    STATS_INTERVAL = stats_interval
+    SEED = seed
+    UDP = udp
+    MAP_SIZE = map_size
+    CELL_COUNT = cell_count
+    CHUNK_SIZE = chunk_size
+    configure_logging(log_level)
+
+
+def start_game(host, port, checkpoint=None, restore=False, standby=False):
+    '''Spawns, restores or stands by for the world, returns (listening socket or None, highest client id so far)
+
+    Only a standby has the socket already, it binds it to notice the server it replaces is gone.
+    '''
+    global checkpoint_writer
+    listener = None
+    if standby:
+        listener, player_counter = run_standby(checkpoint, host, port)
+    elif restore:
+        player_counter = restore_game(checkpoint)
+    else:
+        init_game()
+        player_counter = 0
+    if checkpoint:
+        checkpoint_writer = CheckpointWriter(checkpoint)
+    return listener, player_counter
+
+
+def open_listening_socket(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # connections of a killed server may still be in TIME_WAIT when it is restarted
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind((host, port))
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def configure_logging(log_level):
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if STATS_INTERVAL:
+        stats_log.setLevel(logging.INFO)  # asking for stats turns them on at any log level
+
+
+def start_recording(path, tick_rate):
+    '''Records the session to path, a replay needs the seed so one is picked if none was given'''
+    global SEED, recorder
+    if SEED is None:
+        SEED = random.getrandbits(32)
+    recorder = Recorder(path, CELL_BACKEND, SHARDS, tick_rate, SNAPSHOT_RATE, CELL_COUNT, MAP_SIZE, SEED)
+    atexit.register(stop_recording)
+    log.info("Recording session to %s, seed %d.", path, SEED)
+
+
+def stop_recording():
+    # the final state is only consistent between ticks
+    with tick_lock, players_lock:
+        recorder.close(tick_count, outcome_digest())
+
+
+def outcome_digest():
+    '''Hash of all cell and player state, equal digests mean two runs ended in the same game'''
+    digest = hashlib.sha256(cell_image.pack())
+    for player in sorted(players.values(), key=lambda player: player.client_id):
+        digest.update(struct.pack('=Iddd', player.client_id, player.pos_x, player.pos_y, player.radius))
+    return digest.digest()
+
+
+def restore_game(path):
+    '''Loads the world of the latest checkpoint in path, returns the highest client id in it
+
+    Without a checkpoint a new world is spawned, like without restoring.
+    '''
+    global MAP_SIZE, CELL_COUNT
+    start = time.perf_counter()
+    checkpoint = read_checkpoint(path)
+    if checkpoint is None:
+        log.warning("No checkpoint in %s, spawning a new world.", path)
+        init_game()
+        return 0
+
+    MAP_SIZE = checkpoint.map_size
+    CELL_COUNT = len(checkpoint.cells) // CELL_RECORD.size
+    init_game(checkpoint)
+    log.info("Restored tick %d with %d cells and %d players in %.1f ms.", checkpoint.tick, CELL_COUNT,
+             len(checkpoint.players), (time.perf_counter() - start) * 1000)
+    return max((player[0] for player in checkpoint.players), default=0)
+
+
+def init_game(checkpoint=None):
+    '''Spawns the cells, or loads them and the players waiting to resume from a checkpoint
+
+    CELL_COUNT, MAP_SIZE and CHUNK_SIZE can be set before calling it, a checkpoint needs the ones it was taken with.
+    '''
+    global cell_store, cell_image, chunk_map, cell_chunks
+
+    cell_image = CellImage(CELL_COUNT)
+    chunk_map = ChunkMap(MAP_SIZE, CHUNK_SIZE)
+    seeds = random.Random(SEED)
+    cell_rng.seed(seeds.getrandbits(32))
+    player_rng.seed(seeds.getrandbits(32))
+
+    if CELL_BACKEND in ("numpy", "sharded"):
+        if CELL_BACKEND == "numpy":
+            cell_store = NumpyCells(CELL_COUNT, MAP_SIZE, GRID_BUCKET_SIZE, seeds.getrandbits(32))
+        else:
+            cell_store = ShardedCells(CELL_COUNT, MAP_SIZE, GRID_BUCKET_SIZE, SHARDS, seeds.getrandbits(32))
+        if checkpoint is not None:
+            cell_store.load(checkpoint.cells)
+        for key, pos_x, pos_y, color in cell_store.values(range(CELL_COUNT)):
+            cells_grid.insert(key, pos_x, pos_y)
+            cell_image.update(key, pos_x, pos_y, color)
+    elif checkpoint is not None:
+        for key, pos_x, pos_y, color in CELL_RECORD.iter_unpack(checkpoint.cells):
+            cells[key] = CellData(int(pos_x), int(pos_y), color)
+            cells_grid.insert(key, pos_x, pos_y)
+        cell_image.buffer[:] = checkpoint.cells
+    else:
+        # spawn point cells
+        for i in range(CELL_COUNT):
+            new_cell = CellData(
+                cell_rng.randint(0, MAP_SIZE),
+                cell_rng.randint(0, MAP_SIZE),
+                encode_color(
+                    cell_rng.randint(0, 255),
+                    cell_rng.randint(0, 255),
+                    cell_rng.randint(0, 255)
+                ),
+            )
+
+            cells[i] = new_cell
+            cells_grid.insert(i, new_cell.pos_x, new_cell.pos_y)
+            cell_image.update(i, new_cell.pos_x, new_cell.pos_y, new_cell.color)
+
+    if checkpoint is not None and checkpoint.chunk_size == CHUNK_SIZE:
+        cell_chunks = array('I', checkpoint.cell_chunks)
+    else:
+        cell_chunks = array('I', (chunk_map.index(pos_x, pos_y) for _, pos_x, pos_y, _ in cell_records(range(CELL_COUNT))))
+    if checkpoint is not None:
+        restore_players(checkpoint)
+
+
+def restore_players(checkpoint):
+    '''Replaces the players waiting to resume with the ones of a checkpoint'''
+    global tick_count, resume_deadline
+    # restored players stay out of the world until their clients resume them
+    tick_count = checkpoint.tick
+    with players_lock:
+        resumable_players.clear()
+        for client_id, pos_x, pos_y, radius, color, token, username in checkpoint.players:
+            player = Player(client_id, pos_x, pos_y, color, username, None)
+            player.radius = radius
+            player.session_token = token
+            resumable_players[token] = player
+    resume_deadline = time.monotonic() + RESUME_TIMEOUT
+
+
+def refresh_game(checkpoint):
+    '''Brings a world restored from an earlier checkpoint of the same map up to checkpoint
+
+    Only cells whose records changed are moved, most of the map is the same from one checkpoint to the next.
+    '''
+    block_size = REFRESH_BLOCK_CELLS * CELL_RECORD.size
+    new_cells = checkpoint.cells
+    with cells_lock:
+        old_cells = cell_image.buffer
+        changed = []
+        for start in range(0, len(new_cells), block_size):
+            block = new_cells[start:start + block_size]
+            if old_cells[start:start + block_size] != block:
+                changed.extend(record for record, old_record
+                               in zip(CELL_RECORD.iter_unpack(block),
+                                      CELL_RECORD.iter_unpack(old_cells[start:start + block_size]))
+                               if record != old_record)
+
+        if cell_store is not None:
+            cell_store.load(new_cells, [record[0] for record in changed])
+        for key, pos_x, pos_y, color in changed:
+            if cell_store is None:
+                cell = cells[key]
+                cell.pos_x, cell.pos_y, cell.color = int(pos_x), int(pos_y), color
+            cells_grid.move(key, pos_x, pos_y)
+            cell_chunks[key] = chunk_map.index(pos_x, pos_y)
+        cell_image.buffer[:] = new_cells
+    restore_players(checkpoint)
+    return len(changed)
+
+
+def load_standby_game(checkpoint):
+    '''Replaces the world of the standby with the one of checkpoint'''
+    global MAP_SIZE, CELL_COUNT
+    cells.clear()
+    cells_grid.clear()
+    MAP_SIZE = checkpoint.map_size
+    CELL_COUNT = len(checkpoint.cells) // CELL_RECORD.size
+    init_game(checkpoint)
+
+
+def follow_checkpoint(checkpoint, latest):
+    '''Brings the standby world of checkpoint up to latest, in full if the server writing them was started again'''
+    same_world = (latest.map_size, len(latest.cells)) == (MAP_SIZE, len(checkpoint.cells))
+    if latest.generation == checkpoint.generation and same_world:
+        refresh_game(latest)
+    else:
+        log.info("Checkpoints restarted at tick %d, reloading the world.", latest.tick)
+        load_standby_game(latest)
+
+
+def run_standby(path, host, port):
+    '''Keeps the world of the latest checkpoint in path loaded until the server writing it is gone
+
+    The port is free once that server is gone, binding it is how the standby notices.
+    Returns the bound listening socket and the highest client id in the checkpoint.
+    '''
+    checkpoint = read_checkpoint(path)
+    while checkpoint is None:
+        time.sleep(STANDBY_POLL_INTERVAL)
+        checkpoint = read_checkpoint(path)
+    load_standby_game(checkpoint)
+    log.info("Standing by with tick %d, %d cells, waiting for %s:%d to be free.", checkpoint.tick, CELL_COUNT, host, port)
+
+    while True:
+        try:
+            listener = open_listening_socket(host, port)
+            break
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+        time.sleep(STANDBY_POLL_INTERVAL)
+        if (latest := read_checkpoint(path, checkpoint)) is not None:
+            follow_checkpoint(checkpoint, latest)
+            checkpoint = latest
+
+    start = time.perf_counter()
+    if (latest := read_checkpoint(path, checkpoint)) is not None:
+        follow_checkpoint(checkpoint, latest)
+        checkpoint = latest
+    log.info("Taking over at tick %d with %d players to resume, caught up in %.1f ms.", checkpoint.tick,
+             len(checkpoint.players), (time.perf_counter() - start) * 1000)
+    return listener, max((player[0] for player in checkpoint.players), default=0)
 
 
 def validate_username(username):
@@ -205,17 +900,19 @@ def validate_username(username):
     if not re.match(VALID_USERNAME_CHARACTERS, username):
         return INVALID_USERNAME_MESSAGE
 
-    if username in players:
+    # names of restored players are kept for them until they resume or time out
+    if username in players or any(player.username == username for player in resumable_players.values()):
         return f"Username: {username} is already taken."
 
     return "OK"
 
 
 def spawn_player(client_id, conn, username) -> Player:
+    '''Caller holds players_lock'''
     player_color = encode_color(
-        random.randint(0, 255),
-        random.randint(0, 255),
-        random.randint(0, 255)
+        player_rng.randint(0, 255),
+        player_rng.randint(0, 255),
+        player_rng.randint(0, 255)
     )
 
     # return Player(
@@ -223,95 +920,463 @@ def spawn_player(client_id, conn, username) -> Player:
     #         0, MAP_SIZE), random.randint(0, MAP_SIZE), 
     #     player_color, username, conn)
 
+    if player_pool:
+        player = player_pool.pop()
+        player.reset(client_id, 0, 0, player_color, username, conn)
+        return player
+
     return Player(
         client_id, 0, 0, 
         player_color, username, conn)
 
 
-def handle_player_gameplay(conn, client_id):
-    username = ""
+def cells_for_density(map_size, cell_density):
+    '''Cell count of a map with cell_density cells per 1000x1000 area'''
+    return round(cell_density * (map_size / 1000) ** 2)
 
-    with conn:
-        while True:
-            print("Asking for username...")
-            send_message(conn, "GET username")
-            username = conn.recv(1024).decode('ascii').strip()
-            players_lock.acquire()
-            try:
-                if (msg := validate_username(username)) != "OK":
-                    # TODO: is it ok? maybe use enums for this method?
-                    players_lock.release()
-                    send_message(conn, "ERROR " + msg)
-                    continue
-                else:
-                    # spawn player
-                    # TODO: remove player and cleanup - even if connection was broken
-                    # TODO: make this player inactive until renders
-                    players[username] = spawn_player(client_id, conn, username)
-                    players_lock.release()
-                    print(f"Player {username} has joined the game.")
-                    send_message(conn, "INFO Successfully connected to the game.")
-                    break
-            except:
-                players_lock.release()
-                break
 
-            # TODO: handle no data == null
-            # if not data:
-            #     break
+def send_world_info(conn):
+    '''Answers `/world`, the client sizes its map and chunks from it'''
+    send_message(conn, f"INFO World: map_size={MAP_SIZE} cell_count={CELL_COUNT} cell_radius={CELL_RADIUS} "
+                       f"player_spawn_radius={PLAYER_SPAWN_RADIUS} chunk_size={CHUNK_SIZE}")
 
-        # send init game state
-        send_message(conn, "POST cells")
-        with cells_lock:
-            send_cells(conn, cells)
 
-        # send players (containing current player)
-        send_message(conn, "POST players")
-        with players_lock:
-            send_players(conn, players)
+def open_session(conn):
+    '''Handles `/session` sent instead of username, returns the token the client can resume its player with'''
+    token = secrets.randbits(64)
+    send_message(conn, f"INFO Session: {token}")
+    return token
 
-            # TODO: notify other players about new player
-            player = players[username]
 
-        notify_all_clients(packed_data=pack_player(player, add_length=True), current_client_id=client_id, event=Events.NEW_PLAYER.code)
+def negotiate_protocol(conn, command):
+    '''Handles `/protocol <name>` sent instead of username, returns accepted protocol or None'''
+    requested_protocol = command.removeprefix("/protocol ").strip()
+    if requested_protocol not in PROTOCOLS:
+        send_message(conn, f"ERROR Unknown protocol: {requested_protocol}")
+        return None
+    # clients would put cells in other chunks than the server and drop the wrong ones with CHUNK_LEFT_VIEW
+    if requested_protocol == "compact" and MAP_SIZE > MAX_COMPACT_MAP_SIZE:
+        send_message(conn, f"ERROR Compact protocol needs a map size up to {MAX_COMPACT_MAP_SIZE}")
+        return None
 
-        with connections_lock:
-            connections[client_id] = conn
+    send_message(conn, f"INFO Protocol: {requested_protocol}")
+    return requested_protocol
 
-        while True:
-            data = conn.recv(8)
-            mouse_x, mouse_y = struct.unpack('ff', data)
-
-            # print((mouse_x, mouse_y))
-
-            if mouse_x == 999999:
-                print(f"Player {username} disconnected.")
-                with connections_lock:
-                    connections.pop(client_id)
-                
-                with players_lock:
-                    players.pop(player.username)
-                
-                notify_all_clients(client_id, format=Events.PLAYER_QUIT.format, event=Events.PLAYER_QUIT.code)
-                break
 
-            player.pos_x += (mouse_x / player.radius / 2)
-            player.pos_y += (mouse_y / player.radius / 2)
+def negotiate_input(conn, command):
+    '''Handles `/input <mode>` sent instead of username, returns accepted input mode or None'''
+    requested_mode = command.removeprefix("/input ").strip()
+    if requested_mode not in INPUT_MODES:
+        send_message(conn, f"ERROR Unknown input mode: {requested_mode}")
+        return None
+
+    send_message(conn, f"INFO Input: {requested_mode}")
+    return requested_mode
+
+
+def negotiate_transport(conn, command, input_mode):
+    '''Handles `/transport <name>` sent instead of username, returns the UDP channel token or None'''
+    requested_transport = command.removeprefix("/transport ").strip()
+    if requested_transport not in TRANSPORTS:
+        send_message(conn, f"ERROR Unknown transport: {requested_transport}")
+        return None
+    if requested_transport == "tcp":
+        send_message(conn, "INFO Transport: tcp")
+        return None
+    if datagram_port is None:
+        send_message(conn, "ERROR UDP transport is off")
+        return None
+    if input_mode != "sequenced":
+        # late UDP inputs are told apart by their sequence numbers
+        send_message(conn, "ERROR UDP transport needs sequenced input")
+        return None
+
+    token = secrets.randbits(32)
+    send_message(conn, f"INFO Transport: udp {datagram_port} {token}")
+    return token
+
+
+def join_game(client_id, conn, username, protocol, input_mode="plain"):
+    '''Validates username and spawns player, returns (player, "OK") or (None, error message)'''
+    with players_lock:
+        expire_sessions()
+        if (msg := validate_username(username)) != "OK":
+            return None, msg
+        if MAX_PLAYERS and len(players) >= MAX_PLAYERS:
+            return None, "Game is full"
+
+        # TODO: make this player inactive until renders
+        player = spawn_player(client_id, conn, username)
+        player.protocol = protocol
+        player.input_mode = input_mode
+        players[username] = player
+        players_grid.insert(player, player.pos_x, player.pos_y)
+        if recorder is not None:
+            recorder.join(tick_count, client_id, username, protocol, input_mode)
+
+    log.info("Player %s has joined the game.", username)
+    return player, msg
+
+
+def resume_game(conn, command, protocol, input_mode="plain"):
+    '''Handles `/resume <token>` sent instead of username, returns the restored player like join_game'''
+    token = command.removeprefix("/resume ").strip()
+    with players_lock:
+        expire_sessions()
+        player = resumable_players.pop(int(token), None) if token.isdigit() else None
+        if player is None:
+            return None, "Unknown session"
+
+        player.conn = conn
+        player.protocol = protocol
+        player.input_mode = input_mode
+        players[player.username] = player
+        players_grid.insert(player, player.pos_x, player.pos_y)
+
+    log.info("Player %s has resumed the game.", player.username)
+    return player, "OK"
+
+
+def expire_sessions():
+    '''Drops restored players whose clients didn't resume them in time, caller holds players_lock'''
+    if resumable_players and time.monotonic() > resume_deadline:
+        log.info("%d restored players were not resumed.", len(resumable_players))
+        resumable_players.clear()
+
+
+def send_initial_state(conn, player):
+    # send init game state, cells of the chunk the player is in and players in its view,
+    # the other chunks in view come with the next snapshots
+    # other players see the new player with PLAYER_ENTERED_VIEW on the next tick
+    # data is copied from the encoded world image under the lock and sent after it is released
+    with cells_lock:
+        chunk = chunk_map.index(player.pos_x, player.pos_y)
+        packed_cells = cell_image.pack([record[0] for record in chunk_records(chunk)])
+        player.known_chunks = {chunk}
+    send_message(conn, "POST cells")
+    send_cells(conn, packed_cells)
+
+    # send players (containing current player)
+    with players_lock:
+        visible_players = {other_player.username: other_player
+                           for other_player in players_grid.query_rect(*player.view_rect())}
+        visible_players[player.username] = player
+        packed_players = pack_players(visible_players)
+        player.known_players = {other_player.client_id for other_player in visible_players.values()}
+    send_message(conn, "POST players")
+    send_players(conn, packed_players)
+
+
+def register_connection(player, send_queue):
+    '''From now on everything sent to the player goes through its send queue'''
+    player.conn = send_queue
+    with connections_lock:
+        # apply_kill removes the connection of a player eaten after this check
+        if player.is_alive:
+            connections[player.client_id] = send_queue
+            if player.datagram_token is not None:
+                datagram_tokens[player.datagram_token] = player
+
+
+def forget_datagrams(player):
+    '''Drops the UDP channel of a player leaving the game, caller holds connections_lock'''
+    datagram_tokens.pop(player.datagram_token, None)
+    if datagram_players.get(player.datagram_address) is player:
+        datagram_players.pop(player.datagram_address)
+
+
+def open_datagram_socket(host, port):
+    '''Binds the UDP channel socket, returns None and leaves UDP off if the port is taken'''
+    global datagram_port
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        udp_socket.bind((host, port))
+    except OSError as e:
+        log.warning("UDP transport is off, can't bind %s:%d: %s", host, port, e)
+        udp_socket.close()
+        return None
+
+    datagram_port = udp_socket.getsockname()[1]
+    return udp_socket
+
+
+def receive_datagrams(udp_socket):
+    while True:
+        try:
+            data, address = udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+        except ConnectionResetError:
+            continue  # ICMP port unreachable of a client that is gone, reported on Windows
+        except OSError:
+            return
+        handle_datagram(data, address, udp_socket)
+
+
+def handle_datagram(data, address, transport):
+    '''Handles one datagram of a client UDP channel, transport is what the server sends datagrams with'''
+    kind, values = unpack_client_datagram(data)
+    with connections_lock:
+        player = datagram_players.get(address)
+        if kind == HELLO and player is None:
+            # the token proves the address belongs to the client that negotiated it on TCP
+            player = datagram_tokens.pop(values[0], None)
+            if player is None:
+                return
+            player.datagram_address = address
+            datagram_players[address] = player
+            connections[player.client_id].use_datagrams(DatagramChannel(transport, address))
+            log.info("Player %s bound UDP channel %s.", player.username, address)
+
+    if player is None:
+        return
+    if kind == HELLO:
+        # answered every time, the answer or the HELLO can be lost
+        try:
+            transport.sendto(STATE_HEADER.pack(0), address)
+        except OSError:
+            pass
+    elif kind == INPUT:
+        seq, mouse_x, mouse_y = values
+        player.inputs_received += 1
+        if seq <= player.input_seq:
+            player.inputs_stale += 1
+            return
+        accept_input(player, seq, mouse_x, mouse_y)
+
+
+def send_queue_metrics():
+    with connections_lock:
+        return {client_id: send_queue.metrics() for client_id, send_queue in connections.items()}
+
+
+def input_metrics():
+    with players_lock:
+        return {player.client_id: {counter: getattr(player, f"inputs_{counter}") for counter in INPUT_COUNTERS}
+                for player in players.values()}
+
+
+def apply_input(player, input_format, data):
+    '''Stores one input message as the latest input of the player, returns False if the client quits'''
+    *seq, mouse_x, mouse_y = struct.unpack(input_format, data)
+    if mouse_x == QUIT_INPUT:
+        return False
+
+    player.inputs_received += 1
+    accept_input(player, seq[0] if seq else None, mouse_x, mouse_y)
+    return True
+
+
+def accept_input(player, seq, mouse_x, mouse_y):
+    '''Rate limits, records and stores an input received over TCP or UDP'''
+    if not player.input_limiter.consume():
+        player.inputs_throttled += 1
+        return
+
+    if recorder is None:
+        set_input(player, seq, mouse_x, mouse_y)
+        return
+
+    # game loop moves players under players_lock, so the recorded tick is the one that uses the input
+    with players_lock:
+        set_input(player, seq, mouse_x, mouse_y)
+        recorder.input(tick_count, player.client_id, seq or 0, mouse_x, mouse_y)
+
+
+def set_input(player, seq, mouse_x, mouse_y):
+    '''Validates and clamps the mouse vector, seq is None for plain input'''
+    if not (math.isfinite(mouse_x) and math.isfinite(mouse_y)):
+        player.inputs_dropped += 1
+        return
+
+    if (clamped := clamp_mouse_vector(mouse_x, mouse_y)) != (mouse_x, mouse_y):
+        mouse_x, mouse_y = clamped
+        player.inputs_clamped += 1
+
+    # only the latest input is kept, game loop integrates it on the next tick
+    player.input_x, player.input_y = mouse_x, mouse_y
+    if seq is not None:
+        player.input_seq = seq
+
+
+def remove_player(player):
+    log.info("Player %s disconnected.", player.username)
+    if player.inputs_throttled or player.inputs_dropped:
+        log.warning("Player %s inputs: %d received, %d throttled, %d dropped.", player.username,
+                    player.inputs_received, player.inputs_throttled, player.inputs_dropped)
+    with connections_lock:
+        connections.pop(player.client_id, None)
+        forget_datagrams(player)
+
+    with players_lock:
+        player.is_alive = False
+        # the name can belong to a new player if this one was eaten
+        if players.get(player.username) is player:
+            players.pop(player.username)
+        players_grid.remove(player)
+        if recorder is not None:
+            recorder.quit(tick_count, player.client_id)
+
+    notify_all_clients(player.client_id, format=Events.PLAYER_QUIT.format, event=Events.PLAYER_QUIT.code)
+
+
+def retire_player(player):
+    '''Called by the connection handler of a player that left the game once it doesn't use it anymore'''
+    with players_lock:
+        retired_players.append(player)
+
+
+class Handshake():
+    '''Messages of a connection until its player joins, the same for both servers
+
+    Every message answers `GET username`, with a command or the username.
+    '''
+
+    def __init__(self, conn, client_id):
+        self.conn = conn
+        self.client_id = client_id
+        self.protocol = "standard"
+        self.input_mode = "plain"
+        self.datagram_token = None
+        self.session_token = None
+
+    def handle(self, message):
+        '''Answers one message, returns the player once it joined or resumed, None until then'''
+        # `/` is not valid in usernames, so old clients never send commands
+        if message.startswith("/protocol "):
+            self.protocol = negotiate_protocol(self.conn, message) or self.protocol
+            return None
+        if message.startswith("/input "):
+            self.input_mode = negotiate_input(self.conn, message) or self.input_mode
+            return None
+        if message.startswith("/transport "):
+            self.datagram_token = negotiate_transport(self.conn, message, self.input_mode)
+            return None
+        if message == "/world":
+            send_world_info(self.conn)
+            return None
+        if message == "/session":
+            self.session_token = open_session(self.conn)
+            return None
+
+        if message.startswith("/resume "):
+            player, msg = resume_game(self.conn, message, self.protocol, self.input_mode)
+        else:
+            player, msg = join_game(self.client_id, self.conn, message, self.protocol, self.input_mode)
+            if player is not None:
+                player.session_token = self.session_token
+        if player is None:
+            send_message(self.conn, "ERROR " + msg)
+            return None
+
+        player.datagram_token = self.datagram_token
+        try:
+            send_message(self.conn, "INFO Successfully connected to the game.")
+        except OSError:
+            # the caller never gets the player, so it can't take it out of the world
+            remove_player(player)
+            retire_player(player)
+            raise
+        return player
+
+
+def handle_player_gameplay(conn, client_id):
+    handshake = Handshake(conn, client_id)
+    player = None
+
+    with conn:
+        try:
+            while player is None:
+                log.debug("Asking for username...")
+                send_message(conn, "GET username")
+                data = conn.recv(1024)
+                if not data:
+                    return
+
+                player = handshake.handle(data.decode('ascii').strip())
+
+            send_initial_state(conn, player)
+        except OSError:
+            # connection broke while joining, the player is in the world already
+            if player is not None:
+                remove_player(player)
+                retire_player(player)
+            return
+
+        send_queue = ThreadSendQueue(conn, player.protocol, MAP_SIZE, MAX_QUEUED_BYTES, SLOW_CLIENT_POLICY)
+        register_connection(player, send_queue)
+
+        input_format = INPUT_FORMATS[player.input_mode]
+        input_size = struct.calcsize(input_format)
+        while True:
+            try:
+                data = receive_exact(conn, input_size)
+            except OSError:
+                data = None
 
-            player.collision_check()
             if not player.is_alive:
+                # eaten, the tick that ate it queues GAME_OVER after that, it is over once tick_lock is free
+                with tick_lock:
+                    send_queue.close()
                 break
 
-            # ? TODO: send only if close position (remember about scale)
-            notify_all_clients(client_id, player.pos_x, player.pos_y, player.radius, format=Events.PLAYER_MOVED.format,
-                               current_client_id=client_id, event=Events.PLAYER_MOVED.code)
+            # connection closed or client quit
+            if data is None or not apply_input(player, input_format, data):
+                remove_player(player)
+                send_queue.close()
+                break
+
+        send_queue.wait_closed()
+        retire_player(player)
+
+
+def build_arg_parser(description):
+    '''Command line of both servers, parse_args checks the combinations'''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE, help="simulation ticks per second")
+    parser.add_argument("--max-queued-bytes", type=int, default=MAX_QUEUED_BYTES,
+                        help="outbound bytes per client before it counts as slow")
+    parser.add_argument("--slow-client-policy", choices=SLOW_CLIENT_POLICIES, default=SLOW_CLIENT_POLICY)
+    parser.add_argument("--cell-backend", choices=CELL_BACKENDS, default=CELL_BACKEND)
+    parser.add_argument("--shards", type=int, default=SHARDS, help="worker processes of sharded cell backend")
+    parser.add_argument("--snapshot-rate", type=int, default=SNAPSHOT_RATE, help="world snapshots per second")
+    parser.add_argument("--input-rate", type=int, default=INPUT_RATE, help="input messages per second a client may send")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=LOG_LEVEL)
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between stats dumps, 0 is off")
+    parser.add_argument("--seed", type=int, default=SEED, help="world seed")
+    parser.add_argument("--record", metavar="PATH", help="record joins, inputs and quits for replay.py")
+    parser.add_argument("--no-udp", dest="udp", action="store_false", help="refuse `/transport udp`, TCP only")
+    parser.add_argument("--map-size", type=int, default=MAP_SIZE, help="width and height of the map")
+    parser.add_argument("--cell-count", type=int, default=CELL_COUNT)
+    parser.add_argument("--cell-density", type=float, help="cells per 1000x1000 area, overrides --cell-count")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="side of the map chunks streamed to clients")
+    parser.add_argument("--checkpoint", metavar="PATH", help=f"write the world to PATH every {CHECKPOINT_INTERVAL} s")
+    parser.add_argument("--restore", action="store_true",
+                        help="start from the latest checkpoint in --checkpoint PATH, clients can resume their players")
+    parser.add_argument("--standby", action="store_true",
+                        help="keep the latest checkpoint in --checkpoint PATH loaded and take over when the port is free")
+    return parser
 
-            # print((player.pos_x, player.pos_y))
 
+def parse_args(description):
+    '''Returns the command line as keyword arguments of main'''
+    parser = build_arg_parser(description)
+    args = parser.parse_args()
+    if args.cell_density is not None:
+        args.cell_count = cells_for_density(args.map_size, args.cell_density)
+    if (args.restore or args.standby) and not args.checkpoint:
+        parser.error("--restore and --standby need --checkpoint")
+    if (args.restore or args.standby) and args.record:
+        parser.error("--record can't be used with --restore or --standby, replays start from a new world")
+    if (args.restore or args.standby) and args.cell_backend == "sharded":
+        parser.error("--restore and --standby need the python or numpy cell backend")
+    del args.cell_density
+    return vars(args)
 
 
 if __name__ == "__main__":
-    main()
+    main(**parse_args("Agar.io game server"))
 
 
 # TODO: exception handling, handle random disconnect
@@ -0,0 +1,276 @@
+import argparse
+import atexit
+import multiprocessing
+import random
+import time
+from multiprocessing import shared_memory
+from spatial_grid import SpatialGrid
+
+
+MAX_PLAYERS = 4096  # players sent to one region per tick
+MAX_EATEN = 65536  # cells one region can report per tick, the rest is eaten next tick
+PLAYER_RECORD_SIZE = 4  # floats: player index, pos_x, pos_y, reach
+EATEN_RECORD_SIZE = 2  # uints: cell key, player index
+
+
+class WorldBuffers():
+    '''Shared memory arrays of all cells (pos_x, pos_y, color by key)'''
+
+    def __init__(self, count, name=None):
+        self.count = count
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=count * 12)
+        self.pos_x = self.shm.buf[0:count * 4].cast('f')
+        self.pos_y = self.shm.buf[count * 4:count * 8].cast('f')
+        self.color = self.shm.buf[count * 8:count * 12].cast('I')
+
+    def close(self, unlink=False):
+        self.pos_x.release()
+        self.pos_y.release()
+        self.color.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class RegionBuffers():
+    '''Shared memory for one region: players in, eaten cells out'''
+
+    def __init__(self, names=None):
+        create = names is None
+        self.players_shm = shared_memory.SharedMemory(
+            name=None if create else names[0], create=create, size=MAX_PLAYERS * PLAYER_RECORD_SIZE * 4)
+        self.eaten_shm = shared_memory.SharedMemory(
+            name=None if create else names[1], create=create, size=MAX_EATEN * EATEN_RECORD_SIZE * 4)
+        self.players = self.players_shm.buf.cast('f')
+        self.eaten = self.eaten_shm.buf.cast('I')
+
+    def names(self):
+        return self.players_shm.name, self.eaten_shm.name
+
+    def close(self, unlink=False):
+        self.players.release()
+        self.eaten.release()
+        for shm in (self.players_shm, self.eaten_shm):
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+
+def region_worker(first_key, last_key, bounds, map_size, bucket_size, world_name, cell_count, region_names, conn, seed):
+    '''Owns cells [first_key, last_key), resolves their collisions and respawns them inside its region'''
+    world = WorldBuffers(cell_count, world_name)
+    region = RegionBuffers(region_names)
+    rng = random.Random(seed)
+    left, right = bounds
+
+    grid = SpatialGrid(bucket_size)
+    for key in range(first_key, last_key):
+        world.pos_x[key] = rng.randint(left, right)
+        world.pos_y[key] = rng.randint(0, map_size)
+        world.color[key] = rng.randint(0, 255) * 256 * 256 + rng.randint(0, 255) * 256 + rng.randint(0, 255)
+        grid.insert(key, world.pos_x[key], world.pos_y[key])
+
+    conn.send("ready")
+
+    while True:
+        try:
+            player_count = conn.recv()
+        except EOFError:
+            player_count = None  # server process is gone
+        if player_count is None:
+            break
+
+        eaten = {}  # key, player index
+        for i in range(player_count):
+            offset = i * PLAYER_RECORD_SIZE
+            player_index, pos_x, pos_y, reach = region.players[offset:offset + PLAYER_RECORD_SIZE]
+            for key in grid.query(pos_x, pos_y, reach):
+                if key in eaten:
+                    continue
+                if (world.pos_x[key] - pos_x) ** 2 + (world.pos_y[key] - pos_y) ** 2 < reach ** 2:
+                    eaten[key] = int(player_index)
+                    if len(eaten) == MAX_EATEN:
+                        break
+
+        for i, (key, player_index) in enumerate(eaten.items()):
+            region.eaten[i * 2] = key
+            region.eaten[i * 2 + 1] = player_index
+
+            world.pos_x[key] = rng.randint(left, right)
+            world.pos_y[key] = rng.randint(0, map_size)
+            world.color[key] = rng.randint(0, 255) * 256 * 256 + rng.randint(0, 255) * 256 + rng.randint(0, 255)
+            grid.move(key, world.pos_x[key], world.pos_y[key])
+
+        conn.send(len(eaten))
+
+    region.close()
+    world.close()
+
+
+class ShardedCells():
+    '''Cells split into vertical map strips, each simulated by a worker process
+
+    The server process keeps players and connections. Every tick it writes players
+    overlapping a strip into that strip's shared buffer, workers eat and respawn their
+    own cells in parallel and report (cell key, player index) pairs back. Cell state
+    lives in shared memory, so the server reads new positions without copying them.
+    '''
+
+    def __init__(self, count, map_size, bucket_size, shards, seed=None):
+        self.count = count
+        self.map_size = map_size
+        self.world = WorldBuffers(count)
+        self.regions = []
+        self.processes = []
+        self.connections = []
+        self.bounds = []
+
+        seeds = random.Random(seed)
+        strip_width = map_size / shards
+        for shard in range(shards):
+            first_key, last_key = count * shard // shards, count * (shard + 1) // shards
+            bounds = (round(strip_width * shard), round(strip_width * (shard + 1)))
+            region = RegionBuffers()
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=region_worker, daemon=True,
+                args=(first_key, last_key, bounds, map_size, bucket_size, self.world.shm.name, count,
+                      region.names(), child_conn, seeds.getrandbits(32)))
+            process.start()
+
+            self.regions.append(region)
+            self.processes.append(process)
+            self.connections.append(parent_conn)
+            self.bounds.append(bounds)
+
+        for conn in self.connections:
+            conn.recv()  # cells are generated
+
+        atexit.register(self.close)
+
+    def __len__(self):
+        return self.count
+
+    def eat(self, players_x, players_y, players_reach):
+        '''Eats and respawns colliding cells, returns (cell keys, player indices)'''
+        for region, conn, (left, right) in zip(self.regions, self.connections, self.bounds):
+            player_count = 0
+            for index, (pos_x, pos_y, reach) in enumerate(zip(players_x, players_y, players_reach)):
+                if pos_x + reach < left or pos_x - reach > right or player_count == MAX_PLAYERS:
+                    continue
+                offset = player_count * PLAYER_RECORD_SIZE
+                region.players[offset] = index
+                region.players[offset + 1] = pos_x
+                region.players[offset + 2] = pos_y
+                region.players[offset + 3] = reach
+                player_count += 1
+            conn.send(player_count)
+
+        eaten_keys, eater_indexes = [], []
+        for region, conn in zip(self.regions, self.connections):
+            eaten_count = conn.recv()
+            eaten = region.eaten[0:eaten_count * EATEN_RECORD_SIZE]
+            eaten_keys.extend(eaten[0::2])
+            eater_indexes.extend(eaten[1::2])
+
+        return eaten_keys, eater_indexes
+
+    def values(self, keys):
+        '''(key, pos_x, pos_y, color) tuples with integer positions, as used in snapshots'''
+        return [(key, int(self.world.pos_x[key]), int(self.world.pos_y[key]), self.world.color[key]) for key in keys]
+
+    def close(self):
+        if not self.processes:
+            return
+
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=1)
+        for region in self.regions:
+            region.close(unlink=True)
+        self.world.close(unlink=True)
+        self.processes = []
+
+
+def _reference_eat(cells, grid, players_x, players_y, players_reach):
+    '''Single-process collision pass with the same rules as the workers'''
+    eaten = {}
+    for index, (pos_x, pos_y, reach) in enumerate(zip(players_x, players_y, players_reach)):
+        for key in grid.query(pos_x, pos_y, reach):
+            cell_x, cell_y = cells[key]
+            if key not in eaten and (cell_x - pos_x) ** 2 + (cell_y - pos_y) ** 2 < reach ** 2:
+                eaten[key] = index
+    return eaten
+
+
+def record_input_trace(player_count, ticks, seed):
+    '''Mouse vectors of every player for every tick, players change direction now and then'''
+    rng = random.Random(seed)
+    inputs = [(rng.uniform(-600, 600), rng.uniform(-600, 600)) for _ in range(player_count)]
+    trace = []
+    for _ in range(ticks):
+        inputs = [(rng.uniform(-600, 600), rng.uniform(-600, 600)) if rng.random() < 0.05 else mouse
+                  for mouse in inputs]
+        trace.append(inputs)
+    return trace
+
+
+def verify(count, map_size, bucket_size, shards, player_count, ticks, seed=0):
+    '''Replays an input trace on sharded and single-process engines, returns number of mismatching ticks'''
+    sharded = ShardedCells(count, map_size, bucket_size, shards, seed)
+    cells = {key: (sharded.world.pos_x[key], sharded.world.pos_y[key]) for key in range(count)}
+    grid = SpatialGrid(bucket_size)
+    for key, (pos_x, pos_y) in cells.items():
+        grid.insert(key, pos_x, pos_y)
+
+    rng = random.Random(seed)
+    players_x = [rng.uniform(0, map_size) for _ in range(player_count)]
+    players_y = [rng.uniform(0, map_size) for _ in range(player_count)]
+    radiuses = [35.0] * player_count
+
+    mismatches = 0
+    sharded_time = reference_time = 0
+    for tick_inputs in record_input_trace(player_count, ticks, seed):
+        for index, (mouse_x, mouse_y) in enumerate(tick_inputs):
+            players_x[index] = min(max(players_x[index] + mouse_x / radiuses[index] / 2, 0), map_size)
+            players_y[index] = min(max(players_y[index] + mouse_y / radiuses[index] / 2, 0), map_size)
+        reaches = [10 * 0.9 + radius for radius in radiuses]
+
+        start = time.perf_counter()
+        expected = _reference_eat(cells, grid, players_x, players_y, reaches)
+        reference_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        eaten_keys, eater_indexes = sharded.eat(players_x, players_y, reaches)
+        sharded_time += time.perf_counter() - start
+
+        if dict(zip(eaten_keys, eater_indexes)) != expected:
+            mismatches += 1
+
+        # both engines continue from the sharded respawn positions
+        for key, index in zip(eaten_keys, eater_indexes):
+            radiuses[index] += 0.5
+            cells[key] = (sharded.world.pos_x[key], sharded.world.pos_y[key])
+            grid.move(key, *cells[key])
+
+    sharded.close()
+    print(f"{ticks} ticks, {player_count} players, {count} cells, {shards} shards: {mismatches} mismatching ticks, "
+          f"single process {reference_time / ticks * 1000:.2f} ms/tick, sharded {sharded_time / ticks * 1000:.2f} ms/tick")
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check sharded cell simulation against a single process")
+    parser.add_argument("--cells", type=int, default=200_000)
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mismatches = verify(args.cells, 8000, 200, args.shards, args.players, args.ticks, args.seed)
+    raise SystemExit(1 if mismatches else 0)
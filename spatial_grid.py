@@ -0,0 +1,61 @@
+class SpatialGrid():
+    '''Uniform grid of square buckets used to find entities close to a point'''
+
+    def __init__(self, bucket_size):
+        self.bucket_size = bucket_size
+        self.buckets = {}  # (bucket_x, bucket_y), set of keys
+        self.key_buckets = {}  # key, (bucket_x, bucket_y)
+
+    def __len__(self):
+        return len(self.key_buckets)
+
+    def __contains__(self, key):
+        return key in self.key_buckets
+
+    def _bucket_of(self, x, y):
+        return int(x // self.bucket_size), int(y // self.bucket_size)
+
+    def insert(self, key, x, y):
+        bucket = self._bucket_of(x, y)
+        self.key_buckets[key] = bucket
+        self.buckets.setdefault(bucket, set()).add(key)
+
+    def remove(self, key):
+        bucket = self.key_buckets.pop(key, None)
+        if bucket is None:
+            return
+
+        keys = self.buckets[bucket]
+        keys.discard(key)
+        if not keys:
+            del self.buckets[bucket]
+
+    def move(self, key, x, y):
+        bucket = self._bucket_of(x, y)
+        if self.key_buckets.get(key) == bucket:
+            return
+
+        self.remove(key)
+        self.key_buckets[key] = bucket
+        self.buckets.setdefault(bucket, set()).add(key)
+
+    def clear(self):
+        self.buckets.clear()
+        self.key_buckets.clear()
+
+    def query(self, x, y, radius):
+        '''Returns keys from all buckets overlapping the square around (x, y)'''
+        return self.query_rect(x - radius, y - radius, x + radius, y + radius)
+
+    def query_rect(self, left, top, right, bottom):
+        min_x, min_y = self._bucket_of(left, top)
+        max_x, max_y = self._bucket_of(right, bottom)
+
+        found = []
+        for bucket_x in range(min_x, max_x + 1):
+            for bucket_y in range(min_y, max_y + 1):
+                keys = self.buckets.get((bucket_x, bucket_y))
+                if keys:
+                    found.extend(keys)
+
+        return found
@@ -0,0 +1,90 @@
+from checkpoint import (Checkpoint, CheckpointWriter, read_checkpoint, read_slot, pack_slot, FILE_HEADER,
+                        SLOT_HEADER, MAGIC, CELL_CHUNK_SIZE)
+from newtork_utils import CELL_RECORD
+
+
+def make_checkpoint(tick, players=()):
+    cells = b"".join(CELL_RECORD.pack(key, key * 10.0, key * 20.0, 0x102030 + key) for key in range(8))
+    cell_chunks = bytes(8 * CELL_CHUNK_SIZE)
+    return Checkpoint(tick, 1000, 250, cells, cell_chunks, list(players))
+
+
+def write(path, *checkpoints):
+    writer = CheckpointWriter(str(path))
+    for checkpoint in checkpoints:
+        writer.write(checkpoint)
+    writer.close()
+    return writer
+
+
+def latest_slot_offset(path):
+    magic, slot, slot_size = FILE_HEADER.unpack_from(path.read_bytes())
+    return FILE_HEADER.size + slot * slot_size
+
+
+def test_checkpoint_round_trips(tmp_path):
+    path = tmp_path / "checkpoint.bin"
+    players = [(4, 10.5, 20.25, 30.0, 0xFF00FF, 987654321, "bob")]
+    writer = write(path, make_checkpoint(42, players))
+    checkpoint = read_checkpoint(str(path))
+
+    assert checkpoint == make_checkpoint(42, players)._replace(generation=writer.generation)
+
+
+def test_slot_contents_are_covered_by_the_crc():
+    checkpoint = make_checkpoint(7)
+    header, parts = pack_slot(checkpoint)
+    data = bytearray(header + b"".join(parts))
+    assert read_slot(data, 0) == checkpoint
+
+    data[SLOT_HEADER.size + 3] ^= 0xFF
+    assert read_slot(data, 0) is None
+    assert read_slot(bytes(header + b"".join(parts))[:-1], 0) is None
+
+
+def test_damaged_latest_slot_falls_back_to_the_previous_one(tmp_path):
+    path = tmp_path / "checkpoint.bin"
+    write(path, make_checkpoint(1), make_checkpoint(2))
+    assert read_checkpoint(str(path)).tick == 2
+
+    data = bytearray(path.read_bytes())
+    data[latest_slot_offset(path) + SLOT_HEADER.size] ^= 0xFF
+    path.write_bytes(data)
+    assert read_checkpoint(str(path)).tick == 1
+
+
+def test_writer_keeps_the_checkpoint_of_an_existing_file(tmp_path):
+    path = tmp_path / "checkpoint.bin"
+    write(path, make_checkpoint(1))
+    writer = CheckpointWriter(str(path))
+    assert read_checkpoint(str(path)).tick == 1
+    writer.write(make_checkpoint(2))
+    writer.close()
+
+    assert read_checkpoint(str(path)).tick == 2
+
+
+def test_only_newer_checkpoints_are_read(tmp_path):
+    path = tmp_path / "checkpoint.bin"
+    write(path, make_checkpoint(100))
+    first = read_checkpoint(str(path))
+    assert read_checkpoint(str(path), first) is None
+
+    # a server started again over the same file starts counting ticks over
+    write(path, make_checkpoint(5))
+    restarted = read_checkpoint(str(path), first)
+    assert restarted.tick == 5 and restarted.generation > first.generation
+
+
+def test_missing_or_foreign_files_have_no_checkpoint(tmp_path):
+    path = tmp_path / "checkpoint.bin"
+    assert read_checkpoint(str(path)) is None
+
+    path.write_bytes(b"AG")
+    assert read_checkpoint(str(path)) is None
+
+    write(path, make_checkpoint(1))
+    data = bytearray(path.read_bytes())
+    data[:len(MAGIC)] = b"XXXX"
+    path.write_bytes(data)
+    assert read_checkpoint(str(path)) is None
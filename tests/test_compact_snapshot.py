@@ -0,0 +1,90 @@
+import struct
+import pytest
+import server
+from newtork_utils import (pack_compact_snapshot, unpack_compact_snapshot, quantize_position, dequantize_position,
+                           COMPACT_RADIUS_SCALE, MAX_COMPACT_MAP_SIZE)
+
+MAP_SIZE = 5000
+POSITION_ERROR = MAP_SIZE / 65535 / 2
+
+
+def round_trip(players, cells, server_baselines, client_baselines, map_size=MAP_SIZE):
+    packed = pack_compact_snapshot(players, cells, server_baselines, map_size)
+    length = struct.unpack_from('I', packed)[0]
+    assert length == len(packed) - 4
+    return unpack_compact_snapshot(packed[4:], client_baselines, map_size)
+
+
+def assert_close(received, sent):
+    assert len(received) == len(sent)
+    for (received_id, *received_values), (sent_id, *sent_values) in zip(received, sent):
+        assert received_id == sent_id
+        assert received_values == pytest.approx(sent_values, abs=POSITION_ERROR + 1 / COMPACT_RADIUS_SCALE)
+
+
+def test_first_snapshot_round_trips():
+    players = [(1, 10.5, 4999.0, 20.0), (300, 2500.25, 0.0, 31.3)]
+    cells = [(7, 100, 200, 0xABCDEF), (70000, 5000, 0, 0x000001)]
+    received_players, received_cells = round_trip(players, cells, {}, {})
+
+    assert_close(received_players, players)
+    assert [(key, color) for key, _, _, color in received_cells] == [(key, color) for key, _, _, color in cells]
+    assert_close([cell[:3] for cell in received_cells], [cell[:3] for cell in cells])
+
+
+def test_deltas_against_the_last_snapshot():
+    server_baselines, client_baselines = {}, {}
+    round_trip([(1, 100.0, 100.0, 20.0), (2, 900.0, 900.0, 25.0)], [], server_baselines, client_baselines)
+    moved = [(1, 103.0, 98.0, 20.0), (2, 900.0, 900.0, 26.5)]
+    received_players, _ = round_trip(moved, [], server_baselines, client_baselines)
+
+    assert_close(received_players, moved)
+    assert client_baselines == server_baselines
+
+
+def test_unchanged_players_are_small():
+    server_baselines, client_baselines = {}, {}
+    players = [(client_id, 100.0 * client_id, 50.0, 20.0) for client_id in range(1, 11)]
+    first = pack_compact_snapshot(players, [], server_baselines, MAP_SIZE)
+    unpack_compact_snapshot(first[4:], client_baselines, MAP_SIZE)
+    second = pack_compact_snapshot(players, [], server_baselines, MAP_SIZE)
+
+    assert len(second) < len(first) / 3
+    received_players, _ = unpack_compact_snapshot(second[4:], client_baselines, MAP_SIZE)
+    assert_close(received_players, players)
+
+
+def test_deltas_without_baseline_are_skipped():
+    server_baselines = {}
+    pack_compact_snapshot([(1, 100.0, 100.0, 20.0)], [], server_baselines, MAP_SIZE)
+    packed = pack_compact_snapshot([(1, 110.0, 100.0, 20.0)], [(3, 10, 10, 1)], server_baselines, MAP_SIZE)
+    players, cells = unpack_compact_snapshot(packed[4:], {}, MAP_SIZE)
+
+    assert players == []
+    assert [cell[0] for cell in cells] == [3]
+
+
+def test_players_are_sent_where_they_are(monkeypatch):
+    monkeypatch.setattr(server, "MAP_SIZE", MAP_SIZE)
+    player = server.Player(1, MAP_SIZE - 5, 3, 0, "edge", None)
+    player.input_x, player.input_y = 600, -600
+    for _ in range(10):
+        player.move(1 / 30)
+    assert (player.pos_x, player.pos_y) == (MAP_SIZE, 0)
+    assert not player.move(1 / 30)
+
+    # off the map the compact protocol would disagree with the standard one
+    sent = [(1, player.pos_x, player.pos_y, player.radius)]
+    received_players, _ = round_trip(sent, [], {}, {})
+    assert_close(received_players, sent)
+
+
+def test_positions_are_clamped_to_the_map():
+    assert quantize_position(-10, MAP_SIZE) == 0
+    assert quantize_position(MAP_SIZE + 10, MAP_SIZE) == 65535
+
+
+def test_quantization_error_on_the_biggest_map():
+    for value in (0, 1, 12345.6, MAX_COMPACT_MAP_SIZE / 3, MAX_COMPACT_MAP_SIZE):
+        quantized = quantize_position(value, MAX_COMPACT_MAP_SIZE)
+        assert abs(dequantize_position(quantized, MAX_COMPACT_MAP_SIZE) - value) <= 0.5
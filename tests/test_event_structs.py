@@ -0,0 +1,31 @@
+import struct
+from enums import Events
+from newtork_utils import EVENT_STRUCTS, pack_event
+
+SAMPLE_VALUES = {"I": 123456, "f": 2.5}
+
+
+def test_every_fixed_size_event_has_a_struct():
+    for event in Events:
+        if event.format is not None:
+            assert EVENT_STRUCTS[event.format].format == "I" + event.format
+
+
+def test_packed_events_match_packing_the_format():
+    for event in Events:
+        if event.format is None:
+            continue
+        values = [SAMPLE_VALUES[code] for code in event.format]
+        packed = pack_event(*values, event=event.code, format=event.format)
+
+        assert packed == struct.pack("I" + event.format, event.code, *values)
+        assert struct.unpack("I" + event.format, packed) == (event.code, *values)
+
+
+def test_events_without_values_are_their_code():
+    assert pack_event(event=Events.GAME_OVER.code, format=Events.GAME_OVER.format) == struct.pack("I", 4)
+
+
+def test_packed_data_follows_the_code():
+    packed = pack_event(event=Events.WORLD_SNAPSHOT.code, packed_data=b"\x02\x00\x00\x00ab")
+    assert packed == struct.pack("I", Events.WORLD_SNAPSHOT.code) + b"\x02\x00\x00\x00ab"
@@ -0,0 +1,44 @@
+import pytest
+import server
+
+
+class BreakingConnection():
+    '''Client that sends its messages and resets the connection when the server sends `breaks_on`'''
+
+    def __init__(self, messages, breaks_on):
+        self.messages = list(messages)
+        self.breaks_on = breaks_on
+
+    def recv(self, n_bytes):
+        return self.messages.pop(0) if self.messages else b""
+
+    def sendall(self, data):
+        if self.breaks_on in data:
+            raise ConnectionResetError("Connection reset by peer")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def world():
+    server.CELL_COUNT = 50
+    server.MAP_SIZE = 1000
+    server.init_game()
+
+
+@pytest.mark.parametrize("breaks_on", [b"INFO", b"POST cells", b"POST players"])
+def test_disconnect_while_joining_leaves_no_player(breaks_on):
+    server.handle_player_gameplay(BreakingConnection([b"ghost"], breaks_on), 1)
+
+    assert "ghost" not in server.players
+    assert all(player.username != "ghost" for player in server.players_grid.query_rect(0, 0, 1000, 1000))
+    player, msg = server.join_game(2, None, "ghost", "standard")
+    assert msg == "OK"
+    server.remove_player(player)
@@ -0,0 +1,57 @@
+import pytest
+from recorder import Recorder, read_recording, JOIN, INPUT, QUIT, END
+
+
+def record_session(path):
+    recorder = Recorder(str(path), "numpy", 1, 30, 20, 2000, 5000, 1234)
+    recorder.join(0, 1, "alice", "compact", "sequenced")
+    recorder.input(3, 1, 7, 120.5, -40.25)
+    recorder.quit(9, 1)
+    recorder.close(10, b"d" * 32)
+
+
+def test_recording_round_trips(tmp_path):
+    path = tmp_path / "session.rec"
+    record_session(path)
+    session, records = read_recording(str(path))
+
+    assert session == ("numpy", 1, 30, 20, 2000, 5000, 1234)
+    assert [(record_type, tick, values) for record_type, tick, _, values in records] == [
+        (JOIN, 0, (1, "alice", "compact", "sequenced")),
+        (INPUT, 3, (1, 7, 120.5, -40.25)),
+        (QUIT, 9, (1,)),
+        (END, 10, (b"d" * 32,)),
+    ]
+    timestamps = [timestamp for _, _, timestamp, _ in records]
+    assert timestamps == sorted(timestamps)
+
+
+def test_partial_last_record_is_ignored(tmp_path):
+    path = tmp_path / "session.rec"
+    record_session(path)
+    path.write_bytes(path.read_bytes()[:-1])
+
+    _, records = read_recording(str(path))
+    assert [record[0] for record in records] == [JOIN, INPUT, QUIT]
+
+
+def test_closing_without_digest_ends_the_records(tmp_path):
+    path = tmp_path / "session.rec"
+    recorder = Recorder(str(path), "python", 1, 30, 20, 10, 100, 1)
+    recorder.quit(1, 2)
+    recorder.close()
+    recorder.quit(2, 3)
+
+    _, records = read_recording(str(path))
+    assert [record[0] for record in records] == [QUIT]
+
+
+def test_other_versions_are_refused(tmp_path):
+    path = tmp_path / "session.rec"
+    record_session(path)
+    data = bytearray(path.read_bytes())
+    data[4] += 1
+    path.write_bytes(data)
+
+    with pytest.raises(ValueError):
+        read_recording(str(path))
@@ -0,0 +1,108 @@
+import struct
+from enums import Events
+from newtork_utils import pack_event, unpack_world_snapshot
+from send_queue import SendQueue, ThreadSendQueue
+
+EVENTS_BY_CODE = {event.code: event for event in Events}
+
+
+class RecordingConnection():
+    def __init__(self):
+        self.sent = bytearray()
+        self.shut_down = False
+
+    def sendall(self, data):
+        self.sent += data
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+
+def split_events(data):
+    '''Returns (event, values) of a sent stream, values of length prefixed events are their bytes'''
+    events = []
+    offset = 0
+    while offset < len(data):
+        event = EVENTS_BY_CODE[struct.unpack_from('I', data, offset)[0]]
+        offset += 4
+        if event.format is None:
+            length = struct.unpack_from('I', data, offset)[0]
+            events.append((event, bytes(data[offset + 4:offset + 4 + length])))
+            offset += 4 + length
+        else:
+            events.append((event, struct.unpack_from('=' + event.format, data, offset)))
+            offset += struct.calcsize('=' + event.format)
+    return events
+
+
+def snapshot_of(data):
+    [(event, packed_data)] = [(event, values) for event, values in split_events(data)
+                              if event is Events.WORLD_SNAPSHOT]
+    return unpack_world_snapshot(packed_data)
+
+
+def player_quit(client_id):
+    return pack_event(client_id, event=Events.PLAYER_QUIT.code, format=Events.PLAYER_QUIT.format)
+
+
+def test_snapshot_state_is_coalesced():
+    queue = SendQueue(RecordingConnection(), "standard", 1000, 1024)
+    queue.put_snapshot([(1, 10, 10, 20)], [(5, 100, 100, 7)])
+    queue.put_snapshot([(1, 12, 14, 21), (2, 50, 50, 20)], [(5, 200, 200, 7)])
+
+    players, cells = snapshot_of(queue.take())
+    assert sorted(players) == [(1, 12, 14, 21), (2, 50, 50, 20)]
+    assert cells == [(5, 200, 200, 7)]
+    assert not queue.has_data()
+
+
+def test_events_come_before_the_snapshot_in_order():
+    queue = SendQueue(RecordingConnection(), "standard", 1000, 1024)
+    queue.put_snapshot([(1, 10, 10, 20)], [])
+    queue.sendall(player_quit(3))
+    queue.sendall(player_quit(4))
+
+    events = split_events(queue.take())
+    assert [event for event, _ in events] == [Events.PLAYER_QUIT, Events.PLAYER_QUIT, Events.WORLD_SNAPSHOT]
+    assert [values for _, values in events[:2]] == [(3,), (4,)]
+
+
+def test_drop_policy_keeps_cell_changes():
+    queue = SendQueue(RecordingConnection(), "standard", 1000, 8, policy="drop")
+    queue.put_snapshot([(1, 10, 10, 20)], [(5, 100, 100, 7)])
+    queue.sendall(player_quit(3))
+    queue.sendall(player_quit(4))
+    queue.sendall(player_quit(5))
+    assert queue.is_backed_up()
+    assert queue.put_snapshot([(2, 50, 50, 20)], [(6, 300, 300, 9)])
+
+    players, cells = snapshot_of(queue.take())
+    assert players == []
+    assert sorted(cells) == [(5, 100, 100, 7), (6, 300, 300, 9)]
+    assert queue.metrics()["bytes_dropped"] > 0
+    assert not queue.closed
+
+
+def test_disconnect_policy_closes_slow_clients():
+    conn = RecordingConnection()
+    queue = SendQueue(conn, "standard", 1000, 8, policy="disconnect")
+    queue.put_snapshot([], [(5, 100, 100, 7)])
+    queue.sendall(player_quit(3))
+    queue.sendall(player_quit(4))
+
+    assert queue.closed and conn.shut_down
+    assert not queue.has_data()
+    assert not queue.put_snapshot([(1, 10, 10, 20)], [])
+
+
+def test_closing_sends_what_is_queued():
+    conn = RecordingConnection()
+    queue = ThreadSendQueue(conn, "standard", 1000, 1024)
+    queue.put_snapshot([], [(5, 100, 100, 7)])
+    queue.sendall(pack_event(event=Events.GAME_OVER.code, format=Events.GAME_OVER.format))
+    queue.close()
+    queue.wait_closed()
+
+    assert not queue.writer.is_alive()
+    events = [event for event, _ in split_events(conn.sent)]
+    assert Events.GAME_OVER in events and Events.WORLD_SNAPSHOT in events
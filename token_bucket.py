@@ -0,0 +1,26 @@
+import time
+
+
+class TokenBucket():
+    '''Allows rate events per second on average and bursts of up to burst events'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.reset()
+
+    def reset(self):
+        '''Full bucket, as if it was just created'''
+        self.tokens = self.burst
+        self.updated = time.perf_counter()
+
+    def consume(self):
+        '''Takes one token, returns False if there is none left'''
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True